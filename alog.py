@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
 import time
 import threading
 import Queue
@@ -24,13 +25,42 @@ class AsyncLogWriter:
 	# @param self
 	# @param ttl 使用していないファイルを閉じる時間 (秒単位)
 	# @param checkInterval flushなどを行う間隔 (秒単位)
-	def __init__(self, ttl = 60, checkInterval = 1):
-		self.ttl = ttl
-		self.checkInterval = checkInterval
-		self.qLog = Queue.Queue()
+	# @param bufferSize 間隔を待たずに書き出すバッファサイズ (バイト単位)
+	# @param queueSize 書き込み要求キューの最大行数 (0 の場合は無制限)
+	# @param policy キューが一杯の場合の動作 ('block' : 空くまで待つ, 'drop_old' : 古い行を捨てる, 'drop_new' : 新しい行を捨てる)
+	# @param fsyncInterval fsync を行う間隔 (秒単位) (0 の場合は行わない)
+	# @param formatter putRecord で渡されたログ情報を (ファイル名, 文字列) に変換する関数 (書き込みスレッドで呼び出される)
+	def __init__(self, ttl = 60, checkInterval = 1, bufferSize = 65536, queueSize = 0, policy = 'block', fsyncInterval = 0, formatter = None):
+		self.formatter = formatter
+		self.qLog = Queue.Queue(queueSize)
+		self.dropped = 0
+		self.formatErrors = 0
+		self.settings(ttl, checkInterval, bufferSize, queueSize, policy, fsyncInterval)
 		self.tLogTerminate = False
 		self.tLog = threading.Thread(target=AsyncLogWriter.writeThread, args=(self,))
 	
+	## 設定
+	# @param self
+	# @param ttl 使用していないファイルを閉じる時間 (秒単位)
+	# @param checkInterval flushなどを行う間隔 (秒単位)
+	# @param bufferSize 間隔を待たずに書き出すバッファサイズ (バイト単位)
+	# @param queueSize 書き込み要求キューの最大行数 (0 の場合は無制限)
+	# @param policy キューが一杯の場合の動作 ('block', 'drop_old' または 'drop_new')
+	# @param fsyncInterval fsync を行う間隔 (秒単位) (0 の場合は行わない)
+	def settings(self, ttl = None, checkInterval = None, bufferSize = None, queueSize = None, policy = None, fsyncInterval = None):
+		if ttl is not None:
+			self.ttl = ttl
+		if checkInterval is not None:
+			self.checkInterval = checkInterval
+		if bufferSize is not None:
+			self.bufferSize = bufferSize
+		if queueSize is not None:
+			self.qLog.maxsize = queueSize
+		if policy is not None:
+			self.policy = policy
+		if fsyncInterval is not None:
+			self.fsyncInterval = fsyncInterval
+	
 	## 初期化処理
 	# @param self
 	def initialize(self):
@@ -45,39 +75,150 @@ class AsyncLogWriter:
 			self.tLogTerminate = True
 			self.tLog.join()
 	
+	## 書き込み状況の取得
+	# @param self
+	# @return 統計情報の辞書
+	def stats(self):
+		return {'queue': self.qLog.qsize(), 'dropped': self.dropped, 'formatErrors': self.formatErrors}
+	
 	## 書き込み要求
 	# @param self
 	# @param fname ファイル名
 	# @param line 文字列
 	def puts(self, fname, line):
-		self.qLog.put((fname, line))
+		self.put((fname, line))
+	
+	## ログ情報の書き込み要求 (文字列への変換は書き込みスレッドで行う)
+	# @param self
+	# @param record formatter に渡すログ情報
+	def putRecord(self, record):
+		self.put((None, record))
+	
+	## 書き込み要求キューへの追加
+	# @param self
+	# @param item (ファイル名, 文字列) または (None, ログ情報)
+	def put(self, item):
+		if self.policy == 'block':
+			self.qLog.put(item)
+			return
+		
+		while True:
+			try:
+				self.qLog.put_nowait(item)
+				return
+			except Queue.Full:
+				pass
+			
+			# 新しい行を捨てる
+			if self.policy != 'drop_old':
+				self.dropped += 1
+				return
+			
+			# 古い行を捨てて空きを作る
+			try:
+				self.qLog.get_nowait()
+				self.dropped += 1
+			except Queue.Empty:
+				pass
+	
+	## 書き込み要求の変換 (書き込みスレッドで呼び出される)
+	# 変換に失敗した行は捨てて数える (1行のエラーで書き込みスレッドを止めない)
+	# @param self
+	# @param item (ファイル名, 文字列) または (None, ログ情報)
+	# @return (ファイル名, 文字列) (変換できなかった場合は None)
+	def format(self, item):
+		fname, line = item
+		
+		try:
+			if fname is None:
+				fname, line = self.formatter(line)
+			
+			# ユニコード文字列は他の行と連結できるよう UTF-8 にする
+			if isinstance(line, unicode):
+				line = line.encode('utf-8')
+			
+			return (fname, line)
+		except Exception:
+			self.formatErrors += 1
+			return None
+	
+	## ファイルを開く
+	# @param fname ファイル名
+	# @return ファイル情報 (開けなかった場合の fd は None)
+	@staticmethod
+	def openFile(fname):
+		try:
+			fd = os.open(fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		except OSError:
+			fd = None
+		
+		return {'fd': fd, 'buf': [], 'size': 0, 'atime': time.time()}
+	
+	## バッファの書き出し
+	# @param info ファイル情報
+	# @param fsync fsync を行うか否か
+	@staticmethod
+	def flushBuffer(info, fsync = False):
+		if info['fd'] is not None and len(info['buf']) > 0:
+			data = ''.join(info['buf'])
+			
+			# O_APPEND で行単位のまとまりを一度に書き込むので、複数プロセスから書き込んでも行が混ざらない
+			try:
+				while len(data) > 0:
+					data = data[os.write(info['fd'], data):]
+				
+				if fsync:
+					os.fsync(info['fd'])
+			except OSError:
+				pass
+		
+		info['buf'] = []
+		info['size'] = 0
 	
 	## 書き込みスレッド
 	# @param self
 	@staticmethod
 	def writeThread(self):
 		ctime = time.time()
+		stime = ctime
 		finfo = {}
 		
 		while not self.tLogTerminate:
 			try:
-				# 書き込み要求待ち
-				fname, line = self.qLog.get(timeout=0.1)
+				# 書き込み要求待ち (溜まっている分はまとめて取り出す)
+				batch = [self.qLog.get(timeout=0.1)]
 				
-				if fname not in finfo:
-					# ファイルを開く
-					try:
-						tmp = open(fname, 'a')
-						finfo[fname] = {'fp': tmp, 'atime': time.time()}
-					except IOError:
-						finfo[fname] = {'fp': None, 'atime': time.time()}
+				try:
+					while len(batch) < 10000:
+						batch.append(self.qLog.get_nowait())
+				except Queue.Empty:
+					pass
+				
+				atime = time.time()
 				
-				# 書き込み
-				if finfo[fname]['fp'] is not None:
-					finfo[fname]['fp'].write(line)
-					finfo[fname]['fp'].write('\n')
-					finfo[fname]['atime'] = time.time()
+				for item in batch:
+					item = self.format(item)
+					if item is None:
+						continue
+					
+					fname, line = item
+					
+					if fname not in finfo:
+						finfo[fname] = AsyncLogWriter.openFile(fname)
+					
+					# バッファに追加
+					info = finfo[fname]
+					
+					if info['fd'] is not None:
+						info['buf'].append(line + '\n')
+						info['size'] += len(line) + 1
+						info['atime'] = atime
 				
+				# 一定サイズ以上溜まったものは書き出す
+				for fname in finfo:
+					if finfo[fname]['size'] >= self.bufferSize:
+						AsyncLogWriter.flushBuffer(finfo[fname])
+			
 			except Queue.Empty:
 				pass
 			
@@ -87,10 +228,13 @@ class AsyncLogWriter:
 			if abs(crrtime - ctime) >= self.checkInterval:
 				abandon = []
 				
+				fsync = self.fsyncInterval > 0 and abs(crrtime - stime) >= self.fsyncInterval
+				if fsync:
+					stime = crrtime
+				
 				for fname in finfo:
 					# flush
-					if finfo[fname]['fp'] is not None:
-						finfo[fname]['fp'].flush()
+					AsyncLogWriter.flushBuffer(finfo[fname], fsync)
 					
 					# 使用していないファイルを列挙
 					if abs(crrtime - finfo[fname]['atime']) >= self.ttl:
@@ -98,14 +242,31 @@ class AsyncLogWriter:
 				
 				# 使用していないファイルを閉じる
 				for fname in abandon:
-					if finfo[fname]['fp'] is not None:
-						finfo[fname]['fp'].close()
+					if finfo[fname]['fd'] is not None:
+						os.close(finfo[fname]['fd'])
 					
 					del finfo[fname]
 				
 				ctime = crrtime
 		
-		# すべてのファイルを閉じる
+		# 残りの書き込み要求を処理してすべてのファイルを閉じる
+		try:
+			while True:
+				item = self.format(self.qLog.get_nowait())
+				if item is None:
+					continue
+				
+				fname, line = item
+				
+				if fname not in finfo:
+					finfo[fname] = AsyncLogWriter.openFile(fname)
+				
+				finfo[fname]['buf'].append(line + '\n')
+		except Queue.Empty:
+			pass
+		
 		for fname in finfo:
-			if finfo[fname]['fp'] is not None:
-				finfo[fname]['fp'].close()
+			AsyncLogWriter.flushBuffer(finfo[fname], self.fsyncInterval > 0)
+			
+			if finfo[fname]['fd'] is not None:
+				os.close(finfo[fname]['fd'])
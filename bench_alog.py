@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+## alog.py のアクセスログ書き込みの負荷試験
+# 一定の速度でアクセスログ情報を書き込み要求し、書き込みの遅れ (終了後に書き出し間隔を待っても書き込まれていない行数)、書き込み待ちの最大行数、
+# 書き込み要求の待ち時間 (ACCESS_LOG_QUEUE_POLICY が 'block' の場合にリクエスト処理を待たせる時間)、捨てた行数、メモリ使用量を計測します
+#
+# 例: python bench_alog.py --rate 50000 --seconds 10
+#     python bench_alog.py --rate 300000 --policy drop_old --queue-size 100000
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+import platform
+import threading
+
+import alog
+import tools
+from benchmark import procUsage, percentile
+
+# 比較するキューが一杯の場合の動作
+POLICIES = ['block', 'drop_old', 'drop_new']
+
+## アクセスログ情報の作成 (BaseHandler.finish と同じ形式)
+# @param tt 時刻 (UNIX時間)
+# @param n 通し番号
+# @return ログ情報
+def makeRecord(tt, n):
+	return (tt, '192.0.2.%d' % (n % 250 + 1), None, 'GET', '/tf2/sound/f%07d.wav' % n, 'HTTP/1.1', 200, '65536', '-', 'Mozilla/5.0 (bench_alog)', [])
+
+## アクセスログの整形 (redirect_srv.formatAccessLog と同じ処理量にする)
+# @param logDir ログディレクトリ
+# @return ログ情報を (ログファイル名, 文字列) に変換する関数
+def makeFormatter(logDir):
+	fname = os.path.join(logDir, 'access_log_bench.log')
+	
+	def formatter(record):
+		tt, remoteIp, auth, method, uri, version, status, contentLength, referer, userAgent, logs = record
+		authInfo = tools.parseBasicAuth(auth)
+		
+		logStr = '%s - %s [%s] "%s %s %s" %d %d "%s" "%s"' % (
+			remoteIp,
+			authInfo[0] if authInfo is not None and authInfo[0] != '' else '-',
+			tools.getApacheLogDatetime(tt),
+			method,
+			uri,
+			version,
+			status,
+			int(contentLength),
+			referer,
+			userAgent
+		)
+		
+		return (fname, logStr)
+	
+	return formatter
+
+## ファイルの行数
+# @param fname ファイル名
+# @return 行数 (ファイルが無い場合は 0)
+def countLines(fname):
+	if not os.path.exists(fname):
+		return 0
+	
+	fp = open(fname, 'rb')
+	n = 0
+	
+	try:
+		while True:
+			data = fp.read(1048576)
+			if len(data) == 0:
+				break
+			n += data.count('\n')
+	finally:
+		fp.close()
+	
+	return n
+
+## 1回の計測
+# @param rate 書き込み要求する速度 (行/sec)
+# @param seconds 書き込み要求する時間 (sec)
+# @param queueSize 書き込み待ちの最大行数 (0 の場合は無制限)
+# @param policy キューが一杯の場合の動作
+# @return 結果の辞書
+def run(rate, seconds, queueSize, policy):
+	logDir = tempfile.mkdtemp(prefix='bench_alog')
+	formatter = makeFormatter(logDir)
+	fname = formatter(makeRecord(0, 0))[0]
+	writer = alog.AsyncLogWriter(formatter=formatter, queueSize=queueSize, policy=policy)
+	writer.initialize()
+	
+	# 書き込み待ちの行数とメモリ使用量を 10ms 毎に記録する
+	peak = {'queue': 0, 'rss': 0}
+	done = threading.Event()
+	
+	def monitor():
+		while not done.isSet():
+			peak['queue'] = max(peak['queue'], writer.stats()['queue'])
+			peak['rss'] = max(peak['rss'], procUsage(os.getpid())[1])
+			time.sleep(0.01)
+	
+	th = threading.Thread(target=monitor)
+	th.start()
+	
+	# 10ms 毎にその時点までの分を書き込み要求する (リクエスト処理のスレッドの代わり)
+	waits = []
+	offered = 0
+	start = time.time()
+	
+	try:
+		while True:
+			crrtime = time.time()
+			elapsed = crrtime - start
+			
+			if elapsed >= seconds:
+				break
+			
+			target = int(rate * elapsed)
+			
+			while offered < target:
+				t0 = time.time()
+				writer.putRecord(makeRecord(crrtime, offered))
+				waits.append(time.time() - t0)
+				offered += 1
+			
+			time.sleep(0.01)
+		
+		offerTime = time.time() - start
+		
+		# 書き込み要求の終了後、書き出し間隔を待った時点で書き込み済みの行数 (追いついていれば捨てた分を除くすべて)
+		time.sleep(writer.checkInterval + 0.2)
+		written = countLines(fname)
+		stats = writer.stats()
+		
+		writer.finalize()
+		total = countLines(fname)
+	finally:
+		done.set()
+		th.join()
+		writer.finalize()
+		shutil.rmtree(logDir)
+	
+	waits.sort()
+	ms = lambda x: round(x * 1000, 3) if x is not None else None
+	
+	return {
+		'rate': rate,
+		'policy': policy,
+		'queue_size': queueSize,
+		'offered': offered,
+		'offered_per_sec': round(offered / offerTime, 1),
+		'written': written,
+		'backlog': offered - written - stats['dropped'],
+		'dropped': stats['dropped'],
+		'lost': offered - total - stats['dropped'],
+		'peak_queue': peak['queue'],
+		'put_ms': {'p99': ms(percentile(waits, 0.99)), 'p999': ms(percentile(waits, 0.999)), 'max': ms(waits[-1] if len(waits) > 0 else None)},
+		'peak_rss_kb': peak['rss'],
+	}
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--rate', default='50000', help='offered lines per second, comma separated for several runs (default: %default)')
+	parser.add_option('--seconds', type='float', default=10, help='seconds to offer lines per run (default: %default)')
+	parser.add_option('--queue-size', type='int', default=100000, help='ACCESS_LOG_QUEUE_SIZE (default: %default)')
+	parser.add_option('--policy', default=','.join(POLICIES), help='ACCESS_LOG_QUEUE_POLICY values to compare (default: %default)')
+	parser.add_option('--output', default=None, help='write the results as JSON to this file')
+	opts, args = parser.parse_args()
+	
+	results = []
+	
+	print '%8s %-9s %10s %10s %10s %10s %10s %12s %12s %10s' % ('rate', 'policy', 'offered/s', 'backlog', 'dropped', 'lost', 'peak queue', 'put p999 ms', 'put max ms', 'rss KB')
+	
+	for rate in [int(x) for x in opts.rate.split(',')]:
+		for policy in opts.policy.split(','):
+			x = run(rate, opts.seconds, opts.queue_size, policy)
+			results.append(x)
+			print '%8d %-9s %10.1f %10d %10d %10d %10d %12s %12s %10d' % (rate, policy, x['offered_per_sec'], x['backlog'], x['dropped'], x['lost'], x['peak_queue'], x['put_ms']['p999'], x['put_ms']['max'], x['peak_rss_kb'])
+	
+	if opts.output:
+		fp = open(opts.output, 'w')
+		json.dump({
+			'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+			'host': {'platform': platform.platform(), 'python': platform.python_version()},
+			'params': {'seconds': opts.seconds, 'queue_size': opts.queue_size},
+			'results': results,
+		}, fp, indent=1, sort_keys=True)
+		fp.close()
+	
+	sys.exit(1 if any(x['lost'] != 0 for x in results) else 0)
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+## fcache.py の総キャッシュサイズ削減のマイクロベンチマークと動作確認
+# キャッシュ満杯の状態で、読み込み毎にロックを取得したまま実行される削除対象の列挙 (victims) と
+# 1回の読み込みの処理 (admit, trim, 追加) を、エントリ数毎に以前の全件ソートの実装と比較します
+# recent は、ほとんどのエントリが最小生存時間以下で容量を確保できない場合の削除対象の列挙です
+#
+# 例: python bench_fcache.py --entries 1000,10000,100000
+#     python bench_fcache.py --check-only
+
+import sys
+import json
+import time
+import optparse
+import platform
+
+import fcache
+from bench_tools import Checker, measure
+
+# 計測するエントリ数
+ENTRY_COUNTS = [1000, 10000, 100000]
+
+# 計測する置き換えポリシー
+POLICIES = ['lru', 'gdsf']
+
+# 1エントリのサイズ (byte)
+ENTRY_SIZE = 100
+
+# 最小キャッシュ生存時間 (sec)
+MIN_TTL = 60
+
+## 以前の総キャッシュサイズ削減 (全エントリをアクセス時間でソートし、総サイズを数え直す)
+# @param cache ファイル名をキーとしたキャッシュエントリの辞書
+# @param padding 水増しサイズ (byte)
+# @param maxtotal 最大総キャッシュサイズ (byte)
+# @param minTTL 最小キャッシュ生存時間 (sec)
+# @param ignore 除外するファイル名のリスト
+# @return (削除するファイル名のリスト, maxtotal 以下のサイズに削減できるか否か)
+def victimsSorted(cache, padding, maxtotal, minTTL, ignore):
+	crrtime = time.time()
+	total = padding
+	abandon = []
+	
+	for fname in sorted(cache, key=lambda x: cache[x]['atime'], reverse=True):
+		if fname in ignore:
+			continue
+		
+		entry = cache[fname]
+		size = fcache.entrySize(entry)
+		total += size
+		
+		# ロックされているか、最小生存時間以下のものは削除しない
+		if entry['lock'] or abs(crrtime - entry['atime']) <= minTTL:
+			continue
+		
+		if size > 0 and total > maxtotal:
+			total -= size
+			abandon.append(fname)
+	
+	return (abandon, not (total > maxtotal))
+
+## 満杯のキャッシュ
+# 読み込みスレッドは起動せず、読み込み完了後と同じ手順でエントリを追加する
+class FullCache:
+	## コンストラクタ
+	# @param self
+	# @param n エントリ数
+	# @param policy 置き換えポリシー名
+	def __init__(self, n, policy):
+		self.afcache = fcache.AyncFileCache(ENTRY_SIZE, n * ENTRY_SIZE, 3600, MIN_TTL, 3600, policy=policy)
+		self.data = 'x' * ENTRY_SIZE
+		
+		# アクセス時間はすべて最小生存時間より古く、追加順に新しくする
+		self.atime = time.time() - MIN_TTL * 1000
+		self.serial = 0
+		
+		for i in xrange(n):
+			self.add()
+	
+	## 読み込み完了したエントリの追加
+	# @param self
+	# @return ファイル名
+	def add(self):
+		afcache = self.afcache
+		fname = '/bench/f%08d' % self.serial
+		self.serial += 1
+		
+		with afcache.lock:
+			entry = fcache.newEntry()
+			entry['atime'] = self.atime + self.serial * 0.001
+			afcache.cache[fname] = entry
+			afcache.setData(fname, entry, self.data)
+			afcache.policy.loaded(fname, ENTRY_SIZE)
+		
+		return fname
+	
+	## 古い順に keep 個以外を最小生存時間以下のエントリにする
+	# @param self
+	# @param keep 最小生存時間を過ぎたまま残すエントリ数
+	# @return 最小生存時間を過ぎたファイル名のリスト
+	def touch(self, keep):
+		fnames = self.afcache.cache.keys()
+		
+		for fname in fnames[keep:]:
+			self.afcache.cache[fname]['atime'] = time.time()
+		
+		return fnames[:keep]
+	
+	## 新しいファイルの読み込み (readThread のロック中の処理)
+	# @param self
+	def miss(self):
+		afcache = self.afcache
+		fname = '/bench/f%08d' % self.serial
+		
+		# 3回リクエストされたファイルとする (アクセス頻度を使うポリシーでも受け入れられるように)
+		for i in xrange(3):
+			afcache.policy.record(fname, None)
+		
+		with afcache.lock:
+			victims = afcache.admit(fname, ENTRY_SIZE)
+			
+			if victims is not None and afcache.trim(ENTRY_SIZE, ignore=[fname], victims=victims):
+				self.add()
+	
+	## 以前の実装での新しいファイルの読み込み
+	# @param self
+	def missSorted(self):
+		afcache = self.afcache
+		
+		with afcache.lock:
+			abandon, fit = victimsSorted(afcache.cache, ENTRY_SIZE, afcache.maxtotal, MIN_TTL, [])
+			
+			for fname in abandon:
+				afcache.remove(fname, True)
+			
+			if fit:
+				self.add()
+
+## 動作確認クラス
+class CacheChecker(Checker):
+	## 削除対象の確認
+	# @param self
+	# @param n エントリ数
+	# @param policy 置き換えポリシー名
+	def victims(self, n, policy):
+		full = FullCache(n, policy)
+		afcache = full.afcache
+		
+		# 総サイズの集計
+		self.check(afcache.total == n * ENTRY_SIZE, 'total %s n=%d: %d' % (policy, n, afcache.total))
+		
+		# 1エントリ分の空きを作るには1つ削除する (LRU では以前の実装と同じもの)
+		abandon, fit = afcache.victims(ENTRY_SIZE)
+		self.check(fit and len(abandon) == 1, 'victims %s n=%d: %r %r' % (policy, n, abandon, fit))
+		
+		if policy == 'lru':
+			self.check((abandon, fit) == victimsSorted(afcache.cache, ENTRY_SIZE, afcache.maxtotal, MIN_TTL, []), 'victims %s n=%d differs from sorted' % (policy, n))
+		
+		# 10エントリ分
+		abandon, fit = afcache.victims(ENTRY_SIZE * 10)
+		self.check(fit and len(abandon) == 10 and len(set(abandon)) == 10, 'victims %s n=%d padding=10: %d' % (policy, n, len(abandon)))
+		
+		if policy == 'lru':
+			self.check(sorted(abandon) == sorted(victimsSorted(afcache.cache, ENTRY_SIZE * 10, afcache.maxtotal, MIN_TTL, [])[0]), 'victims %s n=%d padding=10 differs from sorted' % (policy, n))
+		
+		# ロックされているもの、除外するもの、最小生存時間以下のものは削除しない
+		locked, ignored, recent = abandon[:3]
+		afcache.cache[locked]['lock'] = True
+		afcache.cache[recent]['atime'] = time.time()
+		afcache.cache[recent] = afcache.cache.pop(recent)
+		abandon, fit = afcache.victims(ENTRY_SIZE * 10, ignore=[ignored])
+		self.check(fit and len([x for x in (locked, ignored, recent) if x in abandon]) == 0, 'victims %s n=%d skips locked, ignored and recent entries' % (policy, n))
+		
+		# 最大総キャッシュサイズより大きいものは収まらない
+		self.check(not afcache.victims(n * ENTRY_SIZE * 2)[1], 'victims %s n=%d oversize fits' % (policy, n))
+	
+	## GDSF の削除順の確認 (ヒープをたどる順が優先度の昇順になり、更新前の優先度は含まない)
+	# @param self
+	# @param n エントリ数
+	def order(self, n):
+		full = FullCache(n, 'gdsf')
+		afcache = full.afcache
+		policy = afcache.policy
+		fnames = afcache.cache.keys()
+		
+		# ヒットで優先度を更新し、古い優先度をヒープに残す
+		for i in xrange(n * 2):
+			fname = fnames[(i * 7919) % n]
+			policy.record(fname, ENTRY_SIZE)
+		
+		order = [x[0] for x in policy.evictionOrder(afcache.cache)]
+		expect = sorted(afcache.cache, key=lambda x: (policy.priority[x], x))
+		self.check(order == expect, 'order gdsf n=%d: %r' % (n, order[:10]))
+		
+		# 途中で止めた場合もヒープは変更しない
+		heap = list(policy.heap)
+		order = policy.evictionOrder(afcache.cache)
+		head = [order.next() for i in xrange(min(n, 5))]
+		self.check(head == [(x, afcache.cache[x]) for x in expect[:5]] and policy.heap == heap, 'order gdsf n=%d: partial' % n)
+	
+	## 最小生存時間以下のものばかりの場合の削除対象の確認
+	# @param self
+	# @param n エントリ数
+	# @param policy 置き換えポリシー名
+	def recent(self, n, policy):
+		full = FullCache(n, policy)
+		afcache = full.afcache
+		fnames = full.touch(5)
+		
+		# 古いものをすべて削除しても収まらない
+		abandon, fit = afcache.victims(ENTRY_SIZE * 10)
+		self.check(not fit and sorted(abandon) == fnames, 'recent %s n=%d padding=10: %r %r' % (policy, n, abandon, fit))
+		self.check(sorted(abandon) == sorted(victimsSorted(afcache.cache, ENTRY_SIZE * 10, afcache.maxtotal, MIN_TTL, [])[0]), 'recent %s n=%d padding=10 differs from sorted' % (policy, n))
+		
+		# 古いものの一部で収まる
+		abandon, fit = afcache.victims(ENTRY_SIZE * 3)
+		self.check(fit and len(abandon) == 3 and set(abandon) <= set(fnames), 'recent %s n=%d padding=3: %r %r' % (policy, n, abandon, fit))
+		
+		# 除外するものとロックされているものは削除対象にしない
+		afcache.cache[fnames[0]]['lock'] = True
+		abandon, fit = afcache.victims(ENTRY_SIZE * 10, ignore=[fnames[1]])
+		self.check(not fit and sorted(abandon) == fnames[2:5], 'recent %s n=%d locked and ignored: %r' % (policy, n, abandon))
+	
+	## 読み込み後の総サイズの確認
+	# @param self
+	# @param n エントリ数
+	# @param policy 置き換えポリシー名
+	def miss(self, n, policy):
+		full = FullCache(n, policy)
+		afcache = full.afcache
+		
+		# 最初からあったエントリがすべて置き換わるまで
+		for i in xrange(n):
+			full.miss()
+		
+		size = sum(fcache.entrySize(x) for x in afcache.cache.itervalues())
+		self.check(afcache.total == size and size <= afcache.maxtotal, 'miss %s n=%d: total %d, actual %d' % (policy, n, afcache.total, size))
+		self.check(len(afcache.cache) == n, 'miss %s n=%d: %d entries' % (policy, n, len(afcache.cache)))
+		self.check(afcache.counters['evictions'] == n, 'miss %s n=%d: %d evictions' % (policy, n, afcache.counters['evictions']))
+	
+	## すべての確認
+	# @param self
+	def run(self):
+		for policy in POLICIES + ['tinylfu']:
+			for n in (20, 1000):
+				self.victims(n, policy)
+				self.recent(n, policy)
+				self.miss(n, policy)
+		
+		for n in (1, 20, 1000):
+			self.order(n)
+
+## 計測対象の列挙
+# @param counts エントリ数のリスト
+# @return (名前, エントリ数, 以前の実装の関数, 関数の辞書) のリスト
+def cases(counts):
+	ret = []
+	
+	for n in counts:
+		caches = dict((policy, FullCache(n, policy)) for policy in POLICIES)
+		old = caches['lru']
+		
+		# 削除対象の列挙 (ロック中)
+		ret.append(('victims', n, lambda old=old: victimsSorted(old.afcache.cache, ENTRY_SIZE, old.afcache.maxtotal, MIN_TTL, []), dict((policy, lambda x=x: x.afcache.victims(ENTRY_SIZE)) for policy, x in caches.iteritems())))
+		
+		# 最小生存時間以下のものばかりの場合の削除対象の列挙 (古いものをすべて削除しても収まらない)
+		recent = dict((policy, FullCache(n, policy)) for policy in POLICIES)
+		for x in recent.itervalues():
+			x.touch(5)
+		
+		old = recent['lru']
+		ret.append(('recent', n, lambda old=old: victimsSorted(old.afcache.cache, ENTRY_SIZE * 10, old.afcache.maxtotal, MIN_TTL, []), dict((policy, lambda x=x: x.afcache.victims(ENTRY_SIZE * 10)) for policy, x in recent.iteritems())))
+		
+		# 1回の読み込み (admit, trim, 追加)
+		ret.append(('miss', n, FullCache(n, 'lru').missSorted, dict((policy, x.miss) for policy, x in caches.iteritems())))
+	
+	return ret
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--entries', default=','.join(str(x) for x in ENTRY_COUNTS), help='cache entry counts to measure (default: %default)')
+	parser.add_option('--min-time', type='float', default=0.2, help='minimum seconds per measurement (default: %default)')
+	parser.add_option('--repeat', type='int', default=3, help='measurements per case, the fastest is kept (default: %default)')
+	parser.add_option('--output', default=None, help='write the results as JSON to this file')
+	parser.add_option('--check-only', action='store_true', default=False, help='run the correctness checks only')
+	opts, args = parser.parse_args()
+	
+	# 動作確認
+	checker = CacheChecker()
+	checker.run()
+	
+	print '%d checks, %d failed' % (checker.count, len(checker.failures))
+	for msg in checker.failures[:50]:
+		print '  FAIL', msg
+	
+	if opts.check_only:
+		sys.exit(1 if checker.failures else 0)
+	
+	# 計測
+	results = []
+	
+	print
+	print '%-8s %8s %12s %s' % ('case', 'entries', 'sorted usec', ' '.join('%12s %8s' % (x + ' usec', 'speedup') for x in POLICIES))
+	
+	for name, n, old, funcs in cases([int(x) for x in opts.entries.split(',')]):
+		usec = measure(old, opts.min_time, opts.repeat)
+		result = {'case': name, 'entries': n, 'sorted_usec': usec}
+		line = '%-8s %8d %12.3f' % (name, n, usec)
+		
+		for policy in POLICIES:
+			x = measure(funcs[policy], opts.min_time, opts.repeat)
+			result[policy + '_usec'] = x
+			line += ' %12.3f %7.1fx' % (x, usec / x)
+		
+		results.append(result)
+		print line
+	
+	if opts.output:
+		fp = open(opts.output, 'w')
+		json.dump({
+			'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+			'host': {'platform': platform.platform(), 'python': platform.python_version()},
+			'results': results,
+		}, fp, indent=1, sort_keys=True)
+		fp.close()
+	
+	sys.exit(1 if checker.failures else 0)
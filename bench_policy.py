@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+## キャッシュの置き換えポリシーの比較
+# アクセスログ (または合成したアクセス列) を cachepolicy.py の各ポリシーで再生し、
+# 最大総キャッシュサイズ毎のヒット率とバイトヒット率を比較します
+# キャッシュの追加と削除は fcache.py と同じ手順で判定します (リクエストの時刻で、最小キャッシュ生存時間以下のものは削除せず、
+# 受け入れなかったものは fcache.REJECT_RETRY、容量を確保できなかったものはファイルチェック間隔の間、判定し直さずにリダイレクトする)
+# 最大キャッシュ生存時間による削除と読み込み時間は考慮しません
+#
+# 例: python bench_policy.py --log logs/access_log_20111201.log --log logs/access_log_20111202.log
+#     python bench_policy.py --files 20000 --requests 500000 --zipf 0.9 --scan 0.3 --rate 200
+
+import re
+import sys
+import json
+import time
+import bisect
+import random
+import calendar
+import optparse
+import collections
+
+import config
+import fcache
+import cachepolicy
+from benchmark import parseSizes
+
+# 比較するポリシー
+POLICIES = ['lru', 'tinylfu', 'gdsf']
+
+# Combine 形式のアクセスログ (日時, メソッド, URI, ステータス, サイズ)
+LOG_PATTERN = re.compile(r'^\S+ \S+ \S+ \[([^\]]*)\] "(\S+) (\S+)[^"]*" (\d{3}) (\d+)')
+
+## アクセスログの読み込み
+# サイズはステータス 200 で送信した最大のサイズを使用し、一度も送信していないファイルは除く
+# @param fnames ログファイル名のリスト
+# @return (時刻, ファイル名, サイズ) のリスト (時刻は UNIX時間、タイムゾーンは無視する)
+def loadLogs(fnames):
+	requests = []
+	sizes = {}
+	times = {}
+	
+	for fname in fnames:
+		fp = open(fname, 'rb')
+		
+		try:
+			for line in fp:
+				m = LOG_PATTERN.match(line)
+				
+				if m is None or m.group(2) not in ('GET', 'HEAD') or m.group(3).startswith('/!'):
+					continue
+				
+				# 同じ秒の日時は変換済みのものを使う
+				tt = times.get(m.group(1))
+				if tt is None:
+					tt = calendar.timegm(time.strptime(m.group(1)[:20], '%d/%b/%Y:%H:%M:%S'))
+					times[m.group(1)] = tt
+				
+				path = m.group(3).split('?', 1)[0]
+				requests.append((tt, path))
+				
+				if m.group(4) == '200':
+					sizes[path] = max(sizes.get(path, 0), int(m.group(5)))
+		finally:
+			fp.close()
+	
+	return [(tt, x, sizes[x]) for tt, x in requests if x in sizes]
+
+## アクセス列の合成
+# 人気は Zipf 分布に従い、scan の割合で一度しかアクセスされないファイルが混ざる (クローラや一括ダウンロード)
+# @param nfiles ファイル数
+# @param nrequests リクエスト数
+# @param zipf Zipf 分布の指数
+# @param scan 一度しかアクセスされないファイルへのリクエストの割合
+# @param sizes (サイズ, 比率) のリスト
+# @param seed 乱数の種
+# @param rate 1秒あたりのリクエスト数 (一定間隔で並べる)
+# @return (時刻, ファイル名, サイズ) のリスト (時刻は 0 からの秒数)
+def makeTrace(nfiles, nrequests, zipf, scan, sizes, seed, rate):
+	rnd = random.Random(seed)
+	total = sum(x[1] for x in sizes)
+	
+	## サイズの選択
+	def chooseSize():
+		r = rnd.uniform(0, total)
+		for size, weight in sizes:
+			r -= weight
+			if r <= 0:
+				break
+		return size
+	
+	fsizes = [chooseSize() for i in xrange(nfiles)]
+	
+	# 順位 i のファイルの累積の重み
+	cumulative = []
+	acc = 0.0
+	for i in xrange(nfiles):
+		acc += 1.0 / (i + 1) ** zipf
+		cumulative.append(acc)
+	
+	trace = []
+	
+	for n in xrange(nrequests):
+		tt = float(n) / rate
+		
+		if rnd.random() < scan:
+			trace.append((tt, '/scan/%07d' % n, chooseSize()))
+		else:
+			i = min(bisect.bisect_left(cumulative, rnd.uniform(0, acc)), nfiles - 1)
+			trace.append((tt, '/hot/%06d' % i, fsizes[i]))
+	
+	return trace
+
+## 削除するファイルの列挙 (fcache.AyncFileCache.victims と同じ判定)
+# @param policy 置き換えポリシー
+# @param cache ファイル名をキーとしたサイズの OrderedDict (アクセス時間順)
+# @param atime ファイル名をキーとしたアクセス時刻の辞書
+# @param total 新しいファイルを含めた総サイズ (byte)
+# @param maxtotal 最大総キャッシュサイズ (byte)
+# @param minTTL 最小キャッシュ生存時間 (sec)
+# @param crrtime 現在の時刻
+# @return (削除するファイル名のリスト, maxtotal 以下のサイズに削減できるか否か)
+def victims(policy, cache, atime, total, maxtotal, minTTL, crrtime):
+	abandon = []
+	
+	# 最小生存時間を過ぎたものをすべて削除しても収まらない場合は置き換えポリシーの削除順にたどらない
+	if not policy.lruOrder:
+		free = 0
+		
+		for fname, size in cache.iteritems():
+			if not (total - free > maxtotal) or abs(crrtime - atime[fname]) <= minTTL:
+				break
+			
+			free += size
+			abandon.append(fname)
+		
+		if total - free > maxtotal:
+			return (abandon, False)
+		
+		abandon = []
+	
+	for fname, size in policy.evictionOrder(cache):
+		if not (total > maxtotal):
+			break
+		
+		# 最小生存時間以下のものは削除しない
+		if abs(crrtime - atime[fname]) <= minTTL:
+			if policy.lruOrder:
+				break
+			continue
+		
+		if size > 0:
+			total -= size
+			abandon.append(fname)
+	
+	return (abandon, not (total > maxtotal))
+
+## アクセス列の再生
+# @param trace (時刻, ファイル名, サイズ) のリスト
+# @param name ポリシー名
+# @param maxtotal 最大総キャッシュサイズ (byte)
+# @param maxfsize キャッシュする最大ファイルサイズ (byte)
+# @param sketchWidth アクセス頻度を推定するカウンタの1行あたりの数
+# @param minTTL 最小キャッシュ生存時間 (sec)
+# @param cintval ファイルチェック間隔 (sec)
+# @return 結果の辞書
+def replay(trace, name, maxtotal, maxfsize, sketchWidth, minTTL, cintval):
+	policy = cachepolicy.create(name, sketchWidth)
+	cache = collections.OrderedDict()
+	atime = {}
+	retry = {}
+	total = 0
+	hits = 0
+	hitBytes = 0
+	rejections = 0
+	full = 0
+	evictions = 0
+	
+	start = time.time()
+	
+	for tt, fname, size in trace:
+		if fname in cache:
+			# 最近アクセスされたものを末尾へ移動
+			cache[fname] = cache.pop(fname)
+			atime[fname] = tt
+			policy.record(fname, size)
+			hits += 1
+			hitBytes += size
+			continue
+		
+		policy.record(fname, None)
+		
+		# 受け入れなかったもの、容量を確保できなかったものは再判定まではリダイレクトする
+		if tt < retry.get(fname, tt):
+			continue
+		
+		if size > maxfsize:
+			continue
+		
+		abandon, fit = victims(policy, cache, atime, total + size, maxtotal, minTTL, tt)
+		
+		# 置き換えポリシーが受け入れない (fcache.AyncFileCache.admit と同じ判定)
+		if len(abandon) > 0 and fit and not policy.admit(fname, size, abandon):
+			rejections += 1
+			retry[fname] = tt + min(fcache.REJECT_RETRY, cintval)
+			continue
+		
+		# 容量を確保できない場合も列挙したものは削除される
+		for victim in abandon:
+			total -= cache.pop(victim)
+			del atime[victim]
+			policy.remove(victim, True)
+		
+		evictions += len(abandon)
+		
+		if not fit:
+			full += 1
+			retry[fname] = tt + cintval
+			continue
+		
+		retry.pop(fname, None)
+		cache[fname] = size
+		atime[fname] = tt
+		total += size
+		policy.loaded(fname, size)
+	
+	elapsed = time.time() - start
+	requests = len(trace)
+	traceBytes = sum(x[2] for x in trace)
+	
+	return {
+		'policy': name,
+		'maxtotal': maxtotal,
+		'hit_ratio': round(float(hits) / requests, 4) if requests > 0 else 0.0,
+		'byte_hit_ratio': round(float(hitBytes) / traceBytes, 4) if traceBytes > 0 else 0.0,
+		'rejections': rejections,
+		'cache_full': full,
+		'evictions': evictions,
+		'usec_per_request': round(elapsed / requests * 1e6, 2) if requests > 0 else 0.0,
+	}
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--log', action='append', default=[], help='replay this access log (repeatable); a synthetic trace is used if omitted')
+	parser.add_option('--files', type='int', default=20000, help='synthetic files with Zipf popularity (default: %default)')
+	parser.add_option('--requests', type='int', default=500000, help='synthetic requests (default: %default)')
+	parser.add_option('--zipf', type='float', default=0.9, help='Zipf exponent of the synthetic popularity (default: %default)')
+	parser.add_option('--scan', type='float', default=0.3, help='share of synthetic requests to files accessed only once (default: %default)')
+	parser.add_option('--sizes', default='4096:60,65536:30,524288:10', help='synthetic file size distribution as size:weight,... (default: %default)')
+	parser.add_option('--seed', type='int', default=1, help='random seed for the synthetic trace (default: %default)')
+	parser.add_option('--rate', type='float', default=200, help='synthetic requests per second (default: %default)')
+	parser.add_option('--ratios', default='0.01,0.05,0.1,0.25', help='cache sizes as fractions of the bytes of all distinct files (default: %default)')
+	parser.add_option('--max-file-size', type='int', default=1000000, help='CACHE_MAX_FILE_SIZE (default: %default)')
+	parser.add_option('--sketch-width', type='int', default=65536, help='CACHE_SKETCH_WIDTH (default: %default)')
+	parser.add_option('--min-ttl', type='float', default=config.MIN_CACHE_TTL, help='MIN_CACHE_TTL (default: %default)')
+	parser.add_option('--check-interval', type='float', default=config.FILE_CHECK_INTERVAL, help='FILE_CHECK_INTERVAL (default: %default)')
+	parser.add_option('--output', default=None, help='write the results as JSON to this file')
+	opts, args = parser.parse_args()
+	
+	if len(opts.log) > 0:
+		trace = loadLogs(opts.log)
+	else:
+		trace = makeTrace(opts.files, opts.requests, opts.zipf, opts.scan, parseSizes(opts.sizes), opts.seed, opts.rate)
+	
+	if len(trace) == 0:
+		print 'No requests to replay.'
+		sys.exit(1)
+	
+	# キャッシュ可能なファイル全体のサイズ
+	distinct = dict((x[1], x[2]) for x in trace)
+	footprint = sum(x for x in distinct.itervalues() if x <= opts.max_file_size)
+	
+	print '%d requests over %d sec, %d files, %d bytes cacheable' % (len(trace), trace[-1][0] - trace[0][0], len(distinct), footprint)
+	print '%-8s %12s %10s %10s %10s %10s %10s %10s' % ('policy', 'maxtotal', 'hit', 'byte hit', 'rejected', 'full', 'evicted', 'usec/req')
+	
+	results = []
+	
+	for ratio in [float(x) for x in opts.ratios.split(',')]:
+		for name in POLICIES:
+			x = replay(trace, name, int(footprint * ratio), opts.max_file_size, opts.sketch_width, opts.min_ttl, opts.check_interval)
+			x['ratio'] = ratio
+			results.append(x)
+			print '%-8s %12d %10.4f %10.4f %10d %10d %10d %10.2f' % (name, x['maxtotal'], x['hit_ratio'], x['byte_hit_ratio'], x['rejections'], x['cache_full'], x['evictions'], x['usec_per_request'])
+	
+	if opts.output:
+		fp = open(opts.output, 'w')
+		json.dump({'requests': len(trace), 'files': len(distinct), 'footprint': footprint, 'min_ttl': opts.min_ttl, 'check_interval': opts.check_interval, 'results': results}, fp, indent=1, sort_keys=True)
+		fp.close()
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+## tools.py のマイクロベンチマークと動作確認
+# リクエスト毎、再読み込み毎に実行される関数の動作を確認してから速度を計測し、
+# 保存したベースラインより閾値以上遅くなったものを報告します (どちらかで失敗すると終了コード 1)
+#
+# 例: python bench_tools.py --save bench_tools_baseline.json
+#     python bench_tools.py --baseline bench_tools_baseline.json --threshold 0.25
+
+import re
+import sys
+import math
+import json
+import time
+import random
+import timeit
+import datetime
+import fractions
+import optparse
+import platform
+import collections
+
+import tools
+
+# 計測するリダイレクト設定の数
+TABLE_SIZES = [10, 100, 1000]
+
+# 計測するパスの深さ
+PATH_DEPTHS = [1, 4, 8]
+
+# 計測、確認する weight の組み合わせ
+WEIGHT_VECTORS = [
+	[1, 1],
+	[2, 1],
+	[3, 5, 7],
+	[0.5, 0.25, 0.25],
+	[100, 10, 1],
+	[1] * 10,
+	[0.0001, 0.0001],
+	[100, 0.0001],
+	[0.3, 0.0002, 0.0001],
+	[1234, 5678],
+	[3, 1001],
+	[1001, 1000],
+	[2, 2.3],
+]
+
+# 分布の確認に使う有意水準の z 値 (片側 0.1%)
+Z_999 = 3.09
+
+## リダイレクト設定の作成
+# @param size リダイレクト設定の数
+# @param mode 選択方法 ('weighted' または 'hash')
+# @return config.REDIRECT_TABLE 形式のリスト
+def makeTable(size, mode = 'weighted'):
+	rules = []
+	
+	for i in xrange(size):
+		# ディレクトリで絞り込めるもの、拡張子のみのもの、途中にワイルドカードを含むものを混ぜる
+		if i % 10 == 9:
+			pattern = ['/*/x%04d/*.ogg' % i]
+		elif i % 10 == 8:
+			pattern = ['/**/*.e%04d' % i]
+		else:
+			pattern = ['/r%04d/**/*.wav' % i, '/r%04d/?.mp3' % i]
+		
+		rules.append({
+			'pattern': pattern,
+			'to': [
+				{'base_url': '', 'weight': 1},
+				{'base_url': 'http://m1.example.com/r%d/' % i, 'weight': 2},
+				{'base_url': 'http://m2.example.com/r%d/' % i, 'weight': 1},
+			],
+			'mode': mode,
+		})
+	
+	rules.append({'pattern': ['/**/*'], 'to': [{'base_url': 'http://fallback.example.com/', 'weight': 1}]})
+	
+	return rules
+
+## リクエストパスの作成
+# @param rnd random.Random
+# @param size リダイレクト設定の数
+# @param depth パスの深さ (ディレクトリ数)
+# @return パス
+def makePath(rnd, size, depth):
+	i = rnd.randrange(size)
+	dirs = ['d%d' % rnd.randrange(100) for n in xrange(depth - 1)]
+	kind = rnd.randrange(4)
+	
+	if kind == 0:
+		return '/' + '/'.join(['r%04d' % i] + dirs + ['f%d.wav' % rnd.randrange(1000)])
+	elif kind == 1:
+		return '/' + '/'.join(['a'] + ['x%04d' % i] + ['f%d.ogg' % rnd.randrange(1000)])
+	elif kind == 2:
+		return '/' + '/'.join(['r%04d' % i] + dirs + ['f%d.e%04d' % (rnd.randrange(1000), i)])
+	
+	return '/' + '/'.join(['u'] + dirs + ['f%d.txt' % rnd.randrange(1000)])
+
+## 一致するリダイレクト設定を先頭から順に検索する (findRedirect の比較用)
+# @param path リクエストパス
+# @param redirTable fixed config.REDIRECT_TABLE
+# @return 一致したリダイレクト設定 (見つからない場合は None)
+def findRedirectLinear(path, redirTable):
+	for redir in redirTable['rules']:
+		for ptn in redir['pattern']:
+			if ptn.match(path):
+				return redir
+	
+	return None
+
+## 動作確認クラス
+class Checker:
+	## コンストラクタ
+	# @param self
+	def __init__(self):
+		self.failures = []
+		self.count = 0
+	
+	## 確認
+	# @param self
+	# @param cond 条件
+	# @param msg 失敗時のメッセージ
+	def check(self, cond, msg):
+		self.count += 1
+		
+		if not cond:
+			self.failures.append(msg)
+	
+	## wc2re の確認
+	# @param self
+	def wc2re(self):
+		cases = [
+			('/a/*.wav', '/a/b.wav', True),
+			('/a/*.wav', '/a/b/c.wav', False),
+			('/a/**/*.wav', '/a/b.wav', True),
+			('/a/**/*.wav', '/a/b/c/d.wav', True),
+			('/a/**/*.wav', '/ab/c.wav', False),
+			('/a/?.wav', '/a/b.wav', True),
+			('/a/?.wav', '/a/bc.wav', False),
+			('/a/?.wav', '/a//.wav', False),
+			('/**/*.ogg', '/x/y.ogg', True),
+			('/**/*.ogg', '/y.ogg', True),
+			('/a.b/*', '/axb/c', False),
+			('/a+(b)/*', '/a+(b)/c', True),
+			('\\a\\**\\*', '\\a\\b\\c', True),
+		]
+		
+		for wc, path, expected in cases:
+			self.check(bool(re.match(tools.wc2re(wc), path)) == expected, 'wc2re(%r) on %r should be %r' % (wc, path, expected))
+	
+	## pathCheck の確認
+	# @param self
+	def pathCheck(self):
+		cases = [
+			('/a/b.wav', True),
+			('/a/../b.wav', False),
+			('/a/..\\b.wav', False),
+			('/a/..b.wav', True),
+			('/a/b..', True),
+		]
+		
+		for path, expected in cases:
+			self.check(tools.pathCheck(path) == expected, 'pathCheck(%r) should be %r' % (path, expected))
+	
+	## getApacheLogDatetime の確認 (前回の結果を使ったものと毎回変換したものを比較する)
+	# @param self
+	# @param rnd random.Random
+	def getApacheLogDatetime(self, rnd):
+		base = time.time()
+		stamps = [base + x * 0.25 for x in xrange(40)] + [base + rnd.uniform(-86400 * 400, 86400 * 400) for x in xrange(200)]
+		
+		for t in stamps:
+			expected = datetime.datetime.fromtimestamp(int(t), tools.NativeTZ()).strftime('%d/%b/%Y:%H:%M:%S %z')
+			actual = tools.getApacheLogDatetime(t)
+			self.check(actual == expected, 'getApacheLogDatetime(%r) = %r, expected %r' % (t, actual, expected))
+		
+		self.check(re.match(r'^\d\d/[A-Z][a-z]{2}/\d{4}:\d\d:\d\d:\d\d [+-]\d{4}$', tools.getApacheLogDatetime()) is not None, 'getApacheLogDatetime() format')
+	
+	## findRedirect の確認 (ディレクトリのツリーと記憶による検索が先頭からの検索と一致するか)
+	# @param self
+	# @param rnd random.Random
+	def findRedirect(self, rnd):
+		for size in TABLE_SIZES:
+			table = tools.fixRedirectTable(makeTable(size), memoSize=100)
+			paths = [makePath(rnd, size, rnd.choice(PATH_DEPTHS)) for x in xrange(2000)]
+			
+			# 記憶された結果も確認するため同じパスを繰り返す
+			for path in paths + paths[:200]:
+				actual = tools.findRedirect(path, table)
+				expected = findRedirectLinear(path, table)
+				self.check(actual is expected, 'findRedirect(%r) with %d rules picked %r, expected %r' % (path, size, actual and actual['wildcard'], expected and expected['wildcard']))
+	
+	## occuRatioSchedule と weighted 選択の確認
+	# 1周期の出現回数が weight の比に一致し、どの時点でも理想の回数からのずれが1未満であること
+	# @param self
+	def weighted(self):
+		for weights in WEIGHT_VECTORS:
+			seq = tools.occuRatioSchedule(weights)
+			ratio = tools.intRatio(weights)
+			total = float(sum(ratio))
+			counts = [0] * len(weights)
+			worst = 0.0
+			
+			for n, i in enumerate(seq):
+				counts[i] += 1
+				worst = max(worst, max(abs(counts[k] - (n + 1) * ratio[k] / total) for k in xrange(len(ratio))))
+			
+			self.check(counts == ratio, 'occuRatioSchedule(%r) counts %r, expected %r' % (weights, counts, ratio))
+			
+			# 設定された weight の比との比較 (整数で周期が上限以下なら一致し、それ以外も最大値の 1/1000 以内で 0 でないものは選択される)
+			shares = [fractions.Fraction(x) / fractions.Fraction(sum(weights)) for x in weights]
+			exact = all(x == int(x) for x in weights) and sum(weights) <= 10000
+			error = max(abs(fractions.Fraction(c, len(seq)) - x) for c, x in zip(counts, shares))
+			self.check(error == 0 if exact else error <= max(shares) / 1000 and all(c > 0 for c, x in zip(counts, weights) if x > 0), 'occuRatioSchedule(%r) counts %r differ from the weights by %.3g' % (weights, counts, error))
+			self.check(worst < 1.0, 'occuRatioSchedule(%r) deviates by %.3f' % (weights, worst))
+			
+			# selRedirectTo 経由でも (周期の途中から始めても) 同じ比率になること
+			table = tools.fixRedirectTable([{'pattern': ['/**/*'], 'to': [{'base_url': 'u%d' % i, 'weight': w} for i, w in enumerate(weights)]}])
+			tools.selRedirectTo('/a', table)
+			
+			picked = collections.Counter(tools.selRedirectTo('/a', table) for x in xrange(len(seq) * 3))
+			self.check([picked['u%d' % i] for i in xrange(len(weights))] == [x * 3 for x in ratio], 'selRedirectTo with weights %r picked %r' % (weights, dict(picked)))
+	
+	## hash 選択の確認
+	# パスごとの選択が固定で、多数のパスでの選択回数が weight の比に統計的に一致すること
+	# @param self
+	# @param rnd random.Random
+	def hashed(self, rnd):
+		for weights in WEIGHT_VECTORS:
+			table = tools.fixRedirectTable([{'pattern': ['/**/*'], 'to': [{'base_url': 'u%d' % i, 'weight': w} for i, w in enumerate(weights)], 'mode': 'hash'}])
+			paths = ['/d%d/f%d.wav' % (rnd.randrange(1000), n) for n in xrange(20000)]
+			picked = collections.Counter(tools.selRedirectTo(x, table) for x in paths)
+			
+			self.check(all(tools.selRedirectTo(x, table) == tools.selRedirectTo(x, table) for x in paths[:100]), 'hash selection with weights %r is not stable' % (weights,))
+			
+			# カイ二乗適合度検定 (Wilson-Hilferty 近似による棄却限界)
+			total = float(sum(weights))
+			chi2 = sum((picked['u%d' % i] - len(paths) * w / total) ** 2 / (len(paths) * w / total) for i, w in enumerate(weights))
+			k = len(weights) - 1
+			limit = k * (1 - 2.0 / (9 * k) + Z_999 * math.sqrt(2.0 / (9 * k))) ** 3
+			
+			self.check(chi2 < limit, 'hash selection with weights %r picked %r (chi2 %.2f >= %.2f)' % (weights, dict(picked), chi2, limit))
+	
+	## すべての確認
+	# @param self
+	# @param seed 乱数の種
+	def run(self, seed):
+		rnd = random.Random(seed)
+		
+		self.wc2re()
+		self.pathCheck()
+		self.getApacheLogDatetime(rnd)
+		self.findRedirect(rnd)
+		self.weighted()
+		self.hashed(rnd)
+
+## 計測
+# @param func 計測する関数
+# @param minTime 1回の計測の最小時間 (sec)
+# @param repeat 計測回数 (最小値をとる)
+# @return 1回あたりの時間 (usec)
+def measure(func, minTime, repeat):
+	timer = timeit.Timer(func)
+	
+	# minTime 程度かかる回数を決める
+	number = 1
+	elapsed = timer.timeit(number)
+	
+	while elapsed < minTime / 10:
+		number *= 10
+		elapsed = timer.timeit(number)
+	
+	number = max(1, int(number * minTime / elapsed))
+	
+	return min(timer.repeat(repeat, number)) / number * 1e6
+
+## 計測対象の列挙
+# @param seed 乱数の種
+# @return (名前, 関数) のリスト
+def cases(seed):
+	rnd = random.Random(seed)
+	ret = []
+	
+	# wc2re
+	for wc in ('/a/*.wav', '/r0001/**/*.wav', '/*/x0001/**/?.e0001'):
+		ret.append(('wc2re %s' % wc, lambda wc=wc: tools.wc2re(wc)))
+	
+	# pathCheck
+	for depth in PATH_DEPTHS:
+		path = makePath(rnd, 10, depth)
+		ret.append(('pathCheck depth=%d' % depth, lambda path=path: tools.pathCheck(path)))
+	
+	# fixRedirectTable
+	for size in TABLE_SIZES:
+		rules = makeTable(size)
+		ret.append(('fixRedirectTable rules=%d' % size, lambda rules=rules: tools.fixRedirectTable(rules)))
+	
+	# selRedirectTo (記憶済みのパスと、記憶していないパス)
+	for size in TABLE_SIZES:
+		for depth in PATH_DEPTHS:
+			paths = [makePath(rnd, size, depth) for x in xrange(1000)]
+			
+			table = tools.fixRedirectTable(makeTable(size))
+			for path in paths:
+				tools.selRedirectTo(path, table)
+			hit = cycler(paths)
+			ret.append(('selRedirectTo rules=%d depth=%d memo' % (size, depth), lambda table=table, hit=hit: tools.selRedirectTo(hit(), table)))
+			
+			table = tools.fixRedirectTable(makeTable(size), memoSize=0)
+			miss = cycler(paths)
+			ret.append(('selRedirectTo rules=%d depth=%d nomemo' % (size, depth), lambda table=table, miss=miss: tools.selRedirectTo(miss(), table)))
+	
+	# selRedirectTo (hash)
+	for weights in WEIGHT_VECTORS:
+		table = tools.fixRedirectTable([{'pattern': ['/**/*'], 'to': [{'base_url': 'u%d' % i, 'weight': w} for i, w in enumerate(weights)], 'mode': 'hash'}])
+		paths = cycler([makePath(rnd, 10, 4) for x in xrange(1000)])
+		ret.append(('selRedirectTo hash weights=%s' % ':'.join(str(x) for x in weights), lambda table=table, paths=paths: tools.selRedirectTo(paths(), table)))
+	
+	# occuRatioSchedule
+	for weights in WEIGHT_VECTORS:
+		ret.append(('occuRatioSchedule weights=%s' % ':'.join(str(x) for x in weights), lambda weights=weights: tools.occuRatioSchedule(weights)))
+	
+	# getApacheLogDatetime (同じ秒と、毎回異なる秒)
+	now = time.time()
+	ret.append(('getApacheLogDatetime same second', lambda: tools.getApacheLogDatetime(now)))
+	stamps = cycler([now + x for x in xrange(100000)])
+	ret.append(('getApacheLogDatetime new second', lambda: tools.getApacheLogDatetime(stamps())))
+	
+	return ret
+
+## リストを繰り返し返す関数の作成
+# @param items リスト
+# @return 呼び出すたびに次の要素を返す関数
+def cycler(items):
+	state = [0]
+	
+	def step():
+		i = state[0]
+		state[0] = i + 1 if i + 1 < len(items) else 0
+		return items[i]
+	
+	return step
+
+## 基準となる処理の計測 (異なるマシンのベースラインと比較する場合は、計測結果をこれとの比にする)
+# @param minTime 1回の計測の最小時間 (sec)
+# @param repeat 計測回数
+# @return 1回あたりの時間 (usec)
+def calibrate(minTime, repeat):
+	data = [str(x) for x in xrange(100)]
+	return measure(lambda: ''.join(sorted(data, key=len)), minTime, repeat * 3)
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--seed', type='int', default=1, help='random seed (default: %default)')
+	parser.add_option('--min-time', type='float', default=0.2, help='minimum seconds per measurement (default: %default)')
+	parser.add_option('--repeat', type='int', default=5, help='measurements per case, the fastest is kept (default: %default)')
+	parser.add_option('--filter', default='', help='only run cases whose name contains this text')
+	parser.add_option('--baseline', default=None, help='compare against this baseline JSON file')
+	parser.add_option('--threshold', type='float', default=0.25, help='relative slowdown reported as a regression (default: %default)')
+	parser.add_option('--normalize', action='store_true', default=False, help='compare times relative to the calibration loop, for baselines taken on another machine')
+	parser.add_option('--save', default=None, help='write the results as a baseline JSON file')
+	parser.add_option('--check-only', action='store_true', default=False, help='run the correctness checks only')
+	opts, args = parser.parse_args()
+	
+	# 動作確認
+	checker = Checker()
+	checker.run(opts.seed)
+	
+	print '%d checks, %d failed' % (checker.count, len(checker.failures))
+	for msg in checker.failures[:50]:
+		print '  FAIL', msg
+	
+	if opts.check_only:
+		sys.exit(1 if checker.failures else 0)
+	
+	# 計測
+	baseline = None
+	if opts.baseline:
+		fp = open(opts.baseline)
+		baseline = json.load(fp)
+		fp.close()
+	
+	unit = calibrate(opts.min_time, opts.repeat)
+	results = {}
+	regressions = []
+	
+	print
+	print 'calibration %.3f usec' % unit
+	print '%-48s %12s %10s %10s' % ('case', 'usec/call', 'relative', 'change')
+	
+	for name, func in cases(opts.seed):
+		if opts.filter not in name:
+			continue
+		
+		usec = measure(func, opts.min_time, opts.repeat)
+		results[name] = {'usec': usec, 'relative': usec / unit}
+		change = ''
+		
+		if baseline is not None and name in baseline['results']:
+			key = 'relative' if opts.normalize else 'usec'
+			ratio = results[name][key] / baseline['results'][name][key] - 1
+			change = '%+.1f%%' % (ratio * 100)
+			
+			if ratio > opts.threshold:
+				change += ' !'
+				regressions.append((name, ratio))
+		
+		print '%-48s %12.3f %10.3f %10s' % (name, usec, usec / unit, change)
+	
+	if regressions:
+		print
+		print '%d regressions over %.0f%%' % (len(regressions), opts.threshold * 100)
+		for name, ratio in regressions:
+			print '  SLOW %s (%+.1f%%)' % (name, ratio * 100)
+	
+	if opts.save:
+		fp = open(opts.save, 'w')
+		json.dump({
+			'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+			'host': {'platform': platform.platform(), 'python': platform.python_version()},
+			'calibration_usec': unit,
+			'results': results,
+		}, fp, indent=1, sort_keys=True)
+		fp.close()
+	
+	sys.exit(1 if checker.failures or regressions else 0)
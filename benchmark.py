@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+## redirect_srv.py の負荷試験
+# 作業ディレクトリに合成したコンテンツと設定を作成してサーバを起動し、
+# キャッシュヒット、初回読み込み、更新チェック、リダイレクト、404 の各経路の性能を計測して JSON に保存します
+#
+# 例: python benchmark.py --files 2000 --sizes 4096:60,65536:30,524288:10 --concurrency 16 --output result.json
+#     python benchmark.py --source ../redirect_srv.old   # 別のソース (git worktree など) のサーバを計測
+
+import os
+import sys
+import json
+import time
+import glob
+import base64
+import random
+import shutil
+import socket
+import httplib
+import optparse
+import platform
+import subprocess
+import multiprocessing
+
+# このファイルのディレクトリ (サーバのソースをコピーする)
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 管理リクエストの認証情報
+ADMIN = ('bench', 'bench')
+
+## ファイルサイズ分布の解析
+# @param text 「サイズ:比率」のカンマ区切り
+# @return (サイズ, 比率) のリスト
+def parseSizes(text):
+	ret = []
+	
+	for item in text.split(','):
+		size, weight = item.split(':')
+		ret.append((int(size), float(weight)))
+	
+	return ret
+
+## ファイルの作成
+# @param fname ファイル名
+# @param size サイズ (byte)
+# @param block 書き込む内容 (繰り返す)
+def writeFile(fname, size, block):
+	if not os.path.isdir(os.path.dirname(fname)):
+		os.makedirs(os.path.dirname(fname))
+	
+	fp = open(fname, 'wb')
+	for offset in xrange(0, size, len(block)):
+		fp.write(block[:min(len(block), size - offset)])
+	fp.close()
+
+## 合成コンテンツの作成
+# @param root ROOT_DIR
+# @param nfiles ファイル数
+# @param sizes (サイズ, 比率) のリスト
+# @param seed 乱数の種
+# @return ROOT_DIR からの相対パスのリスト
+def makeContent(root, nfiles, sizes, seed):
+	rnd = random.Random(seed)
+	total = sum(x[1] for x in sizes)
+	block = os.urandom(65536)
+	paths = []
+	
+	for i in xrange(nfiles):
+		# 比率に応じてサイズを選ぶ
+		r = rnd.uniform(0, total)
+		for size, weight in sizes:
+			r -= weight
+			if r <= 0:
+				break
+		
+		path = 'self/d%03d/f%05d.bin' % (i % 100, i)
+		writeFile(os.path.join(root, path), size, block)
+		paths.append(path)
+	
+	return paths
+
+## 同時に初回読み込みさせる大きなファイルの作成
+# @param root ROOT_DIR
+# @param nfiles ファイル数
+# @param size サイズ (byte)
+# @return ROOT_DIR からの相対パスのリスト
+def makeBurstContent(root, nfiles, size):
+	block = os.urandom(65536)
+	paths = []
+	
+	for i in xrange(nfiles):
+		path = 'self/burst/b%03d.bin' % i
+		writeFile(os.path.join(root, path), size, block)
+		paths.append(path)
+	
+	return paths
+
+## 設定ファイルの作成 (リポジトリの config.py に上書き設定を追加する)
+# @param workdir 作業ディレクトリ
+# @param port ポート番号
+# @param overrides 上書きする設定の辞書
+# @param source サーバのソースのディレクトリ
+def writeConfig(workdir, port, overrides, source = SRC_DIR):
+	settings = {
+		'SERVER_PORT': port,
+		'ROOT_DIR': os.path.join(workdir, 'htdocs'),
+		'LOG_DIR': os.path.join(workdir, 'logs'),
+		'ADMIN_USERID': ADMIN[0],
+		'ADMIN_PASSWD': ADMIN[1],
+		'REDIRECT_TABLE': [
+			{'pattern': ['/self/**/*'], 'to': [{'base_url': '', 'weight': 1}]},
+			{'pattern': ['/mirror/**/*'], 'to': [{'base_url': 'http://mirror1.example.com/', 'weight': 2}, {'base_url': 'http://mirror2.example.com/', 'weight': 1}]},
+		],
+	}
+	settings.update(overrides)
+	
+	fp = open(os.path.join(workdir, 'config.py'), 'w')
+	fp.write(open(os.path.join(source, 'config.py')).read())
+	fp.write('\n## benchmark.py による上書き\n')
+	for key in sorted(settings):
+		fp.write('%s = %r\n' % (key, settings[key]))
+	fp.close()
+
+## 管理リクエスト
+# @param port ポート番号
+# @param path パス
+# @return レスポンスボディ
+def control(port, path):
+	conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+	conn.request('GET', path, headers={'Authorization': 'Basic ' + base64.b64encode('%s:%s' % ADMIN)})
+	body = conn.getresponse().read()
+	conn.close()
+	
+	return body
+
+## プロセスとその子プロセスの pid を列挙
+# @param pid プロセスID
+# @return pid のリスト
+def procTree(pid):
+	ret = [pid]
+	
+	for stat in glob.glob('/proc/[0-9]*/stat'):
+		try:
+			fields = open(stat).read().rsplit(')', 1)[1].split()
+			if int(fields[1]) == pid:
+				ret.append(int(stat.split('/')[2]))
+		except (IOError, IndexError, ValueError):
+			pass
+	
+	return ret
+
+## CPU 時間とメモリ使用量の取得 (Linux のみ)
+# @param pid サーバのプロセスID
+# @return (CPU 時間 (sec), RSS (KB))
+def procUsage(pid):
+	cpu = 0.0
+	rss = 0
+	
+	for p in procTree(pid):
+		try:
+			fields = open('/proc/%d/stat' % p).read().rsplit(')', 1)[1].split()
+			cpu += (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+			
+			for line in open('/proc/%d/status' % p):
+				if line.startswith('VmRSS:'):
+					rss += int(line.split()[1])
+		except (IOError, OSError):
+			pass
+	
+	return (cpu, rss)
+
+## 負荷をかけるプロセス
+# @param args (ポート番号, パスのリスト, リクエスト数, 終了時刻)
+# @return (応答時間のリスト, ステータスコード毎の件数, エラー数)
+def loadWorker(args):
+	port, paths, count, deadline = args
+	latencies = []
+	statuses = {}
+	errors = 0
+	conn = None
+	
+	for i in xrange(count):
+		if deadline is not None and time.time() >= deadline:
+			break
+		
+		path = paths[i % len(paths)]
+		start = time.time()
+		
+		try:
+			if conn is None:
+				conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+			
+			conn.request('GET', path)
+			res = conn.getresponse()
+			res.read()
+			
+			latencies.append(time.time() - start)
+			statuses[res.status] = statuses.get(res.status, 0) + 1
+			
+			if res.getheader('connection', '').lower() == 'close':
+				conn.close()
+				conn = None
+		except (socket.error, httplib.HTTPException):
+			errors += 1
+			conn = None
+	
+	return (latencies, statuses, errors)
+
+## パーセンタイル
+# @param values ソート済みのリスト
+# @param p 0-1
+# @return 値
+def percentile(values, p):
+	if len(values) == 0:
+		return None
+	
+	return values[min(len(values) - 1, int(len(values) * p))]
+
+## シナリオの実行
+# @param pool 負荷をかけるプロセスのプール
+# @param pid サーバのプロセスID
+# @param port ポート番号
+# @param paths リクエストするパスのリスト
+# @param requests リクエスト数
+# @param concurrency 同時接続数
+# @param duration 最大実行時間 (sec)
+# @param expect 期待するステータスコード
+# @return 結果の辞書
+def runScenario(pool, pid, port, paths, requests, concurrency, duration, expect):
+	# パスを接続毎に分ける
+	per = [paths[i::concurrency] or paths for i in xrange(concurrency)]
+	counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in xrange(concurrency)]
+	
+	cpu0, rss0 = procUsage(pid)
+	start = time.time()
+	results = pool.map(loadWorker, [(port, per[i], counts[i], start + duration) for i in xrange(concurrency)])
+	elapsed = time.time() - start
+	cpu1, rss1 = procUsage(pid)
+	
+	latencies = sorted(sum([x[0] for x in results], []))
+	statuses = {}
+	for x in results:
+		for status, n in x[1].iteritems():
+			statuses[str(status)] = statuses.get(str(status), 0) + n
+	
+	ms = lambda x: round(x * 1000, 3) if x is not None else None
+	
+	return {
+		'requests': len(latencies),
+		'errors': sum(x[2] for x in results),
+		'unexpected': sum(n for status, n in statuses.iteritems() if status != str(expect)),
+		'statuses': statuses,
+		'seconds': round(elapsed, 3),
+		'rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+		'latency_ms': {
+			'mean': ms(sum(latencies) / len(latencies)) if len(latencies) > 0 else None,
+			'p50': ms(percentile(latencies, 0.5)),
+			'p99': ms(percentile(latencies, 0.99)),
+			'p999': ms(percentile(latencies, 0.999)),
+			'max': ms(latencies[-1]) if len(latencies) > 0 else None,
+		},
+		'cpu_seconds': round(cpu1 - cpu0, 3),
+		'cpu_ms_per_request': round((cpu1 - cpu0) * 1000 / len(latencies), 4) if len(latencies) > 0 else None,
+		'rss_kb': rss1,
+	}
+
+## サーバの起動
+# @param workdir 作業ディレクトリ
+# @param port ポート番号
+# @param python Python インタプリタ
+# @return Popen
+def startServer(workdir, port, python):
+	proc = subprocess.Popen([python, 'redirect_srv.py'], cwd=workdir, stdout=open(os.path.join(workdir, 'server.out'), 'w'), stderr=subprocess.STDOUT)
+	
+	# 待ち受け開始まで待つ
+	for i in xrange(100):
+		if proc.poll() is not None:
+			raise RuntimeError('Server exited. (see %s)' % os.path.join(workdir, 'server.out'))
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+			return proc
+		except socket.error:
+			time.sleep(0.1)
+	
+	proc.kill()
+	raise RuntimeError('Server did not start.')
+
+## 負荷試験の実行
+# @param opts コマンドラインオプション
+# @return 結果の辞書
+def benchmark(opts):
+	workdir = os.path.abspath(opts.workdir)
+	
+	# 作業ディレクトリにサーバのソースとコンテンツを用意する
+	if os.path.isdir(workdir):
+		shutil.rmtree(workdir)
+	os.makedirs(os.path.join(workdir, 'logs'))
+	
+	for fname in glob.glob(os.path.join(opts.source, '*.py')):
+		if os.path.basename(fname) not in ('config.py', 'benchmark.py'):
+			shutil.copy(fname, workdir)
+	
+	sizes = parseSizes(opts.sizes)
+	paths = ['/' + x for x in makeContent(os.path.join(workdir, 'htdocs'), opts.files, sizes, opts.seed)]
+	burst = ['/' + x for x in makeBurstContent(os.path.join(workdir, 'htdocs'), opts.burst_files, opts.burst_size)]
+	overrides = dict(eval('{%s}' % opts.set)) if opts.set else {}
+	
+	# キャッシュに全ファイルが収まるようにする
+	overrides.setdefault('CACHE_MAX_TOTAL_SIZE', max(100000000, sum(os.path.getsize(os.path.join(workdir, 'htdocs', x.lstrip('/'))) for x in paths + burst) * 2))
+	overrides.setdefault('CACHE_MAX_FILE_SIZE', max([x[0] for x in sizes] + [opts.burst_size]))
+	overrides.setdefault('FILE_WATCH', False)
+	overrides.setdefault('FILE_CHECK_INTERVAL', 3600)
+	overrides.setdefault('MIN_CACHE_TTL', 3600)
+	overrides.setdefault('MAX_CACHE_TTL', 3600)
+	
+	writeConfig(workdir, opts.port, overrides, opts.source)
+	
+	proc = startServer(workdir, opts.port, opts.python)
+	pool = multiprocessing.Pool(opts.concurrency)
+	results = {}
+	
+	try:
+		run = lambda targets, requests, expect: runScenario(pool, proc.pid, opts.port, targets, requests, opts.concurrency, opts.duration, expect)
+		
+		# 初回読み込み (すべてのファイルを1回ずつ)
+		control(opts.port, '/!clear')
+		results['cold_miss'] = run(paths, len(paths), 200)
+		
+		# 同じファイルへの初回読み込みの集中 (すべての接続が同じ順に同時にリクエストし、読み込み完了を待つ)
+		control(opts.port, '/!clear')
+		results['cold_burst'] = run(sum([[x] * opts.concurrency for x in burst], []), len(burst) * opts.concurrency, 200)
+		
+		# キャッシュヒット
+		run(paths, len(paths), 200)
+		results['cache_hit'] = run(paths, opts.requests, 200)
+		
+		# 更新チェック (毎回ファイルを stat する、チェック中は古いデータを返す)
+		writeConfig(workdir, opts.port, dict(overrides, FILE_CHECK_INTERVAL=0, FILE_STALE_WHILE_REVALIDATE=True), opts.source)
+		control(opts.port, '/!reload')
+		results['revalidate'] = run(paths, opts.requests, 200)
+		writeConfig(workdir, opts.port, overrides, opts.source)
+		control(opts.port, '/!reload')
+		
+		# リダイレクト
+		results['redirect'] = run([x.replace('/self/', '/mirror/', 1) for x in paths], opts.requests, 302)
+		
+		# 存在しないファイル
+		results['not_found'] = run([x.replace('.bin', '.missing') for x in paths], opts.requests, 404)
+		
+		try:
+			stats = json.loads(control(opts.port, '/!stats'))
+		except ValueError:
+			stats = None
+	finally:
+		pool.terminate()
+		
+		try:
+			control(opts.port, '/!exit')
+			proc.wait()
+		except (socket.error, httplib.HTTPException):
+			proc.kill()
+	
+	return {
+		'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+		'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': multiprocessing.cpu_count()},
+		'params': {
+			'files': opts.files,
+			'sizes': opts.sizes,
+			'seed': opts.seed,
+			'burst_files': opts.burst_files,
+			'burst_size': opts.burst_size,
+			'source': opts.source,
+			'requests': opts.requests,
+			'concurrency': opts.concurrency,
+			'duration': opts.duration,
+			'overrides': dict((k, repr(v)) for k, v in overrides.iteritems()),
+		},
+		'results': results,
+		'server_stats': stats,
+	}
+
+## 結果の表示
+# @param result 結果の辞書
+def printResult(result):
+	print '%-12s %10s %10s %10s %10s %12s %10s %6s %10s' % ('scenario', 'req/s', 'p50 ms', 'p99 ms', 'p999 ms', 'cpu ms/req', 'rss KB', 'errors', 'unexpected')
+	
+	for name in ('cache_hit', 'cold_miss', 'cold_burst', 'revalidate', 'redirect', 'not_found'):
+		x = result['results'][name]
+		print '%-12s %10s %10s %10s %10s %12s %10s %6s %10s' % (name, x['rps'], x['latency_ms']['p50'], x['latency_ms']['p99'], x['latency_ms']['p999'], x['cpu_ms_per_request'], x['rss_kb'], x['errors'], x['unexpected'])
+
+if __name__ == "__main__":
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--files', type='int', default=1000, help='number of synthetic files (default: %default)')
+	parser.add_option('--sizes', default='4096:60,65536:30,524288:10', help='file size distribution as size:weight,... (default: %default)')
+	parser.add_option('--seed', type='int', default=1, help='random seed for the content tree (default: %default)')
+	parser.add_option('--burst-files', type='int', default=16, help='large files requested by every connection at once right after a cache clear (default: %default)')
+	parser.add_option('--burst-size', type='int', default=4194304, help='size of each burst file (default: %default)')
+	parser.add_option('--requests', type='int', default=20000, help='requests per scenario (default: %default)')
+	parser.add_option('--concurrency', type='int', default=8, help='concurrent keep-alive connections (default: %default)')
+	parser.add_option('--duration', type='float', default=60, help='maximum seconds per scenario (default: %default)')
+	parser.add_option('--port', type='int', default=18080, help='server port (default: %default)')
+	parser.add_option('--python', default=sys.executable, help='interpreter used to run the server (default: %default)')
+	parser.add_option('--source', default=SRC_DIR, help='directory of the server source to benchmark, e.g. a git worktree of an older commit (default: %default)')
+	parser.add_option('--set', default='', help="config overrides as python dict items, e.g. \"'SERVER_PROCESSES': 4\"")
+	parser.add_option('--workdir', default='bench_work', help='scratch directory, removed and recreated (default: %default)')
+	parser.add_option('--output', default=None, help='write the results as JSON to this file')
+	opts, args = parser.parse_args()
+	
+	result = benchmark(opts)
+	printResult(result)
+	
+	if opts.output:
+		fp = open(opts.output, 'w')
+		json.dump(result, fp, indent=1, sort_keys=True)
+		fp.close()
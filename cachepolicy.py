@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import heapq
+
+# カウンタの最大値 (4bit)
+COUNTER_MAX = 15
+
+# すべてのカウンタを半分にする変換表
+HALVE_TABLE = ''.join(chr(x >> 1) for x in xrange(256))
+
+## アクセス頻度の推定 (Count-Min Sketch)
+# 一定回数記録する毎にすべてのカウンタを半分にして、最近のアクセス頻度を優先する
+class FrequencySketch:
+	## コンストラクタ
+	# @param self
+	# @param width 1行あたりのカウンタ数 (2 の累乗に切り上げる)
+	# @param depth 行数
+	def __init__(self, width, depth = 4):
+		self.width = 1
+		while self.width < width:
+			self.width *= 2
+		
+		self.depth = depth
+		self.mask = self.width - 1
+		self.table = bytearray(self.width * depth)
+		self.additions = 0
+		self.sampleSize = self.width * 10
+	
+	## キーに対応するカウンタの位置
+	# @param self
+	# @param key キー
+	# @return 各行のカウンタの位置のリスト
+	def indexes(self, key):
+		h = hash(key) & 0xffffffff
+		step = (h >> 16) | 1
+		
+		return [i * self.width + ((h + i * step) & self.mask) for i in xrange(self.depth)]
+	
+	## アクセスの記録
+	# @param self
+	# @param key キー
+	def increment(self, key):
+		table = self.table
+		idx = self.indexes(key)
+		count = min([table[i] for i in idx])
+		
+		# 最小のカウンタだけを増やす (conservative update)
+		if count < COUNTER_MAX:
+			for i in idx:
+				if table[i] == count:
+					table[i] = count + 1
+		
+		self.additions += 1
+		
+		if self.additions >= self.sampleSize:
+			self.table = table.translate(HALVE_TABLE)
+			self.additions //= 2
+	
+	## アクセス頻度の推定値
+	# @param self
+	# @param key キー
+	# @return 推定値 (0-15)
+	def estimate(self, key):
+		table = self.table
+		return min([table[i] for i in self.indexes(key)])
+
+## 置き換えポリシー (LRU)
+# 新しいファイルは常に受け入れ、最終アクセス日時の古いものから削除する
+class LRUPolicy:
+	# 削除候補を最終アクセス日時の古い順に返すか否か
+	lruOrder = True
+	
+	## キャッシュ中のエントリの登録 (ポリシー変更時)
+	# @param self
+	# @param cache ファイル名をキーとしたキャッシュエントリの OrderedDict
+	def attach(self, cache):
+		pass
+	
+	## アクセスの記録
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte) (キャッシュされていない場合は None)
+	def record(self, fname, size):
+		pass
+	
+	## 読み込み完了の記録
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	def loaded(self, fname, size):
+		pass
+	
+	## 削除の記録
+	# @param self
+	# @param fname ファイル名
+	# @param evicted 容量確保のために削除したか否か
+	def remove(self, fname, evicted):
+		pass
+	
+	## キャッシュクリアの記録
+	# @param self
+	def clear(self):
+		pass
+	
+	## 削除候補の列挙
+	# @param self
+	# @param cache ファイル名をキーとしたキャッシュエントリの OrderedDict
+	# @return (ファイル名, キャッシュエントリ) を削除する順に列挙するイテレータ
+	def evictionOrder(self, cache):
+		return cache.iteritems()
+	
+	## 新しいファイルを受け入れるか否か
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	# @param victims 受け入れる場合に削除されるファイル名のリスト
+	# @return 受け入れるか否か
+	def admit(self, fname, size, victims):
+		return True
+
+## 置き換えポリシー (TinyLFU)
+# 削除は LRU と同じで、新しいファイルは削除されるすべてのファイルよりアクセス頻度が高い場合のみ受け入れる
+class TinyLFUPolicy(LRUPolicy):
+	## コンストラクタ
+	# @param self
+	# @param sketchWidth アクセス頻度を推定するカウンタの1行あたりの数
+	def __init__(self, sketchWidth):
+		self.sketch = FrequencySketch(sketchWidth)
+	
+	## アクセスの記録
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte) (キャッシュされていない場合は None)
+	def record(self, fname, size):
+		self.sketch.increment(fname)
+	
+	## 新しいファイルを受け入れるか否か
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	# @param victims 受け入れる場合に削除されるファイル名のリスト
+	# @return 受け入れるか否か
+	def admit(self, fname, size, victims):
+		freq = self.sketch.estimate(fname)
+		return all(freq > self.sketch.estimate(x) for x in victims)
+
+## 置き換えポリシー (GDSF)
+# アクセス頻度 / サイズ に削除済みのものの最大値を加えた優先度の低いものから削除し、
+# 新しいファイルは削除されるすべてのファイルより優先度が高い場合のみ受け入れる
+class GDSFPolicy(TinyLFUPolicy):
+	lruOrder = False
+	
+	## コンストラクタ
+	# @param self
+	# @param sketchWidth アクセス頻度を推定するカウンタの1行あたりの数
+	def __init__(self, sketchWidth):
+		TinyLFUPolicy.__init__(self, sketchWidth)
+		self.clear()
+	
+	## 優先度の計算
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	# @return 優先度
+	def score(self, fname, size):
+		return self.clock + float(self.sketch.estimate(fname)) / max(size, 1)
+	
+	## 優先度の更新
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	def update(self, fname, size):
+		priority = self.score(fname, size)
+		self.priority[fname] = priority
+		heapq.heappush(self.heap, (priority, fname))
+		
+		# 古い優先度が溜まったら作り直す
+		if len(self.heap) > len(self.priority) * 2 + 1024:
+			self.heap = [(priority, fname) for fname, priority in self.priority.iteritems()]
+			heapq.heapify(self.heap)
+	
+	## キャッシュ中のエントリの登録 (ポリシー変更時)
+	# @param self
+	# @param cache ファイル名をキーとしたキャッシュエントリの OrderedDict
+	def attach(self, cache):
+		for fname, entry in cache.iteritems():
+			if entry['data'] is not None:
+				self.update(fname, len(entry['data']))
+	
+	## アクセスの記録
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte) (キャッシュされていない場合は None)
+	def record(self, fname, size):
+		self.sketch.increment(fname)
+		
+		if size is not None:
+			self.update(fname, size)
+	
+	## 読み込み完了の記録
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	def loaded(self, fname, size):
+		self.update(fname, size)
+	
+	## 削除の記録
+	# @param self
+	# @param fname ファイル名
+	# @param evicted 容量確保のために削除したか否か
+	def remove(self, fname, evicted):
+		priority = self.priority.pop(fname, None)
+		
+		# 削除したものの優先度を以降の基準にする (古いファイルがいつまでも残らないように)
+		if evicted and priority is not None:
+			self.clock = max(self.clock, priority)
+	
+	## キャッシュクリアの記録
+	# @param self
+	def clear(self):
+		self.clock = 0.0
+		self.priority = {}
+		self.heap = []
+	
+	## 削除候補の列挙
+	# @param self
+	# @param cache ファイル名をキーとしたキャッシュエントリの OrderedDict
+	# @return (ファイル名, キャッシュエントリ) を削除する順に列挙するイテレータ
+	def evictionOrder(self, cache):
+		heap = self.heap
+		
+		# 先頭に溜まった更新前の優先度や削除済みのものを捨てる (削除されるものは優先度が低いので先頭に集まる)
+		while len(heap) > 0 and self.priority.get(heap[0][1]) != heap[0][0]:
+			heapq.heappop(heap)
+		
+		# ヒープをコピーせず、親より子が後になる順に位置をたどる (列挙した数に比例する時間で済む)
+		# 列挙中はロックによりヒープは変更されない
+		frontier = [(heap[0], 0)] if len(heap) > 0 else []
+		seen = set()
+		
+		while len(frontier) > 0:
+			(priority, fname), i = heapq.heappop(frontier)
+			
+			for child in (i * 2 + 1, i * 2 + 2):
+				if child < len(heap):
+					heapq.heappush(frontier, (heap[child], child))
+			
+			# 更新前の優先度や削除済みのものは除く
+			if fname in seen or self.priority.get(fname) != priority or fname not in cache:
+				continue
+			
+			seen.add(fname)
+			yield (fname, cache[fname])
+	
+	## 新しいファイルを受け入れるか否か
+	# @param self
+	# @param fname ファイル名
+	# @param size サイズ (byte)
+	# @param victims 受け入れる場合に削除されるファイル名のリスト
+	# @return 受け入れるか否か
+	def admit(self, fname, size, victims):
+		priority = self.score(fname, size)
+		return all(priority > self.priority.get(x, 0.0) for x in victims)
+
+## 置き換えポリシーの作成
+# @param name ポリシー名 ('lru', 'tinylfu' または 'gdsf')
+# @param sketchWidth アクセス頻度を推定するカウンタの1行あたりの数
+# @return 置き換えポリシー
+def create(name, sketchWidth = 65536):
+	if name == 'tinylfu':
+		return TinyLFUPolicy(sketchWidth)
+	elif name == 'gdsf':
+		return GDSFPolicy(sketchWidth)
+	
+	return LRUPolicy()
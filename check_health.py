@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+## health.py の動作確認
+# ローカルに起動した HTTP サーバをリダイレクト先として、停止判定の回数 (HEALTH_CHECK_FALL)、復帰、
+# 応答時間による weight の調整比率、監視スレッドからの通知、リダイレクト先の選択への反映を確認します (失敗すると終了コード 1)
+#
+# 例: python check_health.py
+
+import sys
+import time
+import socket
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import tools
+import health
+from bench_tools import Checker
+
+## リダイレクト先の代わりのリクエストハンドラ
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	## HEAD
+	# @param self
+	def do_HEAD(self):
+		stub = self.server
+		stub.paths.append(self.path)
+		
+		if stub.delay > 0:
+			time.sleep(stub.delay)
+		
+		self.send_response(stub.status)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+	
+	## アクセスログを出力しない
+	# @param self
+	def log_message(self, *args):
+		pass
+
+## リダイレクト先の代わりの HTTP サーバ
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	
+	## コンストラクタ
+	# @param self
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+		self.status = 200
+		self.delay = 0.0
+		self.paths = []
+		self.url = 'http://127.0.0.1:%d/mirror/' % self.server_address[1]
+		
+		th = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+		th.daemon = True
+		th.start()
+	
+	## リクエスト処理中のエラーを出力しない (タイムアウトの確認で監視側が先に切断する)
+	# @param self
+	# @param request ソケット
+	# @param client_address クライアントのアドレス
+	def handle_error(self, request, client_address):
+		pass
+	
+	## 停止 (以降は接続できない)
+	# @param self
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+## 接続できないポートの URL
+# @return base_url
+def closedUrl():
+	sock = socket.socket()
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	
+	return 'http://127.0.0.1:%d/' % port
+
+## 動作確認クラス
+class HealthCheckerChecker(Checker):
+	## 監視対象の作成
+	# @param self
+	# @param urls base_url のリスト
+	# @param fall 連続して何回失敗したら停止中とみなすか
+	# @param latency 応答時間に応じて weight を調整するか否か
+	# @return HealthChecker
+	def makeChecker(self, urls, fall = 2, latency = False):
+		hchecker = health.HealthChecker(interval=1, timeout=0.5, path='/ping', fall=fall, latency=latency, onUpdate=lambda: None)
+		hchecker.setTargets(urls)
+		return hchecker
+	
+	## 停止判定の回数と復帰の確認
+	# @param self
+	def fall(self):
+		stub = StubServer()
+		url = stub.url
+		hchecker = self.makeChecker([url], fall=3)
+		
+		hchecker.probe(url)
+		status = hchecker.getStatus()[url]
+		self.check(status['healthy'] and status['fails'] == 0 and status['error'] == '', 'fall: healthy stub %r' % status)
+		self.check(stub.paths == ['/mirror/ping'], 'fall: requested path %r' % stub.paths)
+		
+		# サーバエラーが fall 回続くまでは稼働中
+		stub.status = 503
+		
+		for i in xrange(1, 3):
+			hchecker.probe(url)
+			status = hchecker.getStatus()[url]
+			self.check(status['healthy'] and status['fails'] == i and status['error'] == 'HTTP 503', 'fall: %d failure(s) %r' % (i, status))
+			self.check(hchecker.factors() == {url: 1.0}, 'fall: %d failure(s) factors %r' % (i, hchecker.factors()))
+		
+		hchecker.probe(url)
+		status = hchecker.getStatus()[url]
+		self.check(not status['healthy'] and status['fails'] == 3, 'fall: 3 failures %r' % status)
+		self.check(hchecker.factors() == {url: 0.0}, 'fall: 3 failures factors %r' % hchecker.factors())
+		
+		# 1回成功すれば復帰する
+		stub.status = 200
+		hchecker.probe(url)
+		status = hchecker.getStatus()[url]
+		self.check(status['healthy'] and status['fails'] == 0 and status['error'] == '', 'fall: recovered %r' % status)
+		self.check(hchecker.factors() == {url: 1.0}, 'fall: recovered factors %r' % hchecker.factors())
+		
+		# 途中で成功すると数え直す
+		stub.status = 500
+		hchecker.probe(url)
+		hchecker.probe(url)
+		stub.status = 200
+		hchecker.probe(url)
+		stub.status = 500
+		hchecker.probe(url)
+		status = hchecker.getStatus()[url]
+		self.check(status['healthy'] and status['fails'] == 1, 'fall: reset by success %r' % status)
+		
+		# サーバエラー以外 (404 など) は稼働中
+		stub.status = 404
+		hchecker.probe(url)
+		self.check(hchecker.getStatus()[url]['fails'] == 0, 'fall: 404 is healthy %r' % hchecker.getStatus()[url])
+		
+		# 接続できない、タイムアウト
+		stub.delay = 1.0
+		hchecker.probe(url)
+		status = hchecker.getStatus()[url]
+		self.check(status['fails'] == 1 and status['error'] != '', 'fall: timeout %r' % status)
+		
+		stub.stop()
+		hchecker.probe(url)
+		hchecker.probe(url)
+		status = hchecker.getStatus()[url]
+		self.check(not status['healthy'] and status['fails'] == 3, 'fall: refused %r' % status)
+		
+		closed = closedUrl()
+		hchecker = self.makeChecker([closed], fall=1)
+		hchecker.probe(closed)
+		self.check(hchecker.factors() == {closed: 0.0}, 'fall: closed port factors %r' % hchecker.factors())
+		
+		# 監視対象から外れたものは記録しない
+		hchecker.setTargets([])
+		hchecker.probe(closed)
+		self.check(hchecker.getStatus() == {}, 'fall: removed target %r' % hchecker.getStatus())
+	
+	## 応答時間による調整比率の確認
+	# @param self
+	def latency(self):
+		fast = StubServer()
+		slow = StubServer()
+		slow.delay = 0.04
+		down = StubServer()
+		down.status = 503
+		urls = [fast.url, slow.url, down.url]
+		
+		hchecker = self.makeChecker(urls, fall=1, latency=True)
+		
+		# 確認前は応答時間が無いので調整しない
+		self.check(hchecker.factors() == dict((x, 1.0) for x in urls), 'latency: unchecked factors %r' % hchecker.factors())
+		
+		for i in xrange(3):
+			for url in urls:
+				hchecker.probe(url)
+		
+		factors = hchecker.factors()
+		status = hchecker.getStatus()
+		
+		# 最も速いものが 1.0 で、遅いものは 10ms / 40ms 程度 (0.25 刻み)、停止中のものは 0
+		self.check(factors[fast.url] == 1.0, 'latency: fast %r %r' % (factors, status))
+		self.check(factors[slow.url] in (0.25, 0.5), 'latency: slow %r %r' % (factors, status))
+		self.check(factors[down.url] == 0.0, 'latency: down %r %r' % (factors, status))
+		self.check(status[slow.url]['latency'] >= 0.04, 'latency: slow average %r' % status)
+		
+		# 停止中のものの応答時間は基準にしない
+		fast.status = 503
+		hchecker.probe(fast.url)
+		factors = hchecker.factors()
+		self.check(factors[fast.url] == 0.0 and factors[slow.url] == 1.0, 'latency: fastest down %r' % factors)
+		
+		# 調整しない場合
+		hchecker.settings(latency=False)
+		factors = hchecker.factors()
+		self.check(factors == {fast.url: 0.0, slow.url: 1.0, down.url: 0.0}, 'latency: disabled %r' % factors)
+		
+		# 監視しない場合は調整しない
+		hchecker.settings(interval=0)
+		self.check(hchecker.factors() == {}, 'latency: interval 0 %r' % hchecker.factors())
+		
+		for stub in (fast, slow, down):
+			stub.stop()
+	
+	## 監視スレッドの通知とリダイレクト先の選択の確認
+	# @param self
+	def thread(self):
+		up = StubServer()
+		down = StubServer()
+		table = tools.fixRedirectTable([{'pattern': ['/**/*'], 'to': [{'base_url': up.url, 'weight': 1}, {'base_url': down.url, 'weight': 1}]}])
+		updates = []
+		
+		hchecker = health.HealthChecker(interval=0.2, timeout=0.5, path='', fall=2, latency=False, onUpdate=lambda: updates.append(hchecker.factors()))
+		hchecker.setTargets(tools.listRedirectUrls(table))
+		hchecker.initialize()
+		
+		try:
+			# 停止中になったら通知され、選択されなくなる
+			down.status = 502
+			deadline = time.time() + 5
+			while len(updates) == 0 and time.time() < deadline:
+				time.sleep(0.05)
+			
+			self.check(updates == [{up.url: 1.0, down.url: 0.0}], 'thread: update on failure %r' % updates)
+			self.check(down.paths[:1] == ['/mirror/'], 'thread: requested path %r' % down.paths)
+			
+			tools.applyRedirectFactors(table, hchecker.factors())
+			selected = set(tools.selRedirectTo('/a/b.bin', table) for i in xrange(10))
+			self.check(selected == set([up.url]), 'thread: selected while down %r' % selected)
+			
+			# 復帰したら通知され、再び選択される
+			down.status = 200
+			deadline = time.time() + 5
+			while len(updates) == 1 and time.time() < deadline:
+				time.sleep(0.05)
+			
+			self.check(updates[1:] == [{up.url: 1.0, down.url: 1.0}], 'thread: update on recovery %r' % updates)
+			
+			tools.applyRedirectFactors(table, hchecker.factors())
+			selected = set(tools.selRedirectTo('/a/b.bin', table) for i in xrange(10))
+			self.check(selected == set([up.url, down.url]), 'thread: selected after recovery %r' % selected)
+		finally:
+			hchecker.finalize()
+			up.stop()
+			down.stop()
+		
+		self.check(not hchecker.thCheck.isAlive(), 'thread: finalize')
+	
+	## すべての確認
+	# @param self
+	def run(self):
+		self.fall()
+		self.latency()
+		self.thread()
+
+if __name__ == "__main__":
+	checker = HealthCheckerChecker()
+	checker.run()
+	
+	print '%d checks, %d failed' % (checker.count, len(checker.failures))
+	for msg in checker.failures[:50]:
+		print '  FAIL', msg
+	
+	sys.exit(1 if checker.failures else 0)
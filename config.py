@@ -3,9 +3,31 @@
 ## サーバポート番号
 SERVER_PORT = 8080
 
+## ワーカープロセス数 (1 の場合はマルチプロセス化しない、0 の場合は CPU コア数)
+# ワーカープロセスは待ち受けソケットを共有し、異常終了した場合は再起動されます
+# 管理リクエストはすべてのワーカープロセスに伝えられます
+# ファイルキャッシュはワーカープロセスごとに持つため、メモリ使用量はプロセス数倍になります
+# 変更はサーバの再起動後に反映されます
+SERVER_PROCESSES = 1
+
+## ファイル更新監視 (Linux のみ)
+# True の場合、inotify で ROOT_DIR 配下を監視し、更新されたファイルのキャッシュを直ちに読み込み直します
+# 監視中は FILE_CHECK_INTERVAL による定期的な更新チェックは行われません
+# inotify が使用できない場合や、監視が停止した場合は FILE_CHECK_INTERVAL による定期チェックに戻ります
+# ディレクトリへのシンボリックリンクはたどって監視しますが、同じディレクトリに複数のパスからたどり着く場合や、
+# ファイルへのシンボリックリンクがある場合は、すべての更新を通知できないため定期チェックを続けます
+# inotify は NFS などのネットワークファイルシステムで他のホストから行われた更新を通知しないため、
+# ROOT_DIR がネットワークファイルシステム上にある場合は False にしてください
+FILE_WATCH = False
+
 ## ファイルチェック間隔 (sec)
 FILE_CHECK_INTERVAL = 60
 
+## ファイルチェック中は古いキャッシュを返す
+# True の場合、ファイルの更新チェックはバックグラウンドで行われ、その間は古いデータが送信されます
+# False の場合、チェックが完了するまでリクエストは待たされます
+FILE_STALE_WHILE_REVALIDATE = True
+
 ## 最小キャッシュ生存時間 (sec)
 MIN_CACHE_TTL = 60
 
@@ -18,6 +40,89 @@ CACHE_MAX_FILE_SIZE = 1000000
 ## 最大総キャッシュサイズ (byte)
 CACHE_MAX_TOTAL_SIZE = 100000000
 
+## キャッシュデータの保持方法
+# 'heap' : ファイルの内容をメモリ上に読み込んで保持します
+# 'mmap' : ファイルを読み込み専用でメモリマップし、OS のページキャッシュと共有します
+#          キャッシュされたファイル毎にファイルディスクリプタを1つ使用します
+#          ファイルディスクリプタ数の上限 (ulimit -n) の半分を超える分は 'heap' と同じくメモリ上に読み込みます
+#          送信中のファイルを直接切り詰めると異常終了する恐れがあるため、ファイルの更新は別名で作成してから置き換えてください
+# 'shm'  : ファイルの内容を CACHE_SHM_PATH の共有メモリに保持し、同じホストのすべてのサーバプロセスで共有します
+#          あるプロセスが読み込んだファイルは他のプロセスでもキャッシュヒットとなり、
+#          CACHE_MAX_TOTAL_SIZE はホスト全体での上限になります (古いデータから上書きされます)
+CACHE_STORAGE = 'heap'
+
+## 共有メモリのファイル名 (CACHE_STORAGE が 'shm' の場合)
+# 共有メモリのサイズは作成時の CACHE_MAX_TOTAL_SIZE で決まります
+# サイズを変更する場合は、すべてのサーバプロセスを停止してからこのファイルを削除してください
+# サーバを実行するユーザが所有し、他のユーザに読み書きの権限がないファイルのみ使用できます (シンボリックリンクは使用できません)
+CACHE_SHM_PATH = '/dev/shm/redirect_srv.cache'
+
+## アクセス頻度の高いファイルを保存するファイル名 ('' の場合は保存しない)
+# 終了時にキャッシュ中のファイルをアクセス回数の多い順に保存します
+# 複数のサーバプロセスで同じファイル名を指定した場合は、最後に終了したプロセスのものが残ります
+CACHE_SNAPSHOT_PATH = ''
+
+## 保存するファイルの最大数
+CACHE_SNAPSHOT_ENTRIES = 10000
+
+## キャッシュの先読み
+# True の場合、起動時に CACHE_SNAPSHOT_PATH に保存したファイルをアクセス頻度の高い順に読み込みます
+# キャッシュクリア時もクリア前にアクセス頻度の高かったファイルを読み込み直します
+# 先読みはリクエストによる読み込みを優先し、CACHE_MAX_TOTAL_SIZE に達した時点で終了します
+CACHE_WARMUP = False
+
+## キャッシュの置き換えポリシー
+# 'lru'     : 新しいファイルは常にキャッシュし、最終アクセス日時の古いものから削除します
+# 'tinylfu' : 削除は 'lru' と同じですが、新しいファイルはアクセス頻度が削除されるすべてのファイルより高い場合のみキャッシュします
+#             一度しかアクセスされないファイルが大量に要求されても、よくアクセスされるファイルが追い出されにくくなります
+# 'gdsf'    : アクセス頻度 / ファイルサイズ の小さいものから削除し、新しいファイルもこの値で判定します
+#             小さなファイルが優先され、キャッシュヒットするリクエスト数が多くなります (ヒットするバイト数は少なくなります)
+# キャッシュされなかったファイルはリダイレクトされ、アクセス頻度が上がれば1秒後以降のリクエストで再度判定されます
+# アクセス頻度は最近のものほど重視され、ファイル名毎ではなく CACHE_SKETCH_WIDTH × 4 個のカウンタで推定されます
+CACHE_POLICY = 'lru'
+
+## アクセス頻度を推定するカウンタの1行あたりの数 (2 の累乗に切り上げられます)
+# キャッシュされるファイル数の数倍を目安にしてください (1 カウンタあたり 1 byte 使用します)
+CACHE_SKETCH_WIDTH = 65536
+
+## gzip 圧縮データのキャッシュ
+# True の場合、キャッシュするファイル毎に gzip 圧縮したデータも保持し、
+# Accept-Encoding: gzip を送信したクライアントには圧縮データを送信します
+# 元のファイルより新しい同名の .gz ファイルが ROOT_DIR 配下にある場合は、圧縮せずにそれを使用します
+# 圧縮データのサイズも CACHE_MAX_TOTAL_SIZE に含まれます
+CACHE_GZIP = False
+
+## gzip 圧縮レベル (1-9)
+CACHE_GZIP_LEVEL = 6
+
+## 圧縮データを保持する最大の圧縮率
+# 圧縮後のサイズが元のサイズのこの割合を超える (圧縮の効果が小さい) 場合は圧縮データを保持しません
+CACHE_GZIP_MIN_RATIO = 0.9
+
+## 分割送信の最大同時接続数
+# CACHE_MAX_FILE_SIZE を超えるファイルはキャッシュせずに、このサーバから分割して送信されます
+# 同時接続数がこの値に達している場合は、従来通り他のサーバにリダイレクトされます (0 の場合は常にリダイレクト)
+STREAM_MAX_CONNECTIONS = 50
+
+## 分割送信のバッファサイズ (byte)
+# 1接続あたりのメモリ使用量はおよそこのサイズに抑えられます
+STREAM_BUFFER_SIZE = 65536
+
+## 分割送信に sendfile を使用する (Linux のみ)
+# ファイルの内容をメモリにコピーせず、カーネル内で直接ソケットへ送信します
+# sendfile が使用できない環境では通常の分割送信が行われます
+# ※ sendfile はリクエスト処理のスレッドで実行されるため、ページキャッシュに無いファイルはディスクの読み込みを待ちます
+#   ディスクが遅い場合は False (読み込みスレッドによる分割送信) を推奨します
+SENDFILE_ENABLE = False
+
+## 分割送信のファイル読み込みスレッド数
+# 分割送信するファイルを開く処理と読み込みは、リクエスト処理を止めないようこのスレッドで行われます
+STREAM_READ_THREADS = 2
+
+## ファイル読み込みスレッド数
+# 異なるファイルは並列に読み込まれます (同じファイルの読み込みは常に1つだけです)
+CACHE_READ_THREADS = 4
+
 ## ルートディレクトリ
 ROOT_DIR = r'htdocs'
 
@@ -27,12 +132,56 @@ LOG_DIR = r'logs'
 ## アクセスログファイル名形式
 ACCESS_LOG_FILENAME_FORMAT = 'access_log_%Y%m%d.log'
 
+## アクセスログの書き込み待ちの最大行数 (0 の場合は無制限)
+ACCESS_LOG_QUEUE_SIZE = 100000
+
+## アクセスログの書き込み待ちが最大行数に達した場合の動作
+# 'block'    : 書き込まれるまでリクエストの処理を待たせます (ログは失われません)
+# 'drop_old' : 最も古い行を捨てます
+# 'drop_new' : 新しい行を捨てます
+# 捨てた行数は /!stats で確認できます
+# ログの欠落が許されない場合 (課金や監査に使う場合など) は 'block' のままにしてください
+# ディスクが遅くリクエストの処理を待たせたくない場合は 'drop_old' または 'drop_new' を指定します
+ACCESS_LOG_QUEUE_POLICY = 'block'
+
+## アクセスログを書き出す間隔 (sec)
+ACCESS_LOG_FLUSH_INTERVAL = 1
+
+## アクセスログを fsync する間隔 (sec) (0 の場合は OS に任せる)
+ACCESS_LOG_FSYNC_INTERVAL = 0
+
+## 設定ファイルの更新チェック間隔 (sec) (0 の場合はチェックしない)
+# config.py の更新日時が変わると自動的に再読み込みします
+# 再読み込みは /!reload や SIGHUP でも行えます
+CONFIG_CHECK_INTERVAL = 0
+
 ## 管理者ID
 ADMIN_USERID = 'admin'
 
 ## 管理者パスワード
 ADMIN_PASSWD = 'changeme'
 
+## リダイレクト設定の検索結果を記憶するパスの最大数
+ROUTE_CACHE_SIZE = 10000
+
+## リダイレクト先の死活監視間隔 (sec) (0 の場合は監視しない)
+# 停止中のリダイレクト先は復旧するまで選択されなくなります
+# 状態は /!health で確認できます
+HEALTH_CHECK_INTERVAL = 0
+
+## 死活監視のタイムアウト (sec)
+HEALTH_CHECK_TIMEOUT = 3
+
+## 死活監視で HEAD リクエストするパス (base_url からの相対パス)
+HEALTH_CHECK_PATH = ''
+
+## 何回連続して失敗したら停止中とみなすか
+HEALTH_CHECK_FALL = 2
+
+## 応答時間に応じてリダイレクト先の weight を調整する
+# 最も速いリダイレクト先との応答時間の比を 0.25 刻みで weight に掛けます
+HEALTH_LATENCY_WEIGHTING = False
+
 ## リダイレクト設定
 # 上から順にパターンマッチが行われ、weight の比率でリダイレクト先が決定されます
 #
@@ -46,7 +195,7 @@ ADMIN_PASSWD = 'changeme'
 # base_url について：
 #   空文字列の base_url はこのサーバ自身を表します
 #   ファイルを ROOT_DIR ディレクトリ配下から読み込み、このサーバから送信されます
-#   CACHE_MAX_FILE_SIZEを超えるなどキャッシュ不可能な場合は他のサーバにリダイレクトされます
+#   CACHE_MAX_TOTAL_SIZE の超過や、大きなファイルの同時送信数が STREAM_MAX_CONNECTIONS に達した場合など、このサーバから送信できない場合は他のサーバにリダイレクトされます
 #   この場合、サーバ自身の weight を除いた比率でリダイレクト先が決定されます
 #
 # pattern について：
@@ -55,6 +204,24 @@ ADMIN_PASSWD = 'changeme'
 #   「**/」：ワイルドカード「*/」の0回以上の繰り返しを意味し、 ディレクトリを再帰的にたどってマッチを行います
 #            例えば, foo/**/bar は foo/bar, foo/*/bar, foo/*/*/bar ... (以下無限に続く)に対してそれぞれ マッチ判定を行います
 #
+# mode について：
+#   リダイレクト先の選択方法を指定します (省略可)
+#   'weighted' : weight の比率で順番にリダイレクト先が決定されます (省略時)
+#   'hash'     : パスのハッシュ値と weight によってリダイレクト先が決定され、同じファイルは常に同じリダイレクト先になります
+#                リダイレクト先を追加・削除しても、リダイレクト先が変わるファイルはおよそ 1/リダイレクト先の数 に抑えられます
+#   例：'mode': 'hash'
+#
+# preload について：
+#   True の場合、起動時と設定の再読み込み時に pattern に一致するファイルをキャッシュに先読みします (省略可)
+#   このサーバ (base_url が '') を含む設定のみ有効で、CACHE_MAX_TOTAL_SIZE に達した時点で終了します
+#   例：'preload': True
+#
+# cache_control について：
+#   このサーバから送信するファイルの Cache-Control ヘッダを指定します (省略可)
+#   省略した場合はクライアントに毎回再検証させます
+#   いずれの場合も ETag と Last-Modified が送信され、ファイルが更新されていなければ 304 が返されます
+#   例：'cache_control': 'public, max-age=3600'
+#
 # 例：
 #REDIRECT_TABLE = [
 #	{
@@ -15,9 +15,18 @@
 # under the License.
 
 import os
+import mmap
+import gzip
+import json
 import time
+import errno
+import resource
 import threading
 import Queue
+import collections
+import cStringIO
+import shmcache
+import cachepolicy
 
 ## 問い合わせ中例外
 class Queried(Exception):
@@ -28,6 +37,62 @@ class Error(Exception):
 	def __init__(self, msg):
 		self.msg = msg
 
+## ファイルサイズ超過例外
+class TooLarge(Error):
+	pass
+
+# 置き換えポリシーに受け入れられなかったファイルを再度判定するまでの時間 (sec)
+REJECT_RETRY = 1
+
+# ファイルが存在しないとみなすエラー (これ以外の読み込みエラーはファイルの有無を判断しない)
+MISSING_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EISDIR, errno.EACCES, errno.ELOOP, errno.ENAMETOOLONG)
+
+# mmap に使用するファイルディスクリプタの上限 (ulimit -n に対する割合)
+MMAP_FD_SHARE = 0.5
+
+## キャッシュデータのサイズ
+# @param data ファイルデータ
+# @return サイズ (byte) (共有メモリ上のデータはプロセスのメモリを使用しないので 0)
+def dataSize(data):
+	if data is None or isinstance(data, shmcache.SharedData):
+		return 0
+	
+	return len(data)
+
+## キャッシュエントリのサイズ
+# @param entry キャッシュエントリ
+# @return 圧縮データを含むサイズ (byte)
+def entrySize(entry):
+	return dataSize(entry['data']) + dataSize(entry['gzdata'])
+
+## キャッシュエントリが保持する mmap の数
+# @param entry キャッシュエントリ
+# @return mmap の数 (mmap はそれぞれファイルディスクリプタを1つ使用する)
+def entryMaps(entry):
+	return isinstance(entry['data'], mmap.mmap) + isinstance(entry['gzdata'], mmap.mmap)
+
+## mmap に使用できるファイルディスクリプタ数
+# @return ファイルディスクリプタ数 (ソケットやログファイルの分を残す)
+def mmapBudget():
+	soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+	
+	if soft == resource.RLIM_INFINITY:
+		soft = 65536
+	
+	return int(soft * MMAP_FD_SHARE)
+
+## キャッシュエントリの作成
+# @return キャッシュエントリ
+def newEntry():
+	return {'ctime': 0, 'atime': 0, 'mtime': 0, 'etag': '', 'data': None, 'gzdata': None, 'err': False, 'errMsg': '', 'large': False, 'lock': False, 'dirty': False, 'waiters': [], 'hits': 0, 'rejected': False}
+
+## ETag の作成
+# @param mtime 更新日時 (UNIX時間)
+# @param size ファイルサイズ (byte)
+# @return ETag 文字列
+def makeEtag(mtime, size):
+	return '"%x-%x"' % (int(mtime), size)
+
 ## 非同期ファイルキャッシュクラス
 class AyncFileCache:
 	## コンストラクタ
@@ -37,13 +102,42 @@ class AyncFileCache:
 	# @param cintval ファイル更新チェック間隔 (sec)
 	# @param minTTL 最小キャッシュ生存時間 (sec)
 	# @param maxTTL 最大キャッシュ生存時間 (sec)
-	def __init__(self, maxfsize, maxtotal, cintval, minTTL, maxTTL):
-		self.settings(maxfsize, maxtotal, cintval, minTTL, maxTTL)
+	# @param swr 再チェック中は古いデータを返すか否か
+	# @param nreaders 読み込みスレッド数
+	# @param storage キャッシュデータの保持方法 ('heap', 'mmap' または 'shm')
+	# @param compress gzip 圧縮データも保持するか否か
+	# @param compressLevel gzip 圧縮レベル (1-9)
+	# @param compressRatio 圧縮データを保持する最大の圧縮率
+	# @param shmPath storage が 'shm' の場合の共有メモリのファイル名
+	# @param snapshotPath 終了時にアクセス頻度の高いファイルを保存するファイル名 ('' の場合は保存しない)
+	# @param snapshotEntries 保存する最大ファイル数
+	# @param warmup 起動時とキャッシュクリア時に保存したファイルを先読みするか否か
+	# @param policy 置き換えポリシー ('lru', 'tinylfu' または 'gdsf')
+	# @param sketchWidth アクセス頻度を推定するカウンタの1行あたりの数
+	# @param dispatch 待機コールバックの呼び出し関数 (None の場合は読み込みスレッドから直接呼び出す)
+	def __init__(self, maxfsize, maxtotal, cintval, minTTL, maxTTL, swr = False, nreaders = 1, storage = 'heap', compress = False, compressLevel = 6, compressRatio = 0.9, shmPath = '/dev/shm/redirect_srv.cache', snapshotPath = '', snapshotEntries = 10000, warmup = False, policy = 'lru', sketchWidth = 65536, dispatch = None):
+		self.dispatch = dispatch
+		self.segment = None
+		self.policy = None
+		self.policyName = policy
+		self.sketchWidth = sketchWidth
 		self.lock = threading.RLock()
-		self.cache = {}
+		self.cache = collections.OrderedDict()
+		self.total = 0
+		self.reserved = 0
+		self.maps = 0
+		self.maxMaps = mmapBudget()
 		self.qRead = Queue.Queue()
 		self.thReadTerminate = False
-		self.thRead = threading.Thread(target=AyncFileCache.readThread, args=(self,))
+		self.thReads = []
+		self.thRetired = []
+		self.qWarm = collections.deque()
+		self.thWarm = None
+		self.sweepTime = time.time()
+		self.watched = False
+		self.readStats = {'count': 0, 'readTime': 0.0, 'readTimeMax': 0.0, 'waitTime': 0.0}
+		self.counters = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0, 'expirations': 0, 'errors': 0, 'prefetches': 0, 'rejections': 0}
+		self.settings(maxfsize, maxtotal, cintval, minTTL, maxTTL, swr, nreaders, storage, compress, compressLevel, compressRatio, shmPath, snapshotPath, snapshotEntries, warmup, policy, sketchWidth)
 	
 	## 設定
 	# @param self
@@ -52,7 +146,30 @@ class AyncFileCache:
 	# @param cintval ファイル更新チェック間隔 (sec)
 	# @param minTTL 最小キャッシュ生存時間 (sec)
 	# @param maxTTL 最大キャッシュ生存時間 (sec)
-	def settings(self, maxfsize = None, maxtotal = None, cintval = None, minTTL = None, maxTTL = None):
+	# @param swr 再チェック中は古いデータを返すか否か
+	# @param nreaders 読み込みスレッド数
+	# @param storage キャッシュデータの保持方法 ('heap', 'mmap' または 'shm')
+	# @param compress gzip 圧縮データも保持するか否か
+	# @param compressLevel gzip 圧縮レベル (1-9)
+	# @param compressRatio 圧縮データを保持する最大の圧縮率
+	# @param shmPath storage が 'shm' の場合の共有メモリのファイル名
+	# @param snapshotPath 終了時にアクセス頻度の高いファイルを保存するファイル名 ('' の場合は保存しない)
+	# @param snapshotEntries 保存する最大ファイル数
+	# @param warmup 起動時とキャッシュクリア時に保存したファイルを先読みするか否か
+	# @param policy 置き換えポリシー ('lru', 'tinylfu' または 'gdsf')
+	# @param sketchWidth アクセス頻度を推定するカウンタの1行あたりの数
+	def settings(self, maxfsize = None, maxtotal = None, cintval = None, minTTL = None, maxTTL = None, swr = None, nreaders = None, storage = None, compress = None, compressLevel = None, compressRatio = None, shmPath = None, snapshotPath = None, snapshotEntries = None, warmup = None, policy = None, sketchWidth = None):
+		# 共有メモリを開く (データ領域のサイズは作成時の最大総キャッシュサイズ)
+		# 開けない場合は例外となり、他の設定も変更しない
+		segment = self.segment
+		newStorage = storage if storage is not None else self.storage
+		newShmPath = shmPath if shmPath is not None else self.shmPath
+		
+		if newStorage != 'shm':
+			segment = None
+		elif segment is None or segment.path != newShmPath:
+			segment = shmcache.SharedSegment(newShmPath, maxtotal if maxtotal is not None else self.maxtotal)
+		
 		if maxfsize is not None:
 			self.maxfsize = maxfsize
 		if maxtotal is not None:
@@ -63,67 +180,483 @@ class AyncFileCache:
 			self.minTTL = minTTL
 		if maxTTL is not None:
 			self.maxTTL = maxTTL
+		if swr is not None:
+			self.swr = swr
+		if storage is not None:
+			self.storage = storage
+		if compress is not None:
+			self.compress = compress
+		if compressLevel is not None:
+			self.compressLevel = compressLevel
+		if compressRatio is not None:
+			self.compressRatio = compressRatio
+		if shmPath is not None:
+			self.shmPath = shmPath
+		if snapshotPath is not None:
+			self.snapshotPath = snapshotPath
+		if snapshotEntries is not None:
+			self.snapshotEntries = snapshotEntries
+		if warmup is not None:
+			self.warmup = warmup
+		
+		with self.lock:
+			# 使わなくなった共有メモリを閉じる (キャッシュ中のデータは上書きされた場合と同様に読み込み直される)
+			if self.segment is not None and self.segment is not segment:
+				self.segment.close()
+			
+			self.segment = segment
+			
+			# 置き換えポリシーの変更 (アクセス頻度は引き継がない)
+			if (policy is not None and policy != self.policyName) or (sketchWidth is not None and sketchWidth != self.sketchWidth) or self.policy is None:
+				if policy is not None:
+					self.policyName = policy
+				if sketchWidth is not None:
+					self.sketchWidth = sketchWidth
+				
+				self.policy = cachepolicy.create(self.policyName, self.sketchWidth)
+				self.policy.attach(self.cache)
+		if nreaders is not None:
+			self.nreaders = max(1, nreaders)
+			
+			# 稼働中ならスレッド数を変更
+			if len(self.thReads) > 0:
+				self.resize()
 	
 	## 初期化処理
 	# @param self
 	def initialize(self):
-		if not self.thRead.isAlive():
+		if len(self.thReads) == 0:
 			self.thReadTerminate = False
-			self.thRead.start()
+			self.resize()
+			
+			# 前回終了時にアクセス頻度の高かったファイルを先読み
+			if self.warmup and self.snapshotPath:
+				self.prefetch(self.loadSnapshot())
 	
 	## 終了処理
 	# @param self
 	def finalize(self):
-		if self.thRead.isAlive():
-			self.thReadTerminate = True
-			self.thRead.join()
+		self.thReadTerminate = True
+		
+		for th in self.thReads + self.thRetired + [self.thWarm]:
+			if th is not None and th.isAlive():
+				th.join()
+		
+		self.thReads = []
+		self.thRetired = []
+		self.thWarm = None
+		self.qWarm.clear()
+		
+		if self.snapshotPath:
+			self.saveSnapshot()
+	
+	## 読み込みスレッド数の変更
+	# @param self
+	def resize(self):
+		with self.lock:
+			self.thRetired = [th for th in self.thRetired if th.isAlive()]
+			
+			# 不足分を起動
+			while len(self.thReads) < self.nreaders:
+				th = threading.Thread(target=AyncFileCache.readThread, args=(self,))
+				self.thReads.append(th)
+				th.start()
+			
+			# 超過分は読み込み処理の区切りで終了させる
+			while len(self.thReads) > self.nreaders:
+				self.thRetired.append(self.thReads.pop())
+	
+	## 読み込み状況の取得
+	# @param self
+	# @return 統計情報の辞書
+	def stats(self):
+		with self.lock:
+			count = self.readStats['count']
+			
+			ret = {
+				'readers': len(self.thReads),
+				'queue': self.qRead.qsize(),
+				'reads': count,
+				'readTimeAvg': self.readStats['readTime'] / count if count > 0 else 0.0,
+				'readTimeMax': self.readStats['readTimeMax'],
+				'waitTimeAvg': self.readStats['waitTime'] / count if count > 0 else 0.0,
+				'entries': len(self.cache),
+				'bytes': self.total,
+				'mappedFiles': self.maps,
+				'policy': self.policyName,
+			}
+			ret.update(self.counters)
+			
+			# 共有メモリの使用量 (ホスト全体)
+			if self.segment is not None and self.storage == 'shm':
+				ret['sharedBytes'], ret['sharedSize'] = self.segment.usage()
+			
+			return ret
+	
+	## キャッシュ済みのファイルサイズの取得 (ファイルの読み込みやチェックは行わない)
+	# @param self
+	# @param fname ファイル名
+	# @return ファイルサイズ (byte) (キャッシュされていない場合は None)
+	def peekSize(self, fname):
+		with self.lock:
+			entry = self.cache.get(fname)
+			
+			if entry is None or entry['data'] is None:
+				return None
+			
+			return len(entry['data'])
 	
 	## ファイルデータ取得
 	# @param self
 	# @param fname ファイル名
-	def get(self, fname):
+	# @param waiter Queried 発生時に読み込み完了後呼び出されるコールバック
+	# @return ファイルデータ (ファイルが存在しない場合は None)
+	def get(self, fname, waiter = None):
+		return self.lookup(fname, waiter)[0]
+	
+	## ファイルデータと更新情報の取得
+	# @param self
+	# @param fname ファイル名
+	# @param waiter Queried 発生時に読み込み完了後呼び出されるコールバック
+	# @param acceptGzip gzip 圧縮データを受け付けるか否か
+	# @return (ファイルデータ, 更新日時, ETag, gzip 圧縮データか否か)
+	def lookup(self, fname, waiter = None, acceptGzip = False):
 		with self.lock:
 			if fname in self.cache:
-				self.cache[fname]['atime'] = time.time()
+				# 最近アクセスされたものを末尾へ移動
+				entry = self.cache.pop(fname)
+				self.cache[fname] = entry
+				entry['atime'] = time.time()
+				entry['hits'] += 1
+				self.policy.record(fname, len(entry['data']) if entry['data'] is not None else None)
 				
-				# 処理中判定
-				if self.cache[fname]['lock']:
-					raise Queried()
+				# 処理中判定 (再チェック中のものは古いデータを返す)
+				if entry['lock']:
+					if not self.swr or entry['ctime'] == 0:
+						self.wait(entry, waiter)
 				
-				# 再チェック判定
-				if abs(time.time() - self.cache[fname]['ctime']) >= self.cintval:
-					self.cache[fname]['lock'] = True
-					self.qRead.put(fname)
-					raise Queried()
+				# 再チェック判定 (ファイル更新監視中はファイルの状態によるものは更新通知時のみ、
+				# 最大総キャッシュサイズ超過などファイルの更新通知が来ないエラーは定期的に、置き換えポリシーに受け入れられなかったものは短い間隔で判定し直す)
+				elif ((not self.watched or (entry['err'] and not entry['large'])) and abs(time.time() - entry['ctime']) >= self.cintval) or (entry['rejected'] and abs(time.time() - entry['ctime']) >= REJECT_RETRY):
+					entry['lock'] = True
+					self.qRead.put((fname, time.time()))
+					
+					if not self.swr:
+						self.wait(entry, waiter)
 				
 				# エラー判定
-				if self.cache[fname]['err']:
-					raise Error(self.cache[fname]['errMsg'])
+				if entry['err']:
+					self.counters['errors'] += 1
+					if entry['large']:
+						raise TooLarge(entry['errMsg'])
+					raise Error(entry['errMsg'])
+				
+				self.counters['hits'] += 1
+				
+				# 圧縮データがあればそちらを返す
+				gzipped = acceptGzip and entry['gzdata'] is not None
+				data = entry['gzdata'] if gzipped else entry['data']
 				
-				return self.cache[fname]['data']
+				# 共有メモリから取り出す (他のプロセスに上書きされていたら読み込み直す)
+				if isinstance(data, shmcache.SharedData):
+					data = data.read()
+					
+					if data is None:
+						self.setData(fname, entry, None)
+						entry['ctime'] = 0
+						
+						# 再チェック中のものは読み込み完了を待つ (同じファイルを重複して読み込まない)
+						if not entry['lock']:
+							entry['lock'] = True
+							self.qRead.put((fname, time.time()))
+						
+						self.wait(entry, waiter)
+				
+				if gzipped:
+					return (data, entry['mtime'], entry['etag'][:-1] + '-gz"', True)
 				
+				return (data, entry['mtime'], entry['etag'], False)
+			
 			else:
-				self.cache[fname] = {'ctime': 0, 'atime': 0, 'mtime': 0, 'data': None, 'err': False, 'errMsg': '', 'lock': False}
+				entry = newEntry()
+				self.cache[fname] = entry
 				
 				# 新規ファイル
-				self.cache[fname]['atime'] = time.time()
-				self.cache[fname]['lock'] = True
-				self.qRead.put(fname)
-				raise Queried()
+				self.counters['misses'] += 1
+				entry['atime'] = time.time()
+				entry['hits'] = 1
+				entry['lock'] = True
+				self.policy.record(fname, None)
+				self.qRead.put((fname, time.time()))
+				self.wait(entry, waiter)
+	
+	## ファイル更新監視の状態設定
+	# @param self
+	# @param watched 監視中か否か (監視中は定期的な更新チェックを行わない)
+	def setWatched(self, watched):
+		self.watched = watched
+	
+	## ファイル更新通知
+	# @param self
+	# @param fname ファイル名
+	def invalidate(self, fname):
+		with self.lock:
+			if fname not in self.cache:
+				return
+			
+			entry = self.cache[fname]
+			
+			if entry['lock']:
+				# 読み込み中の場合は完了後に再度読み込む
+				entry['dirty'] = True
+			else:
+				# 古いデータは読み込み完了まで返される (FILE_STALE_WHILE_REVALIDATE)
+				entry['lock'] = True
+				self.qRead.put((fname, time.time()))
+	
+	## すべてのファイルの更新通知
+	# @param self
+	def invalidateAll(self):
+		with self.lock:
+			for fname in self.cache.keys():
+				self.invalidate(fname)
+	
+	## 読み込み完了待ち登録
+	# @param self
+	# @param entry キャッシュエントリ
+	# @param waiter 読み込み完了後に呼び出されるコールバック
+	def wait(self, entry, waiter):
+		if waiter is not None:
+			entry['waiters'].append(waiter)
+		
+		self.counters['waits'] += 1
+		raise Queried()
+	
+	## 待機コールバック呼び出し
+	# @param self
+	# @param waiters コールバックのリスト
+	def notify(self, waiters):
+		for waiter in waiters:
+			if self.dispatch is not None:
+				self.dispatch(waiter)
+			else:
+				waiter()
 	
 	## キャッシュクリア
 	# @param self
 	def clear(self):
+		waiters = []
+		
+		with self.lock:
+			# アクセス頻度の高かったファイルはクリア後に読み込み直す
+			if self.warmup:
+				hot = [(x['path'], x['hits']) for x in self.hotEntries()]
+			else:
+				hot = []
+			
+			# 読み込み待ちのリクエストは再開させる
+			for fname in self.cache:
+				waiters.extend(self.cache[fname]['waiters'])
+				self.cache[fname]['waiters'] = []
+			
+			self.cache = collections.OrderedDict()
+			self.total = 0
+			self.maps = 0
+			self.policy.clear()
+			
+			# 共有メモリは他のプロセスの分も無効化される
+			if self.segment is not None and self.storage == 'shm':
+				self.segment.clear()
+		
+		self.notify(waiters)
+		self.prefetch(hot)
+	
+	## アクセス頻度の高いファイルの列挙
+	# @param self
+	# @return {'path', 'mtime', 'size', 'hits'} のリスト (アクセス回数、最終アクセス日時の降順)
+	def hotEntries(self):
 		with self.lock:
-			self.cache = {}
+			entries = [(fname, entry) for fname, entry in self.cache.iteritems() if entry['data'] is not None and not entry['err']]
+			entries.sort(key=lambda x: (x[1]['hits'], x[1]['atime']), reverse=True)
+			
+			return [{'path': fname, 'mtime': entry['mtime'], 'size': len(entry['data']), 'hits': entry['hits']} for fname, entry in entries[:self.snapshotEntries]]
 	
-	## 総キャッシュサイズ削減
+	## アクセス頻度の高いファイルの保存
+	# @param self
+	# @return 保存できたか否か
+	def saveSnapshot(self):
+		entries = self.hotEntries()
+		
+		# ファイル名はバイト列のまま保存する
+		for x in entries:
+			x['path'] = x['path'].decode('latin-1')
+		
+		snapshot = {'time': time.time(), 'entries': entries}
+		
+		# 複数プロセスが同時に保存しても壊れないよう、別名で書き込んでから置き換える
+		tmpname = '%s.%d.tmp' % (self.snapshotPath, os.getpid())
+		
+		try:
+			fp = open(tmpname, 'wb')
+			try:
+				json.dump(snapshot, fp)
+			finally:
+				fp.close()
+			
+			os.rename(tmpname, self.snapshotPath)
+			return True
+		except (IOError, OSError):
+			try:
+				os.remove(tmpname)
+			except OSError:
+				pass
+			
+			return False
+	
+	## 保存したアクセス頻度の高いファイルの読み込み
+	# 過去のアクセス回数は半分にして引き継ぐ (再起動を繰り返しても古い傾向が残り続けないように)
+	# @param self
+	# @return (ファイル名, アクセス回数) のリスト (保存されていない場合は空のリスト)
+	def loadSnapshot(self):
+		try:
+			fp = open(self.snapshotPath, 'rb')
+			try:
+				snapshot = json.load(fp)
+			finally:
+				fp.close()
+			
+			return [(x['path'].encode('latin-1'), (int(x['hits']) + 1) // 2) for x in snapshot['entries']]
+		except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError, UnicodeError):
+			return []
+	
+	## ファイルの先読み
+	# リクエストによる読み込みを優先し、読み込み待ちがない時に最大総キャッシュサイズに収まるまで読み込む
+	# @param self
+	# @param fnames ファイル名または (ファイル名, アクセス回数) を列挙するイテレータ (先読みスレッドで列挙される)
+	def prefetch(self, fnames):
+		with self.lock:
+			self.qWarm.append(fnames)
+			
+			if not self.thReadTerminate and (self.thWarm is None or not self.thWarm.isAlive()):
+				self.thWarm = threading.Thread(target=AyncFileCache.warmThread, args=(self,))
+				self.thWarm.start()
+	
+	## 先読みスレッド
+	# @param self
+	@staticmethod
+	def warmThread(self):
+		while not self.thReadTerminate:
+			with self.lock:
+				if len(self.qWarm) == 0:
+					self.thWarm = None
+					return
+				
+				fnames = self.qWarm.popleft()
+			
+			# 先読みを依頼して読み込みが完了していないもの (エントリ, サイズ)
+			pending = []
+			
+			for item in fnames:
+				if self.thReadTerminate:
+					return
+				
+				if isinstance(item, tuple):
+					fname, hits = item
+				else:
+					fname, hits = item, 0
+				
+				# 読み込み待ちが読み込みスレッド数以下になるまで待つ (リクエストによる読み込みを待たせない)
+				while self.qRead.qsize() >= self.nreaders and not self.thReadTerminate:
+					time.sleep(0.005)
+				
+				try:
+					fsize = os.stat(fname).st_size
+				except OSError:
+					continue
+				
+				if fsize > self.maxfsize:
+					continue
+				
+				with self.lock:
+					if fname in self.cache:
+						continue
+					
+					pending = [x for x in pending if x[0]['lock']]
+					
+					# 最大総キャッシュサイズに達したら終了 (以降のものはよりアクセス頻度が低い)
+					if self.total + self.reserved + sum(x[1] for x in pending) + fsize > self.maxtotal:
+						break
+					
+					entry = newEntry()
+					entry['atime'] = time.time()
+					entry['hits'] = hits
+					entry['lock'] = True
+					self.cache[fname] = entry
+					self.counters['prefetches'] += 1
+					self.qRead.put((fname, time.time()))
+					pending.append((entry, fsize))
+	
+	## キャッシュデータの設定
+	# @param self
+	# @param fname ファイル名
+	# @param entry キャッシュエントリ
+	# @param data ファイルデータ
+	# @param gzdata gzip 圧縮データ
+	def setData(self, fname, entry, data, gzdata = None):
+		with self.lock:
+			# キャッシュから削除済みのエントリは総サイズに含めない
+			if self.cache.get(fname) is entry:
+				self.total += dataSize(data) + dataSize(gzdata) - entrySize(entry)
+				self.maps -= entryMaps(entry)
+			
+			entry['data'] = data
+			entry['gzdata'] = gzdata
+			
+			if self.cache.get(fname) is entry:
+				self.maps += entryMaps(entry)
+	
+	## キャッシュエントリの削除
+	# @param self
+	# @param fname ファイル名
+	# @param evicted 容量確保のために削除したか否か
+	def remove(self, fname, evicted = False):
+		with self.lock:
+			self.total -= entrySize(self.cache[fname])
+			self.maps -= entryMaps(self.cache[fname])
+			del self.cache[fname]
+			self.policy.remove(fname, evicted)
+	
+	## 最大生存時間を超過したエントリの削除
+	# @param self
+	# @param crrtime 現在時刻 (UNIX時間)
+	def expire(self, crrtime):
+		abandon = []
+		
+		with self.lock:
+			# アクセス時間の古い順に期限切れのものを列挙 (期限内のものに達したら終了)
+			for fname, entry in self.cache.iteritems():
+				if abs(crrtime - entry['atime']) < self.maxTTL:
+					break
+				
+				# ロックされているものは削除しない
+				if entry['lock']:
+					continue
+				
+				abandon.append(fname)
+			
+			# 列挙したものを削除
+			for fname in abandon:
+				self.remove(fname)
+			
+			self.counters['expirations'] += len(abandon)
+	
+	## 総キャッシュサイズ削減で削除するエントリの列挙
 	# @param self
 	# @param padding 水増しサイズ (byte)
 	# @param maxtotal 最大総キャッシュサイズ (bytes)
 	# @param ignore 除外するファイル名のリスト
-	# @return maxtotal 以下のサイズに削減できたか否か
-	def trim(self, padding = 0, maxtotal = None, ignore = None):
+	# @return (削除するファイル名のリスト, maxtotal 以下のサイズに削減できるか否か)
+	def victims(self, padding = 0, maxtotal = None, ignore = None):
 		if maxtotal is None:
 			maxtotal = self.maxtotal
 		
@@ -133,48 +666,208 @@ class AyncFileCache:
 			ignore = set(ignore)
 		
 		crrtime = time.time()
-		total = padding
 		
 		with self.lock:
-			# キーをアクセス時間の降順にソート
-			fnames = [(fname, self.cache[fname]['atime']) for fname in self.cache]
-			fnames = [fname[0] for fname in sorted(fnames, lambda a, b: b[1] - a[1])]
+			# 除外するファイルを除いた総サイズ (読み込み中の予約分を含む)
+			total = self.total + self.reserved + padding
+			
+			for fname in ignore:
+				if fname in self.cache:
+					total -= entrySize(self.cache[fname])
+			
 			abandon = []
 			
-			# 総サイズを超えたものを古い順に列挙
-			for fname in fnames:
-				if fname in ignore:
-					continue
+			# 最小生存時間を過ぎたものはアクセス時間順の先頭に並ぶので、それらをすべて削除しても収まらない場合は
+			# 置き換えポリシーの削除順にたどらずにすべて削除対象にする (最近のものばかりのヒープを毎回たどらない)
+			if not self.policy.lruOrder:
+				free = 0
+				
+				for fname, entry in self.cache.iteritems():
+					if not (total - free > maxtotal) or abs(crrtime - entry['atime']) <= self.minTTL:
+						break
+					
+					if fname in ignore or entry['lock']:
+						continue
+					
+					size = entrySize(entry)
+					
+					if size > 0:
+						free += size
+						abandon.append(fname)
+				
+				if total - free > maxtotal:
+					return (abandon, False)
+				
+				abandon = []
+			
+			# 置き換えポリシーの削除順 (LRU ではアクセス時間の古い順) に総サイズを超えた分を列挙
+			for fname, entry in self.policy.evictionOrder(self.cache):
+				if not (total > maxtotal):
+					break
 				
-				size = len(self.cache[fname]['data']) if self.cache[fname]['data'] is not None else 0
-				total += size
+				# 最小生存時間以下のものは削除しない (アクセス時間順なら以降のものはすべてより新しい)
+				if abs(crrtime - entry['atime']) <= self.minTTL:
+					if self.policy.lruOrder:
+						break
+					continue
 				
-				# ロックされているか、最小生存時間以下のものは削除しない
-				if self.cache[fname]['lock'] or abs(crrtime - self.cache[fname]['atime']) <= self.minTTL:
+				# ロックされているものは削除しない
+				if fname in ignore or entry['lock']:
 					continue
 				
-				if size > 0 and total > maxtotal:
+				size = entrySize(entry)
+				
+				if size > 0:
 					total -= size
 					abandon.append(fname)
+		
+		return (abandon, not (total > maxtotal))
+	
+	## 総キャッシュサイズ削減
+	# @param self
+	# @param padding 水増しサイズ (byte)
+	# @param maxtotal 最大総キャッシュサイズ (bytes)
+	# @param ignore 除外するファイル名のリスト
+	# @param victims 同じロック中に victims で列挙済みの結果 (None の場合は列挙する)
+	# @return maxtotal 以下のサイズに削減できたか否か
+	def trim(self, padding = 0, maxtotal = None, ignore = None, victims = None):
+		with self.lock:
+			abandon, fit = victims if victims is not None else self.victims(padding, maxtotal, ignore)
 			
 			# 列挙したものを削除
 			for fname in abandon:
-				del self.cache[fname]
+				self.remove(fname, True)
+			
+			self.counters['evictions'] += len(abandon)
 		
-		return not (total > maxtotal)
+		return fit
+	
+	## 新しいファイルをキャッシュするか否かの判定
+	# 空き容量に収まらない場合は、追い出されるファイルと比べて置き換えポリシーが判定する
+	# @param self
+	# @param fname ファイル名
+	# @param size ファイルサイズ (byte)
+	# @return キャッシュする場合は trim にそのまま渡せる victims の結果、しない場合は None
+	#         (容量が確保できない場合もキャッシュするものとし、trim で判定する)
+	def admit(self, fname, size):
+		with self.lock:
+			victims = self.victims(size, ignore=[fname])
+			abandon, fit = victims
+			
+			if len(abandon) > 0 and fit and not self.policy.admit(fname, size, abandon):
+				return None
+			
+			return victims
+	
+	## ファイル読み込み
+	# @param self
+	# @param fname ファイル名
+	# @return ファイルデータ (str または mmap)
+	def load(self, fname):
+		fp = open(fname, 'rb')
+		
+		try:
+			# 読み込み専用で共有マップする (空のファイルは mmap できない)
+			# ファイルディスクリプタを使い切らないよう、上限を超える分はメモリ上に読み込む
+			if self.storage == 'mmap' and self.maps < self.maxMaps:
+				try:
+					return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+				except ValueError:
+					pass
+			
+			return fp.read()
+		finally:
+			fp.close()
+	
+	## gzip 圧縮データの作成
+	# @param self
+	# @param fname ファイル名
+	# @param data ファイルデータ
+	# @param mtime ファイルの更新日時 (UNIX時間)
+	# @return gzip 圧縮データ (圧縮しない場合は None)
+	def loadGzip(self, fname, data, mtime):
+		if not self.compress or len(data) == 0:
+			return None
+		
+		# 元のファイルより新しい .gz ファイルがあればそれを使用する
+		try:
+			if os.stat(fname + '.gz').st_mtime >= mtime:
+				return self.load(fname + '.gz')
+		except OSError:
+			pass
+		
+		buf = cStringIO.StringIO()
+		fp = gzip.GzipFile(os.path.basename(fname), 'wb', self.compressLevel, buf, 0)
+		fp.write(data[:])
+		fp.close()
+		gzdata = buf.getvalue()
+		
+		# 圧縮の効果が小さいものは保持しない
+		if len(gzdata) > len(data) * self.compressRatio:
+			return None
+		
+		return gzdata
+	
+	## 共有メモリを介したファイル読み込み
+	# @param self
+	# @param fname ファイル名
+	# @param fstat ファイルの stat
+	# @return (ファイルデータ, gzip 圧縮データ) (他のプロセスが読み込み済みならファイルは読まない)
+	def loadShared(self, fname, fstat):
+		segment = self.segment
+		data = segment.find(fname, fstat.st_mtime, fstat.st_size)
+		raw = None
+		
+		if data is None:
+			raw = self.load(fname)
+			data = segment.put(fname, fstat.st_mtime, raw) or raw
+		
+		if not self.compress:
+			return (data, None)
+		
+		# 圧縮の効果が小さく保持しないものは空のデータとして登録する
+		# 圧縮データのサイズは読み込むまで分からないので、元のファイルのサイズをキーに含める
+		gzkey = '%s\0gz\0%d' % (fname, fstat.st_size)
+		gzdata = segment.find(gzkey, fstat.st_mtime)
+		
+		if gzdata is None:
+			if raw is None:
+				raw = data.read() if isinstance(data, shmcache.SharedData) else data
+			if raw is None:
+				raw = self.load(fname)
+			
+			gzraw = self.loadGzip(fname, raw, fstat.st_mtime) or ''
+			gzdata = segment.put(gzkey, fstat.st_mtime, gzraw) or gzraw
+		
+		return (data, gzdata if len(gzdata) > 0 else None)
 	
 	## 読み込みスレッド
 	# @param self
 	@staticmethod
 	def readThread(self):
-		ctime = time.time()
+		th = threading.currentThread()
 		
-		while not self.thReadTerminate:
+		# 同じファイルは lock フラグにより1つのスレッドでのみ処理される
+		while not self.thReadTerminate and th in self.thReads:
 			try:
 				# ファイル読み込みキュー待ち
 				err = False
 				errMsg = ''
-				fname = self.qRead.get(timeout=0.1)
+				large = False
+				rejected = False
+				fname, qtime = self.qRead.get(timeout=0.1)
+				rtime = time.time()
+				
+				with self.lock:
+					entry = self.cache.get(fname)
+					
+					# 以降の更新通知は再読み込みが必要
+					if entry is not None:
+						entry['dirty'] = False
+				
+				# キャッシュクリアなどで削除済み
+				if entry is None:
+					continue
 				
 				try:
 					fstat = os.stat(fname)
@@ -183,25 +876,70 @@ class AyncFileCache:
 						# ファイルが大きすぎる
 						err = True
 						errMsg = 'File size too large. (%d bytes)' % fstat.st_size
+						large = True
 					else:
 						# ファイル更新チェック
 						with self.lock:
-							mtime = self.cache[fname]['mtime']
-							fsize = len(self.cache[fname]['data']) if self.cache[fname]['data'] is not None else None
+							mtime = entry['mtime']
+							fsize = len(entry['data']) if entry['data'] is not None else None
 						
 						if mtime != fstat.st_mtime or fsize is None or fsize != fstat.st_size:
-							# ファイル更新あり
-							if self.trim(fstat.st_size, ignore=[fname]):
-								data = open(fname, 'rb').read()
+							# ファイル更新あり (読み込み完了まで領域を予約する)
+							with self.lock:
+								# キャッシュされていないファイルは置き換えポリシーが受け入れた場合のみ読み込む
+								# (受け入れる場合は判定に使った削除対象をそのまま削除する)
+								victims = None
+								
+								if fsize is None:
+									victims = self.admit(fname, fstat.st_size)
+									rejected = victims is None
+								
+								if rejected:
+									fit = False
+								else:
+									fit = self.trim(fstat.st_size, ignore=[fname], victims=victims)
+								
+								if fit:
+									self.reserved += fstat.st_size
+							
+							if fit:
+								try:
+									if self.segment is not None and self.storage == 'shm':
+										data, gzdata = self.loadShared(fname, fstat)
+									else:
+										data = self.load(fname)
+										gzdata = self.loadGzip(fname, data, fstat.st_mtime)
+								except:
+									with self.lock:
+										self.reserved -= fstat.st_size
+									raise
 								
 								# ファイル読み込み成功
 								with self.lock:
-									self.cache[fname]['ctime'] = time.time()
-									self.cache[fname]['mtime'] = fstat.st_mtime
-									self.cache[fname]['data'] = data
-									self.cache[fname]['err'] = False
-									self.cache[fname]['errMsg'] = ''
-									self.cache[fname]['lock'] = False
+									# 圧縮データの分の領域が確保できなければ保持しない
+									if gzdata is not None and not self.trim(len(gzdata), ignore=[fname]):
+										gzdata = None
+									
+									self.reserved -= fstat.st_size
+									self.setData(fname, entry, data, gzdata)
+									entry['ctime'] = time.time()
+									entry['mtime'] = fstat.st_mtime
+									entry['etag'] = makeEtag(fstat.st_mtime, fstat.st_size)
+									entry['err'] = False
+									entry['errMsg'] = ''
+									entry['large'] = False
+									entry['rejected'] = False
+									entry['lock'] = False
+									
+									if self.cache.get(fname) is entry:
+										self.policy.loaded(fname, fstat.st_size)
+							elif rejected:
+								# 置き換えポリシーが受け入れない (リダイレクトされる)
+								err = True
+								errMsg = 'Rejected by cache policy.'
+								
+								with self.lock:
+									self.counters['rejections'] += 1
 							else:
 								# 最大総キャッシュサイズ超過
 								err = True
@@ -209,49 +947,73 @@ class AyncFileCache:
 						else:
 							# ファイル更新なし
 							with self.lock:
-								self.cache[fname]['ctime'] = time.time()
-								self.cache[fname]['err'] = False
-								self.cache[fname]['errMsg'] = ''
-								self.cache[fname]['lock'] = False
-				except:
-					# ファイルが見つからない
-					with self.lock:
-						self.cache[fname]['ctime'] = time.time()
-						self.cache[fname]['mtime'] = 0
-						self.cache[fname]['data'] = None
-						self.cache[fname]['err'] = False
-						self.cache[fname]['errMsg'] = ''
-						self.cache[fname]['lock'] = False
+								entry['ctime'] = time.time()
+								entry['err'] = False
+								entry['errMsg'] = ''
+								entry['large'] = False
+								entry['rejected'] = False
+								entry['lock'] = False
+				except Exception, e:
+					if isinstance(e, EnvironmentError) and e.errno in MISSING_ERRNOS:
+						# ファイルが見つからない
+						with self.lock:
+							self.setData(fname, entry, None)
+							entry['ctime'] = time.time()
+							entry['mtime'] = 0
+							entry['etag'] = ''
+							entry['err'] = False
+							entry['errMsg'] = ''
+							entry['large'] = False
+							entry['rejected'] = False
+							entry['lock'] = False
+					else:
+						# 読み込みエラー (ファイルディスクリプタの不足などはファイルが無いとはみなさず、リダイレクトさせる)
+						err = True
+						errMsg = 'Read error. [%s]' % e
 				
 				if err:
 					# エラー
 					with self.lock:
-						self.cache[fname]['ctime'] = time.time()
-						self.cache[fname]['mtime'] = 0
-						self.cache[fname]['data'] = None
-						self.cache[fname]['err'] = True
-						self.cache[fname]['errMsg'] = errMsg
-						self.cache[fname]['lock'] = False
+						self.setData(fname, entry, None)
+						entry['ctime'] = time.time()
+						entry['mtime'] = 0
+						entry['etag'] = ''
+						entry['err'] = True
+						entry['errMsg'] = errMsg
+						entry['large'] = large
+						entry['rejected'] = rejected
+						entry['lock'] = False
 				
+				# 読み込み完了を待機中のリクエストに通知
+				with self.lock:
+					# 読み込み中に更新通知があった場合は再度読み込む
+					if entry['dirty']:
+						entry['dirty'] = False
+						entry['lock'] = True
+						self.qRead.put((fname, time.time()))
+					
+					waiters = entry['waiters']
+					entry['waiters'] = []
+					
+					# 読み込み時間の集計
+					crrtime = time.time()
+					self.readStats['count'] += 1
+					self.readStats['readTime'] += crrtime - rtime
+					self.readStats['readTimeMax'] = max(self.readStats['readTimeMax'], crrtime - rtime)
+					self.readStats['waitTime'] += rtime - qtime
+				
+				self.notify(waiters)
+			
 			except Queue.Empty:
 				pass
 			
 			crrtime = time.time()
 			
-			# 生存時間超過処理
-			if abs(crrtime - ctime) >= 1:
-				abandon = []
-				
-				with self.lock:
-					# 最大生存時間を超過した物を列挙
-					for fname in self.cache:
-						if self.cache[fname]['lock']:
-							continue
-						if abs(crrtime - self.cache[fname]['atime']) >= self.maxTTL:
-							abandon.append(fname)
-					
-					# 列挙したものを削除
-					for fname in abandon:
-						del self.cache[fname]
-				
-				ctime = crrtime
+			# 生存時間超過処理 (いずれかのスレッドが1秒毎に行う)
+			with self.lock:
+				sweep = abs(crrtime - self.sweepTime) >= 1
+				if sweep:
+					self.sweepTime = crrtime
+			
+			if sweep:
+				self.expire(crrtime)
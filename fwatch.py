@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import errno
+import struct
+import select
+import ctypes
+import threading
+
+# inotify イベント
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+# 監視するイベント
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# inotify_event 構造体のヘッダ
+EVENT_HEADER = struct.Struct('iIII')
+
+# inotify (Linux のみ)
+try:
+	if not sys.platform.startswith('linux'):
+		raise OSError(errno.ENOSYS, 'Not linux')
+	
+	_libc = ctypes.CDLL(None, use_errno=True)
+	_inotify_init = _libc.inotify_init
+	_inotify_init.argtypes = []
+	_inotify_add_watch = _libc.inotify_add_watch
+	_inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	_inotify_rm_watch = _libc.inotify_rm_watch
+	_inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (OSError, AttributeError):
+	_inotify_init = None
+
+## inotify が利用可能か否か
+# @return 利用可能か否か
+def available():
+	return _inotify_init is not None
+
+## ファイル更新監視クラス
+class FileWatcher:
+	## コンストラクタ
+	# @param self
+	# @param root 監視するディレクトリ (配下のディレクトリも再帰的に監視する)
+	# @param onChange ファイル更新時に呼び出されるコールバック (引数はファイル名)
+	# @param onReset 更新通知を取りこぼした場合に呼び出されるコールバック
+	# @param onState 監視の開始・停止時に呼び出されるコールバック (引数は監視中か否か)
+	def __init__(self, root, onChange, onReset, onState):
+		self.root = os.path.normpath(root)
+		self.onChange = onChange
+		self.onReset = onReset
+		self.onState = onState
+		self.fd = None
+		self.wds = {}
+		self.partial = False
+		self.thWatchTerminate = False
+		self.thWatch = None
+	
+	## 初期化処理
+	# @param self
+	# @return 監視を開始できたか否か
+	def initialize(self):
+		if self.thWatch is not None and self.thWatch.isAlive():
+			return True
+		
+		if not available():
+			return False
+		
+		self.fd = _inotify_init()
+		if self.fd < 0:
+			self.fd = None
+			return False
+		
+		self.wds = {}
+		self.partial = False
+		self.addTree(self.root)
+		
+		self.thWatchTerminate = False
+		self.thWatch = threading.Thread(target=FileWatcher.watchThread, args=(self,))
+		self.thWatch.start()
+		
+		return True
+	
+	## 終了処理
+	# @param self
+	def finalize(self):
+		if self.thWatch is not None and self.thWatch.isAlive():
+			self.thWatchTerminate = True
+			self.thWatch.join()
+	
+	## ディレクトリ配下の監視を追加
+	# シンボリックリンクのディレクトリもたどって監視する
+	# @param self
+	# @param path ディレクトリ名
+	# @param notify 配下のファイルの更新を通知するか否か
+	def addTree(self, path, notify = False):
+		seen = set()
+		
+		for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+			try:
+				st = os.stat(dirpath)
+			except OSError:
+				dirnames[:] = []
+				continue
+			
+			# シンボリックリンクでループしている
+			if (st.st_dev, st.st_ino) in seen:
+				dirnames[:] = []
+				self.setPartial()
+				continue
+			
+			seen.add((st.st_dev, st.st_ino))
+			
+			wd = _inotify_add_watch(self.fd, dirpath, WATCH_MASK)
+			if wd >= 0:
+				if wd in self.wds and self.wds[wd] != dirpath:
+					# 監視済みのディレクトリに別のパスからたどり着いた (更新通知は1つのパスでしか受け取れない)
+					dirnames[:] = []
+					self.setPartial()
+					continue
+				
+				self.wds[wd] = dirpath
+			else:
+				# 監視数の上限 (max_user_watches) などで監視できないディレクトリがある
+				self.setPartial()
+			
+			for name in filenames:
+				fname = os.path.join(dirpath, name)
+				
+				# ファイルへのシンボリックリンクはリンク先の更新が通知されない
+				if os.path.islink(fname):
+					self.setPartial()
+				
+				if notify:
+					self.changed(fname)
+	
+	## ディレクトリ配下の監視を削除
+	# @param self
+	# @param path ディレクトリ名
+	# @return 監視していたか否か
+	def removeTree(self, path):
+		wds = [x for x in self.wds if self.wds[x] == path or self.wds[x].startswith(path + os.sep)]
+		
+		for wd in wds:
+			_inotify_rm_watch(self.fd, wd)
+			del self.wds[wd]
+		
+		return len(wds) > 0
+	
+	## 一部のファイルの更新を監視できない状態にする
+	# 定期チェックに戻す (監視できたディレクトリの更新通知は引き続き反映される)
+	# @param self
+	def setPartial(self):
+		if not self.partial:
+			self.partial = True
+			self.onState(False)
+	
+	## ファイル更新の通知
+	# @param self
+	# @param fname ファイル名
+	def changed(self, fname):
+		self.onChange(fname)
+		
+		# 圧縮済みファイルの更新は元のファイルの更新として扱う
+		if fname.endswith('.gz'):
+			self.onChange(fname[:-3])
+	
+	## イベント処理
+	# @param self
+	# @param wd 監視ディスクリプタ
+	# @param mask イベント
+	# @param name ファイル名
+	def handleEvent(self, wd, mask, name):
+		# イベントを取りこぼした
+		if mask & IN_Q_OVERFLOW:
+			self.onReset()
+			return
+		
+		# 監視対象のディレクトリが削除された
+		if mask & IN_IGNORED:
+			self.wds.pop(wd, None)
+			return
+		
+		if wd not in self.wds:
+			return
+		
+		path = os.path.join(self.wds[wd], name) if name else self.wds[wd]
+		
+		if mask & IN_ISDIR:
+			if mask & (IN_CREATE | IN_MOVED_TO):
+				# 新しいディレクトリを監視し、配下のファイルを更新扱いにする
+				self.addTree(path, True)
+			elif mask & IN_MOVED_FROM:
+				# 移動されたディレクトリの監視を外し、すべてのキャッシュを再チェックさせる
+				self.removeTree(path)
+				self.onReset()
+		elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+			if self.wds[wd] == self.root:
+				# ルートディレクトリが無くなった
+				self.onReset()
+		elif name:
+			# ディレクトリへのシンボリックリンクの削除・置き換え (IN_ISDIR は付かない)
+			if mask & (IN_DELETE | IN_MOVED_FROM | IN_CREATE | IN_MOVED_TO) and self.removeTree(path):
+				self.onReset()
+			
+			if mask & (IN_CREATE | IN_MOVED_TO) and os.path.isdir(path):
+				# ディレクトリへのシンボリックリンクの作成
+				self.addTree(path, True)
+			else:
+				if mask & (IN_CREATE | IN_MOVED_TO) and os.path.islink(path):
+					self.setPartial()
+				
+				self.changed(path)
+	
+	## 監視スレッド
+	# @param self
+	@staticmethod
+	def watchThread(self):
+		# すべてのディレクトリを監視できた場合のみ定期チェックを止める
+		self.onState(not self.partial)
+		
+		try:
+			while not self.thWatchTerminate:
+				# イベント待ち
+				r, w, x = select.select([self.fd], [], [], 0.1)
+				if self.fd not in r:
+					continue
+				
+				buf = os.read(self.fd, 65536)
+				pos = 0
+				
+				while pos + EVENT_HEADER.size <= len(buf):
+					wd, mask, cookie, size = EVENT_HEADER.unpack_from(buf, pos)
+					pos += EVENT_HEADER.size
+					name = buf[pos:pos + size].rstrip('\0')
+					pos += size
+					
+					self.handleEvent(wd, mask, name)
+		finally:
+			# 監視を停止し、定期チェックに戻す
+			os.close(self.fd)
+			self.fd = None
+			self.wds = {}
+			self.onState(False)
+			
+			# 異常終了した場合は停止中の更新を取りこぼしている
+			if not self.thWatchTerminate:
+				self.onReset()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import httplib
+import urlparse
+import threading
+
+## リダイレクト先の死活監視クラス
+class HealthChecker:
+	## コンストラクタ
+	# @param self
+	# @param interval 監視間隔 (sec)
+	# @param timeout タイムアウト (sec)
+	# @param path リクエストするパス (base_url からの相対パス)
+	# @param fall 連続して何回失敗したら停止中とみなすか
+	# @param latency 応答時間に応じて weight を調整するか否か
+	# @param onUpdate 調整後の weight の比率が変化した時に呼び出されるコールバック
+	def __init__(self, interval, timeout, path, fall, latency, onUpdate):
+		self.settings(interval, timeout, path, fall, latency)
+		self.onUpdate = onUpdate
+		self.lock = threading.RLock()
+		self.status = {}
+		self.thCheckTerminate = False
+		self.thCheck = None
+	
+	## 設定
+	# @param self
+	# @param interval 監視間隔 (sec)
+	# @param timeout タイムアウト (sec)
+	# @param path リクエストするパス (base_url からの相対パス)
+	# @param fall 連続して何回失敗したら停止中とみなすか
+	# @param latency 応答時間に応じて weight を調整するか否か
+	def settings(self, interval = None, timeout = None, path = None, fall = None, latency = None):
+		if interval is not None:
+			self.interval = interval
+		if timeout is not None:
+			self.timeout = timeout
+		if path is not None:
+			self.path = path
+		if fall is not None:
+			self.fall = fall
+		if latency is not None:
+			self.latency = latency
+	
+	## 初期化処理
+	# @param self
+	def initialize(self):
+		if self.thCheck is None or not self.thCheck.isAlive():
+			self.thCheckTerminate = False
+			self.thCheck = threading.Thread(target=HealthChecker.checkThread, args=(self,))
+			self.thCheck.start()
+	
+	## 終了処理
+	# @param self
+	def finalize(self):
+		if self.thCheck is not None and self.thCheck.isAlive():
+			self.thCheckTerminate = True
+			self.thCheck.join()
+	
+	## 監視対象の設定
+	# @param self
+	# @param urls base_url のリスト
+	def setTargets(self, urls):
+		with self.lock:
+			status = {}
+			
+			for url in urls:
+				status[url] = self.status.get(url, {'healthy': True, 'fails': 0, 'latency': None, 'checked': 0, 'error': ''})
+			
+			self.status = status
+	
+	## 監視状態の取得
+	# @param self
+	# @return base_url をキーとした監視状態の辞書
+	def getStatus(self):
+		with self.lock:
+			return dict((url, dict(self.status[url])) for url in self.status)
+	
+	## weight の調整比率の取得
+	# @param self
+	# @return base_url をキーとした調整比率の辞書 (0 は停止中)
+	def factors(self):
+		with self.lock:
+			if self.interval <= 0:
+				return {}
+			
+			ret = {}
+			latencies = [x['latency'] for x in self.status.values() if x['healthy'] and x['latency'] is not None]
+			
+			for url, status in self.status.iteritems():
+				if not status['healthy']:
+					ret[url] = 0.0
+				elif self.latency and status['latency'] is not None and len(latencies) > 0:
+					# 最も速いものとの応答時間の比 (誤差で頻繁に変化しないよう 10ms 未満は区別せず、0.25 刻みにする)
+					factor = max(min(latencies), 0.01) / max(status['latency'], 0.01)
+					ret[url] = max(0.25, round(factor * 4) / 4)
+				else:
+					ret[url] = 1.0
+			
+			return ret
+	
+	## 死活確認
+	# @param self
+	# @param url base_url
+	def probe(self, url):
+		error = ''
+		start = time.time()
+		
+		try:
+			parsed = urlparse.urlsplit(url)
+			
+			if parsed.scheme == 'https':
+				conn = httplib.HTTPSConnection(parsed.netloc, timeout=self.timeout)
+			else:
+				conn = httplib.HTTPConnection(parsed.netloc, timeout=self.timeout)
+			
+			try:
+				conn.request('HEAD', parsed.path.rstrip('/') + '/' + self.path.lstrip('/'))
+				res = conn.getresponse()
+				
+				# サーバエラー以外は稼働中とみなす
+				if res.status >= 500:
+					error = 'HTTP %d' % res.status
+			finally:
+				conn.close()
+		except Exception, e:
+			error = str(e) or e.__class__.__name__
+		
+		elapsed = time.time() - start
+		
+		with self.lock:
+			if url not in self.status:
+				return
+			
+			status = self.status[url]
+			status['checked'] = time.time()
+			status['error'] = error
+			
+			if error:
+				status['fails'] += 1
+				if status['fails'] >= self.fall:
+					status['healthy'] = False
+			else:
+				status['fails'] = 0
+				status['healthy'] = True
+				
+				# 応答時間は指数移動平均をとる
+				if status['latency'] is None:
+					status['latency'] = elapsed
+				else:
+					status['latency'] = status['latency'] * 0.7 + elapsed * 0.3
+	
+	## 監視スレッド
+	# @param self
+	@staticmethod
+	def checkThread(self):
+		ctime = 0
+		factors = self.factors()
+		
+		while not self.thCheckTerminate:
+			time.sleep(0.1)
+			
+			crrtime = time.time()
+			
+			if self.interval <= 0 or abs(crrtime - ctime) < self.interval:
+				continue
+			
+			ctime = crrtime
+			
+			# すべてのリダイレクト先を並列に確認する
+			with self.lock:
+				urls = self.status.keys()
+			
+			ths = [threading.Thread(target=self.probe, args=(url,)) for url in urls]
+			
+			for th in ths:
+				th.start()
+			for th in ths:
+				th.join()
+			
+			# 調整比率が変化したら通知
+			crrfactors = self.factors()
+			
+			if crrfactors != factors:
+				factors = crrfactors
+				self.onUpdate()
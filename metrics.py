@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+import bisect
+
+# 応答時間のヒストグラムの区間 (sec)
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+## リクエスト統計クラス
+# IOLoop のスレッドからのみ更新されるのでロックしない
+class Metrics:
+	## コンストラクタ
+	# @param self
+	def __init__(self):
+		self.startTime = time.time()
+		self.requests = {}
+		self.rules = {}
+		self.targets = {}
+		self.bytes = {'self': 0, 'redirect': 0}
+		self.redirectUnknown = 0
+		self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+		self.latencySum = 0.0
+	
+	## リクエスト完了の記録
+	# @param self
+	# @param status ステータスコード
+	# @param elapsed 応答時間 (sec)
+	def request(self, status, elapsed):
+		self.requests[status] = self.requests.get(status, 0) + 1
+		self.latency[bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+		self.latencySum += elapsed
+	
+	## リダイレクト先選択の記録
+	# @param self
+	# @param rule リダイレクト設定の名前
+	# @param baseUrl 選択されたリダイレクト先URL ('' はこのサーバ)
+	def route(self, rule, baseUrl):
+		self.rules[rule] = self.rules.get(rule, 0) + 1
+		self.targets[baseUrl] = self.targets.get(baseUrl, 0) + 1
+	
+	## このサーバから送信したファイルサイズの記録
+	# @param self
+	# @param size サイズ (byte)
+	def served(self, size):
+		self.bytes['self'] += size
+	
+	## リダイレクトしたファイルサイズの記録
+	# @param self
+	# @param size サイズ (byte) (不明な場合は None)
+	def redirected(self, size):
+		if size is None:
+			self.redirectUnknown += 1
+		else:
+			self.bytes['redirect'] += size
+	
+	## 統計情報の取得
+	# @param self
+	# @return 統計情報の辞書
+	def snapshot(self):
+		# 累積度数にする
+		buckets = []
+		count = 0
+		
+		for le, n in zip(LATENCY_BUCKETS + ['+Inf'], self.latency):
+			count += n
+			buckets.append((le, count))
+		
+		return {
+			'uptime': time.time() - self.startTime,
+			'requests': dict((str(x), self.requests[x]) for x in self.requests),
+			'routes': {
+				'rules': dict(self.rules),
+				'targets': dict(('self' if x == '' else x, self.targets[x]) for x in self.targets),
+			},
+			'bytes': {
+				'self': self.bytes['self'],
+				'redirect': self.bytes['redirect'],
+				'redirectUnknownSize': self.redirectUnknown,
+			},
+			'latency': {'buckets': buckets, 'sum': self.latencySum, 'count': count},
+		}
+
+## Prometheus のラベル値のエスケープ
+# @param value 値
+# @return エスケープした文字列
+def escapeLabel(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+## 統計情報を Prometheus のテキスト形式に変換する
+# @param stats redirect_srv の統計情報の辞書
+# @param prefix メトリクス名の接頭辞
+# @return テキスト
+def formatPrometheus(stats, prefix = 'redirect_srv_'):
+	lines = []
+	
+	# メトリクスの追加 (samples は (ラベルの辞書, 値) のリスト)
+	def add(name, mtype, text, samples):
+		lines.append('# HELP %s%s %s' % (prefix, name, text))
+		lines.append('# TYPE %s%s %s' % (prefix, name, mtype))
+		
+		for labels, value in samples:
+			label = ','.join('%s="%s"' % (k, escapeLabel(labels[k])) for k in sorted(labels))
+			lines.append('%s%s%s %s' % (prefix, name, '{%s}' % label if label else '', repr(float(value)) if isinstance(value, float) else value))
+	
+	cache = stats['cache']
+	
+	add('cache_hits_total', 'counter', 'Cache lookups served from the cache.', [({}, cache['hits'])])
+	add('cache_misses_total', 'counter', 'Cache lookups of files not in the cache.', [({}, cache['misses'])])
+	add('cache_waits_total', 'counter', 'Requests that waited for a file to be read.', [({}, cache['waits'])])
+	add('cache_evictions_total', 'counter', 'Entries evicted to stay under the size limit.', [({}, cache['evictions'])])
+	add('cache_expirations_total', 'counter', 'Entries removed after the maximum TTL.', [({}, cache['expirations'])])
+	add('cache_errors_total', 'counter', 'Cache lookups that failed.', [({}, cache['errors'])])
+	add('cache_prefetches_total', 'counter', 'Files queued for reading by the cache warm-up.', [({}, cache['prefetches'])])
+	add('cache_rejections_total', 'counter', 'New files not cached because the cache policy preferred the entries they would evict.', [({}, cache['rejections'])])
+	add('cache_entries', 'gauge', 'Entries in the cache.', [({}, cache['entries'])])
+	add('cache_bytes', 'gauge', 'Bytes held in process memory by the cache.', [({}, cache['bytes'])])
+	
+	if 'sharedBytes' in cache:
+		add('cache_shared_bytes', 'gauge', 'Bytes written to the shared memory cache.', [({}, cache['sharedBytes'])])
+	
+	add('read_queue_length', 'gauge', 'Files waiting to be read.', [({}, cache['queue'])])
+	add('log_queue_length', 'gauge', 'Access log lines waiting to be written.', [({}, stats['log']['queue'])])
+	add('log_dropped_total', 'counter', 'Access log lines dropped because the queue was full.', [({}, stats['log']['dropped'])])
+	add('log_format_errors_total', 'counter', 'Access log records dropped because they could not be formatted.', [({}, stats['log']['formatErrors'])])
+	
+	add('requests_total', 'counter', 'Requests by status code.', [({'code': x}, stats['requests'][x]) for x in sorted(stats['requests'])])
+	add('rule_requests_total', 'counter', 'Requests by redirect rule.', [({'rule': x}, stats['routes']['rules'][x]) for x in sorted(stats['routes']['rules'])])
+	add('target_requests_total', 'counter', 'Requests by selected redirect target.', [({'target': x}, stats['routes']['targets'][x]) for x in sorted(stats['routes']['targets'])])
+	add('bytes_total', 'counter', 'File bytes served by this server or redirected to mirrors.', [({'by': x}, stats['bytes'][x]) for x in ('self', 'redirect')])
+	add('redirect_unknown_size_total', 'counter', 'Redirects of files whose size was not cached.', [({}, stats['bytes']['redirectUnknownSize'])])
+	
+	# ヒストグラム
+	latency = stats['latency']
+	name = prefix + 'request_duration_seconds'
+	lines.append('# HELP %s Request latency.' % name)
+	lines.append('# TYPE %s histogram' % name)
+	
+	for le, count in latency['buckets']:
+		lines.append('%s_bucket{le="%s"} %d' % (name, le, count))
+	
+	lines.append('%s_sum %r' % (name, latency['sum']))
+	lines.append('%s_count %d' % (name, latency['count']))
+	
+	return '\n'.join(lines) + '\n'
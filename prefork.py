@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import errno
+import signal
+
+# 親プロセスのプロセスID (ワーカープロセスが親プロセスの終了を検出するために起動前に記録する)
+_supervisorPid = None
+
+## ワーカープロセス管理クラス
+# 親プロセスは受け取ったシグナルをすべてのワーカープロセスに転送し、異常終了したワーカープロセスを再起動する
+class WorkerSupervisor:
+	## コンストラクタ
+	# @param self
+	# @param num ワーカープロセス数
+	# @param signals ワーカープロセスに転送するシグナルのリスト (SIGTERM, SIGINT は常に終了として転送する)
+	# @param restartDelay 異常終了したワーカープロセスを再起動するまでの時間 (sec)
+	def __init__(self, num, signals, restartDelay = 1):
+		self.num = num
+		self.signals = signals
+		self.restartDelay = restartDelay
+		self.children = {}
+		self.terminating = False
+	
+	## ワーカープロセスの起動
+	# @param self
+	# @param wid ワーカー番号
+	# @return ワーカープロセスか否か
+	def spawn(self, wid):
+		pid = os.fork()
+		
+		if pid == 0:
+			# ワーカープロセスのシグナルハンドラは呼び出し側で設定する
+			for signum in self.signals + [signal.SIGTERM, signal.SIGINT]:
+				signal.signal(signum, signal.SIG_DFL)
+			
+			self.children = {}
+			return True
+		
+		self.children[pid] = wid
+		return False
+	
+	## シグナルの転送
+	# @param self
+	# @param signum シグナル番号
+	# @param frame スタックフレーム
+	def forward(self, signum, frame):
+		if signum in (signal.SIGTERM, signal.SIGINT):
+			self.terminating = True
+			signum = signal.SIGTERM
+		
+		for pid in self.children.keys():
+			try:
+				os.kill(pid, signum)
+			except OSError:
+				pass
+	
+	## ワーカープロセスを起動して監視する
+	# @param self
+	# @return ワーカープロセスではワーカー番号、親プロセスではすべてのワーカープロセスが終了した時に None
+	def start(self):
+		global _supervisorPid
+		_supervisorPid = os.getpid()
+		
+		for signum in self.signals + [signal.SIGTERM, signal.SIGINT]:
+			signal.signal(signum, self.forward)
+		
+		for wid in xrange(self.num):
+			if self.spawn(wid):
+				return wid
+		
+		while len(self.children) > 0:
+			try:
+				pid, status = os.wait()
+			except OSError, e:
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			
+			if pid not in self.children:
+				continue
+			
+			wid = self.children.pop(pid)
+			
+			# 終了中または正常終了
+			if self.terminating or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+				continue
+			
+			# 異常終了したワーカープロセスを再起動
+			time.sleep(self.restartDelay)
+			
+			if not self.terminating and self.spawn(wid):
+				return wid
+		
+		return None
+
+## 親プロセスが稼働中か否か
+# 親プロセスが終了すると init などに引き取られ、getppid は別のプロセスを返す
+# @return 稼働中か否か
+def supervisorAlive():
+	return _supervisorPid is not None and os.getppid() == _supervisorPid
+
+## 親プロセスにシグナルを送ってすべてのワーカープロセスに転送させる
+# 親プロセスが終了している場合は送らない (引き取ったプロセスにシグナルを送らないように)
+# @param signum シグナル番号
+# @return 送ったか否か
+def broadcast(signum):
+	if not supervisorAlive():
+		return False
+	
+	os.kill(_supervisorPid, signum)
+	return True
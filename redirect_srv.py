@@ -16,29 +16,365 @@
 
 import os
 import time
+import fcntl
+import signal
+import errno
+import logging
 import datetime
-import base64
+import threading
+import email.utils
 import tornado.ioloop
 import tornado.web
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
 import fcache
+import fwatch
+import streamio
+import health
+import prefork
 import alog
+import metrics
 import tools
 import config
 
-## 設定ファイルの再読み込み
-def reloadConf():
-	global redirect_table
+## 設定ファイルのパス
+# @return config.py のパス
+def configPath():
+	return os.path.splitext(config.__file__)[0] + '.py'
+
+## 設定ファイルの読み込みと検証 (稼働中の設定は変更しない)
+# IOLoop を止めないよう、再読み込み時は別スレッドで呼び出される
+# @return (設定の辞書, fixed config.REDIRECT_TABLE)
+def loadConf():
+	values = {'__file__': configPath(), '__name__': config.__name__}
+	execfile(configPath(), values)
+	values = dict((k, v) for k, v in values.iteritems() if k.isupper())
+	
+	# 削除された設定があると稼働中に参照できなくなる
+	missing = sorted(k for k in dir(config) if k.isupper() and k not in values)
+	if len(missing) > 0:
+		raise ValueError('Missing settings: %s' % ', '.join(missing))
+	
+	if values['CACHE_STORAGE'] not in ('heap', 'mmap', 'shm'):
+		raise ValueError('Unknown CACHE_STORAGE: %r' % (values['CACHE_STORAGE'],))
+	if values['CACHE_POLICY'] not in ('lru', 'tinylfu', 'gdsf'):
+		raise ValueError('Unknown CACHE_POLICY: %r' % (values['CACHE_POLICY'],))
+	if values['ACCESS_LOG_QUEUE_POLICY'] not in ('block', 'drop_old', 'drop_new'):
+		raise ValueError('Unknown ACCESS_LOG_QUEUE_POLICY: %r' % (values['ACCESS_LOG_QUEUE_POLICY'],))
 	
-	reload(config)
-	redirect_table = tools.fixRedirectTable(config.REDIRECT_TABLE)
+	tools.checkRedirectTable(values['REDIRECT_TABLE'])
+	table = tools.fixRedirectTable(values['REDIRECT_TABLE'], values['ROUTE_CACHE_SIZE'], hchecker.factors())
 	
+	return (values, table)
+
+## 読み込んだ設定の反映 (IOLoop 上で呼び出す)
+# @param values 設定の辞書
+# @param table fixed config.REDIRECT_TABLE
+def applyConf(values, table):
+	global redirect_table, config_checker, fwatcher
+	
+	# 失敗する可能性のあるもの (共有メモリを開くなど) を先に反映し、失敗した場合は何も変更しない
 	afcache.settings(
-		maxfsize=config.CACHE_MAX_FILE_SIZE,
-		maxtotal=config.CACHE_MAX_TOTAL_SIZE,
-		cintval=config.FILE_CHECK_INTERVAL,
-		minTTL=config.MAX_CACHE_TTL,
-		maxTTL=config.MAX_CACHE_TTL
+		maxfsize=values['CACHE_MAX_FILE_SIZE'],
+		maxtotal=values['CACHE_MAX_TOTAL_SIZE'],
+		cintval=values['FILE_CHECK_INTERVAL'],
+		minTTL=values['MIN_CACHE_TTL'],
+		maxTTL=values['MAX_CACHE_TTL'],
+		swr=values['FILE_STALE_WHILE_REVALIDATE'],
+		nreaders=values['CACHE_READ_THREADS'],
+		storage=values['CACHE_STORAGE'],
+		compress=values['CACHE_GZIP'],
+		compressLevel=values['CACHE_GZIP_LEVEL'],
+		compressRatio=values['CACHE_GZIP_MIN_RATIO'],
+		shmPath=values['CACHE_SHM_PATH'],
+		snapshotPath=values['CACHE_SNAPSHOT_PATH'],
+		snapshotEntries=values['CACHE_SNAPSHOT_ENTRIES'],
+		warmup=values['CACHE_WARMUP'],
+		policy=values['CACHE_POLICY'],
+		sketchWidth=values['CACHE_SKETCH_WIDTH']
 	)
+	
+	interval = getattr(config, 'HEALTH_CHECK_INTERVAL', None)
+	config.__dict__.update(values)
+	
+	sreader.settings(nthreads=config.STREAM_READ_THREADS)
+	
+	# 変更のないリダイレクト設定は選択位置を引き継ぐ
+	tools.inheritRedirectSeq(table, redirect_table)
+	redirect_table = table
+	
+	hchecker.settings(
+		interval=config.HEALTH_CHECK_INTERVAL,
+		timeout=config.HEALTH_CHECK_TIMEOUT,
+		path=config.HEALTH_CHECK_PATH,
+		fall=config.HEALTH_CHECK_FALL,
+		latency=config.HEALTH_LATENCY_WEIGHTING
+	)
+	hchecker.setTargets(tools.listRedirectUrls(redirect_table))
+	
+	# 監視の有無が変わった場合は weight の調整比率を作り直す
+	if interval is not None and interval != config.HEALTH_CHECK_INTERVAL:
+		applyHealth()
+	
+	# 先読みするファイル
+	if any(x['preload'] for x in redirect_table['rules']):
+		afcache.prefetch(preloadFiles(redirect_table, config.ROOT_DIR))
+	
+	logFile.settings(
+		checkInterval=config.ACCESS_LOG_FLUSH_INTERVAL,
+		queueSize=config.ACCESS_LOG_QUEUE_SIZE,
+		policy=config.ACCESS_LOG_QUEUE_POLICY,
+		fsyncInterval=config.ACCESS_LOG_FSYNC_INTERVAL
+	)
+	
+	# ファイル更新監視 (ROOT_DIR が変わった場合は作り直す)
+	if os.path.normpath(config.ROOT_DIR) != fwatcher.root:
+		fwatcher.finalize()
+		fwatcher = fwatch.FileWatcher(config.ROOT_DIR, afcache.invalidate, afcache.invalidateAll, afcache.setWatched)
+	
+	if config.FILE_WATCH:
+		fwatcher.initialize()
+	else:
+		fwatcher.finalize()
+	
+	# リダイレクト先の死活監視
+	if config.HEALTH_CHECK_INTERVAL > 0:
+		hchecker.initialize()
+	else:
+		hchecker.finalize()
+	
+	# 設定ファイルの更新監視 (間隔が変わった場合は作り直す)
+	checkTime = config.CONFIG_CHECK_INTERVAL * 1000
+	
+	if config_checker is None or config_checker.callback_time != checkTime:
+		if config_checker is not None:
+			config_checker.stop()
+			config_checker = None
+		
+		if checkTime > 0:
+			config_checker = tornado.ioloop.PeriodicCallback(checkConfFile, checkTime)
+			config_checker.start()
+
+## 設定ファイルの読み込み (起動時)
+def reloadConf():
+	reload_state['mtime'] = os.stat(configPath()).st_mtime
+	applyConf(*loadConf())
+
+## 設定ファイルの再読み込みを要求する
+# 読み込みは別スレッドで行い、成功した場合のみ IOLoop 上で反映する (読み込み中の要求は完了後にまとめて1回行う)
+# @param callback 完了時に IOLoop 上で呼び出されるコールバック (引数は失敗した場合のエラーメッセージ、成功した場合は None)
+def requestReload(callback = None):
+	if reload_state['running']:
+		reload_state['next'].append(callback)
+		return
+	
+	reload_state['running'] = True
+	reload_state['callbacks'] = [callback]
+	
+	th = threading.Thread(target=reloadThread)
+	th.daemon = True
+	th.start()
+
+## 設定ファイルの再読み込みスレッド
+def reloadThread():
+	conf = None
+	error = None
+	
+	# 失敗した場合も同じファイルを繰り返し読み込まないよう、読み込む前に更新日時を記録する
+	try:
+		mtime = os.stat(configPath()).st_mtime
+	except OSError:
+		mtime = reload_state['mtime']
+	
+	try:
+		conf = loadConf()
+	except Exception, e:
+		error = '%s: %s' % (e.__class__.__name__, e)
+	
+	tornado.ioloop.IOLoop.instance().add_callback(lambda: finishReload(conf, error, mtime))
+
+## 設定ファイルの再読み込み完了 (IOLoop 上で呼び出される)
+# @param conf loadConf の戻り値 (失敗した場合は None)
+# @param error エラーメッセージ (成功した場合は None)
+# @param mtime 読み込んだ設定ファイルの更新日時
+def finishReload(conf, error, mtime):
+	reload_state['mtime'] = mtime
+	
+	if conf is not None:
+		try:
+			applyConf(*conf)
+		except Exception, e:
+			error = '%s: %s' % (e.__class__.__name__, e)
+	
+	if error is not None:
+		logging.error('Reload failed. [%s]', error)
+	else:
+		logging.info('Reload succeed.')
+	
+	callbacks = reload_state['callbacks']
+	reload_state['running'] = False
+	
+	for callback in callbacks:
+		if callback is not None:
+			callback(error)
+	
+	# 読み込み中に要求されたもの
+	if len(reload_state['next']) > 0:
+		callbacks = reload_state['next']
+		reload_state['next'] = []
+		requestReload(callbacks[0])
+		reload_state['callbacks'].extend(callbacks[1:])
+
+## 設定ファイルの更新チェック (CONFIG_CHECK_INTERVAL 毎に IOLoop 上で呼び出される)
+def checkConfFile():
+	try:
+		mtime = os.stat(configPath()).st_mtime
+	except OSError:
+		return
+	
+	if mtime != reload_state['mtime'] and not reload_state['running']:
+		requestReload()
+
+# 設定ファイルの再読み込み状態
+reload_state = {'running': False, 'callbacks': [], 'next': [], 'mtime': None}
+
+# 設定ファイルの更新チェック (tornado.ioloop.PeriodicCallback)
+config_checker = None
+
+## 先読みするファイルの列挙 (ファイルキャッシュの先読みスレッドで列挙される)
+# @param redirTable fixed config.REDIRECT_TABLE
+# @param root ROOT_DIR
+# @return ファイル名を列挙するイテレータ
+def preloadFiles(redirTable, root):
+	rules = redirTable['rules']
+	
+	for i, redir in enumerate(rules):
+		# このサーバから送信するものだけ
+		if not redir['preload'] or not any(x['base_url'] == '' for x in redir['to']):
+			continue
+		
+		for wc, ptn in zip(redir['wildcard'], redir['pattern']):
+			for path in tools.walkWildcard(root, wc, ptn):
+				# 先に一致する設定があるものは除く (検索結果の記憶は IOLoop のスレッドでのみ更新するので findRedirect は使わない)
+				if not any(x.match(path) for prev in rules[:i] for x in prev['pattern']):
+					yield os.path.normpath(os.path.join(root, path.lstrip('/')))
+
+## 死活監視の結果をリダイレクト先の選択に反映する
+def applyHealth():
+	tools.applyRedirectFactors(redirect_table, hchecker.factors())
+
+## 管理コマンドとシグナルの対応
+COMMAND_SIGNALS = {'reload': signal.SIGUSR1, 'clear': signal.SIGUSR2, 'exit': signal.SIGTERM}
+
+## 管理コマンドの実行
+# @param cmd コマンド名
+def runCommand(cmd):
+	if cmd == 'reload':
+		requestReload()
+	elif cmd == 'clear':
+		afcache.clear()
+	elif cmd == 'exit':
+		tornado.ioloop.IOLoop.instance().stop()
+
+## 管理コマンドをすべてのワーカープロセスで実行する
+# @param cmd コマンド名
+# @return このプロセスで実行済みか否か (False の場合は各プロセスで非同期に実行される)
+def broadcastCommand(cmd):
+	if worker_id is None:
+		runCommand(cmd)
+		return True
+	
+	# 親プロセスが終了している場合はこのプロセスでのみ実行する
+	if not prefork.broadcast(COMMAND_SIGNALS[cmd]):
+		runCommand(cmd)
+		return True
+	
+	return False
+
+## 親プロセスの監視 (ワーカープロセスのみ)
+# 親プロセスが終了したワーカープロセスは終了する
+def checkSupervisor():
+	if not prefork.supervisorAlive():
+		logging.error('Supervisor process has gone. Exiting worker %d.', worker_id)
+		tornado.ioloop.IOLoop.instance().stop()
+
+## シグナルハンドラ (IOLoop 上で処理させるためパイプに書き込むだけ)
+# @param signum シグナル番号
+# @param frame スタックフレーム
+def onSignal(signum, frame):
+	try:
+		os.write(signal_pipe[1], chr(signum))
+	except OSError:
+		pass
+
+## シグナルの処理
+# @param fd パイプ
+# @param events IOLoop のイベント
+def onSignalPipe(fd, events):
+	for c in os.read(fd, 256):
+		signum = ord(c)
+		
+		if signum == signal.SIGINT:
+			runCommand('exit')
+		
+		if signum == signal.SIGHUP:
+			runCommand('reload')
+		
+		for cmd in COMMAND_SIGNALS:
+			if COMMAND_SIGNALS[cmd] == signum:
+				runCommand(cmd)
+
+## アクセスログの整形 (ログの書き込みスレッドで呼び出される)
+# @param record BaseHandler.finish で作成したログ情報
+# @return (ログファイル名, Combine形式のログ文字列)
+def formatAccessLog(record):
+	global access_log_name
+	
+	tt, remoteIp, auth, method, uri, version, status, contentLength, referer, userAgent, logs = record
+	
+	try:    contentLength = int(contentLength)
+	except: contentLength = 0
+	
+	authInfo = tools.parseBasicAuth(auth)
+	
+	logStr = '%s - %s [%s] "%s %s %s" %d %d "%s" "%s"' % (
+		remoteIp,
+		authInfo[0] if authInfo is not None and authInfo[0] != '' else '-',
+		tools.getApacheLogDatetime(tt),
+		method,
+		uri,
+		version,
+		status,
+		contentLength,
+		referer,
+		userAgent
+	)
+	
+	if len(logs) > 0:
+		logStr += ' "%s"' % ';'.join(logs)
+	
+	# ログファイル名は同じ秒のものは前回の結果を使う
+	sec = int(tt)
+	if access_log_name[0] != sec:
+		logName = datetime.datetime.fromtimestamp(sec).strftime(config.ACCESS_LOG_FILENAME_FORMAT)
+		access_log_name = (sec, os.path.join(config.LOG_DIR, logName))
+	
+	return (access_log_name[1], logStr)
+
+# formatAccessLog の前回のログファイル名 (UNIX時間の秒, ログファイル名)
+access_log_name = (None, '')
+
+## 統計情報の収集
+# @return 統計情報の辞書 (マルチプロセスの場合は応答したワーカープロセスのもの)
+def collectStats():
+	stats = request_metrics.snapshot()
+	stats['pid'] = os.getpid()
+	stats['worker'] = worker_id
+	stats['cache'] = afcache.stats()
+	stats['log'] = logFile.stats()
+	
+	return stats
 
 ## ログ出力付き RequestHandler
 class BaseHandler(tornado.web.RequestHandler):
@@ -55,15 +391,25 @@ class BaseHandler(tornado.web.RequestHandler):
 	def finish(self, chunk=None):
 		ret = tornado.web.RequestHandler.finish(self, chunk)
 		
-		# ログ出力
-		tt = time.time()
-		logStr = self.generateApacheLog(tt)
+		request_metrics.request(self.get_status(), self.request.request_time())
 		
-		if len(self.logs) > 0:
-			logStr += ' "%s"' % ';'.join(self.logs)
+		# ログ出力 (整形は書き込みスレッドで行う)
+		request = self.request
+		headers = request.headers
 		
-		logName = datetime.datetime.fromtimestamp(tt).strftime(config.ACCESS_LOG_FILENAME_FORMAT)
-		logFile.puts(os.path.join(config.LOG_DIR, logName), logStr)
+		logFile.putRecord((
+			time.time(),
+			request.remote_ip,
+			headers.get('Authorization'),
+			request.method,
+			request.uri,
+			request.version,
+			self.get_status(),
+			self._headers.get('Content-Length', 0),
+			headers.get('Referer', ''),
+			headers.get('User-Agent', ''),
+			self.logs
+		))
 		
 		return ret
 	
@@ -71,19 +417,7 @@ class BaseHandler(tornado.web.RequestHandler):
 	# @param self
 	# @return (ユーザ名, パスワード) 失敗した場合は None
 	def getBasicAuthInfo(self):
-		try:
-			auth = self.request.headers['Authorization'].split(' ')
-			if auth[0] == 'Basic' and len(auth) == 2:
-				try:
-					info =  base64.b64decode(auth[1]).split(':')
-					if len(info) == 2:
-						return (info[0].strip(), info[1].strip())
-				except TypeError:
-					pass
-		except KeyError:
-			pass
-		
-		return None
+		return tools.parseBasicAuth(self.request.headers.get('Authorization'))
 	
 	## BASIC認証を行う
 	# @param self
@@ -100,88 +434,383 @@ class BaseHandler(tornado.web.RequestHandler):
 		self.set_header('WWW-Authenticate', 'Basic realm="%s"' % realm)
 		
 		return False
-	
-	## Combine形式のログを作成すする
-	# @param self
-	# @param tt UNIX時間
-	# @return ログ文字列
-	def generateApacheLog(self, tt):
-		try:    contentLength = int(self._headers['Content-Length'])
-		except: contentLength = 0
-		try:    referer = self.request.headers['Referer']
-		except: referer = ''
-		try:    userAgent = self.request.headers['User-Agent']
-		except: userAgent = ''
-		
-		authInfo = self.getBasicAuthInfo()
-		
-		return '%s - %s [%s] "%s %s %s" %d %d "%s" "%s"' % (
-			self.request.remote_ip,
-			authInfo[0] if authInfo is not None and authInfo[0] != '' else '-',
-			tools.getApacheLogDatetime(tt),
-			self.request.method,
-			self.request.uri,
-			self.request.version,
-			self.get_status(),
-			contentLength,
-			referer,
-			userAgent
-		)
 
 ## 制御リクエストハンドラ
 class ControlHandler(BaseHandler):
 	## GET
 	# @param self
+	@tornado.web.asynchronous
 	def get(self):
 		judge = lambda info: info[0] == config.ADMIN_USERID and info[1] == config.ADMIN_PASSWD
 		
-		# 設定再読込
+		# 設定再読込 (マルチプロセスでない場合は完了を待って結果を返す)
 		if self.request.path == '/!reload':
 			if self.basicAuth('Admin only', judge):
-				reloadConf()
-				self.write('Reload succeed. (%s)' % tools.getApacheLogDatetime(time.time()))
+				if worker_id is None:
+					requestReload(self.onReload)
+					return
+				
+				broadcastCommand('reload')
+				self.write('Reload requested to all workers. (%s)' % tools.getApacheLogDatetime(time.time()))
 		
 		# キャッシュクリア
 		if self.request.path == '/!clear':
 			if self.basicAuth('Admin only', judge):
-				afcache.clear()
-				self.write('Cache clear succeed. (%s)' % tools.getApacheLogDatetime(time.time()))
+				if broadcastCommand('clear'):
+					self.write('Cache clear succeed. (%s)' % tools.getApacheLogDatetime(time.time()))
+				else:
+					self.write('Cache clear requested to all workers. (%s)' % tools.getApacheLogDatetime(time.time()))
+		
+		# リダイレクト先の死活監視状態
+		if self.request.path == '/!health':
+			if self.basicAuth('Admin only', judge):
+				self.write({
+					'targets': hchecker.getStatus(),
+					'rules': [{'pattern': x['wildcard'], 'weights': x['seq'][False]['targets']} for x in redirect_table['rules']]
+				})
+		
+		# 統計情報 (?format=prometheus の場合は Prometheus のテキスト形式)
+		if self.request.path == '/!stats':
+			if self.basicAuth('Admin only', judge):
+				stats = collectStats()
+				
+				if self.get_argument('format', 'json') == 'prometheus':
+					self.set_header('Content-Type', 'text/plain; version=0.0.4')
+					self.write(metrics.formatPrometheus(stats))
+				else:
+					self.write(stats)
 		
 		# 終了
 		if self.request.path == '/!exit':
 			if self.basicAuth('Admin only', judge):
-				tornado.ioloop.IOLoop.instance().stop()
+				broadcastCommand('exit')
+		
+		self.finish()
+	
+	## 設定再読込の完了
+	# @param self
+	# @param error エラーメッセージ (成功した場合は None)
+	def onReload(self, error):
+		if error is None:
+			self.write('Reload succeed. (%s)' % tools.getApacheLogDatetime(time.time()))
+		else:
+			self.set_status(500)
+			self.write('Reload failed. [%s] (%s)' % (error, tools.getApacheLogDatetime(time.time())))
+		
+		self.finish()
 
 ## 通常リクエストハンドラ
 class MainHandler(BaseHandler):
+	## コンストラクタ
+	# @param self
+	def __init__(self, *args, **kwargs):
+		BaseHandler.__init__(self, *args, **kwargs)
+		self.redir = None
+		self.stream = None
+	
+	## ファイル送信用ヘッダの設定
+	# @param self
+	# @param path ファイルパス
+	# @param mtime 更新日時 (UNIX時間)
+	# @param etag ETag
+	def setFileHeaders(self, path, mtime, etag):
+		self.set_header('Content-Type', 'application/octet-stream')
+		self.set_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(path))
+		self.set_header('Content-Transfer-Encoding', 'binary')
+		self.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(int(mtime)))
+		self.set_header('Etag', etag)
+		
+		# キャッシュ制御 (REDIRECT_TABLE の cache_control が未指定の場合は毎回再検証させる)
+		if self.redir is None or self.redir['cache_control'] is None:
+			self.set_header('Expires', 0)
+			self.set_header('Cache-Control', 'must-revalidate, post-check=0, pre-check=0')
+			self.set_header('Pragma', 'public')
+		else:
+			self.set_header('Cache-Control', self.redir['cache_control'])
+		
+		# 圧縮データを送信する場合があるのでプロキシに伝える
+		if config.CACHE_GZIP:
+			self.set_header('Vary', 'Accept-Encoding')
+	
+	## gzip 圧縮データを受け付けるか否か
+	# @param self
+	# @return 受け付けるか否か
+	def acceptGzip(self):
+		for coding in self.request.headers.get('Accept-Encoding', '').split(','):
+			coding = [x.strip() for x in coding.split(';')]
+			
+			if coding[0].lower() == 'gzip':
+				# q=0 は拒否を意味する
+				return not ('q=0' in coding or 'q=0.0' in coding)
+		
+		return False
+	
+	## 条件付きリクエストの判定
+	# @param self
+	# @param mtime 更新日時 (UNIX時間)
+	# @param etag ETag
+	# @return ファイルが更新されていないか否か
+	def notModified(self, mtime, etag):
+		# If-None-Match が優先される
+		inm = self.request.headers.get('If-None-Match')
+		if inm is not None:
+			tags = [x.strip() for x in inm.split(',')]
+			return '*' in tags or etag in tags or ('W/' + etag) in tags
+		
+		ims = self.request.headers.get('If-Modified-Since')
+		if ims is not None:
+			ims = email.utils.parsedate_tz(ims)
+			if ims is not None:
+				return int(mtime) <= email.utils.mktime_tz(ims)
+		
+		return False
+	
 	## ファイル読み込み・書き出し処理
 	# @param self
 	# @param path ファイルパス
 	def getFile(self, path):
+		# 読み込み待ちの間に切断された
+		if self.request.connection.stream.closed():
+			return
+		
 		try:
 			# ファイル書き出し
-			data = afcache.get(path)
-			if data is not None:
-				self.set_header('Content-Type', 'application/octet-stream')
-				self.set_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(path))
-				self.set_header('Content-Transfer-Encoding', 'binary')
-				self.set_header('Expires', 0)
-				self.set_header('Cache-Control', 'must-revalidate, post-check=0, pre-check=0')
-				self.set_header('Pragma', 'public')
-				self.write(data)
-				self.finish()
-			else:
+			data, mtime, etag, gzipped = afcache.lookup(path, lambda: self.getFile(path), self.acceptGzip())
+			if data is None:
 				# ファイルが見つからない
 				self.set_status(404)
 				self.finish()
+			else:
+				self.setFileHeaders(path, mtime, etag)
+				
+				if gzipped:
+					self.set_header('Content-Encoding', 'gzip')
+				
+				if self.notModified(mtime, etag):
+					# 更新されていない
+					self.set_status(304)
+					self.finish()
+				elif isinstance(data, str):
+					request_metrics.served(len(data))
+					self.write(data)
+					self.finish()
+				else:
+					# mmap されたデータは分割してコピーしながら送信
+					self.stream = {'file': False, 'fp': None, 'data': data, 'offset': 0, 'remain': len(data), 'busy': False}
+					self.beginStream()
 		except fcache.Queried:
-			# ファイル読込中リトライ
-			tornado.ioloop.IOLoop.instance().add_callback(lambda: self.getFile(path))
+			# ファイル読込中 (読み込み完了後に再度呼び出される)
+			pass
+		except fcache.TooLarge, e:
+			# キャッシュできない大きさのファイルは分割送信する
+			if not self.startStream(path, e.msg):
+				self.logs.append('[WARN] Cache error. [%s] (%s)' % (e.msg, path))
+				self.getRequest(True)
 		except fcache.Error, e:
-			# ファイルサイズ制限超過などのエラー
+			# 最大総キャッシュサイズ超過などのエラー
 			self.logs.append('[WARN] Cache error. [%s] (%s)' % (e.msg, path))
 			self.getRequest(True)
 	
+	## 分割送信開始 (ファイルは読み込みスレッドで開き、完了後に openStream が呼び出される)
+	# @param self
+	# @param path ファイルパス
+	# @param msg ファイルを開けなかった場合に記録するエラーメッセージ
+	# @return 分割送信を開始したか否か (False の場合はリダイレクトする)
+	def startStream(self, path, msg):
+		global stream_count
+		
+		# 同時送信数の上限に達している
+		if stream_count >= config.STREAM_MAX_CONNECTIONS:
+			return False
+		
+		stream_count += 1
+		stream = {'file': True, 'fp': None, 'data': None, 'offset': 0, 'remain': 0, 'busy': True}
+		self.stream = stream
+		sreader.submit(streamio.openFile, (path,), lambda ret, error: self.openStream(stream, path, msg, ret, error))
+		
+		return True
+	
+	## ファイルを開いた後の処理
+	# @param self
+	# @param stream 分割送信の状態
+	# @param path ファイルパス
+	# @param msg ファイルを開けなかった場合に記録するエラーメッセージ
+	# @param ret (ファイルオブジェクト, os.fstat の結果)
+	# @param error 開けなかった場合の例外
+	def openStream(self, stream, path, msg, ret, error):
+		if not self.doneBusy(stream):
+			if ret is not None:
+				ret[0].close()
+			return
+		
+		if error is not None:
+			# 開けない場合はリダイレクト
+			self.closeStream()
+			self.logs.append('[WARN] Cache error. [%s] (%s)' % (msg, path))
+			self.getRequest(True)
+			return
+		
+		fp, fstat = ret
+		stream['fp'] = fp
+		stream['remain'] = fstat.st_size
+		
+		etag = fcache.makeEtag(fstat.st_mtime, fstat.st_size)
+		self.setFileHeaders(path, fstat.st_mtime, etag)
+		
+		if self.notModified(fstat.st_mtime, etag):
+			# 更新されていない
+			self.closeStream()
+			self.set_status(304)
+			self.finish()
+			return
+		
+		self.beginStream()
+	
+	## 読み込みスレッドの処理完了
+	# 処理中に切断された場合、ファイルは処理の完了後にここで閉じる
+	# @param self
+	# @param stream 分割送信の状態
+	# @return 分割送信を続けるか否か
+	def doneBusy(self, stream):
+		stream['busy'] = False
+		
+		if self.stream is not stream:
+			if stream['fp'] is not None:
+				stream['fp'].close()
+			return False
+		
+		return True
+	
+	## 分割送信開始
+	# @param self
+	def beginStream(self):
+		self.set_header('Content-Length', self.stream['remain'])
+		request_metrics.served(self.stream['remain'])
+		
+		if self.stream['fp'] is not None and config.SENDFILE_ENABLE and tools.sendfileAvailable():
+			# ヘッダの送信完了後に sendfile で送信
+			self.flush(callback=self.sendStreamFile)
+		else:
+			self.sendStream()
+	
+	## 分割送信 (送信済みのデータがソケットに書き込まれる毎に呼び出される)
+	# @param self
+	def sendStream(self):
+		stream = self.stream
+		if stream is None:
+			return
+		
+		size = min(config.STREAM_BUFFER_SIZE, stream['remain'])
+		
+		if stream['fp'] is not None:
+			# ファイルは読み込みスレッドで読み込み、完了後に sendChunk が呼び出される
+			stream['busy'] = True
+			sreader.submit(stream['fp'].read, (size,), lambda data, error: self.sendChunk(stream, data, error))
+		else:
+			self.sendChunk(stream, stream['data'][stream['offset']:stream['offset'] + size], None)
+	
+	## 読み込んだデータの送信
+	# @param self
+	# @param stream 分割送信の状態
+	# @param data 読み込んだデータ
+	# @param error 読み込めなかった場合の例外
+	def sendChunk(self, stream, data, error):
+		if stream['fp'] is not None and not self.doneBusy(stream):
+			return
+		
+		if error is not None:
+			# 送信途中のエラーは切断する
+			self.logs.append('[ERROR] Read failed while streaming. (%s)' % error)
+			self.request.connection.stream.close()
+			return
+		
+		stream['offset'] += len(data)
+		stream['remain'] -= len(data)
+		
+		if len(data) > 0:
+			self.write(data)
+		
+		if len(data) == 0 or stream['remain'] <= 0:
+			self.endStream()
+		else:
+			self.flush(callback=self.sendStream)
+	
+	## sendfile による分割送信
+	# @param self
+	def sendStreamFile(self):
+		if self.stream is None:
+			return
+		
+		try:
+			sent = tools.sendfile(
+				self.request.connection.stream.socket.fileno(),
+				self.stream['fp'].fileno(),
+				self.stream['offset'],
+				self.stream['remain']
+			)
+		except OSError, e:
+			if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+				# 送信バッファが空くまで待つ (少量のデータを通常の方法で送信し、その完了を待つ)
+				self.stream['fp'].seek(self.stream['offset'])
+				data = self.stream['fp'].read(min(4096, self.stream['remain']))
+				self.stream['offset'] += len(data)
+				self.stream['remain'] -= len(data)
+				
+				self.write(data)
+				
+				if len(data) == 0 or self.stream['remain'] <= 0:
+					self.endStream()
+				else:
+					self.flush(callback=self.sendStreamFile)
+			elif self.stream['offset'] == 0:
+				# sendfile が使えない場合は通常の分割送信に切り替える
+				self.logs.append('[WARN] sendfile failed, fall back to buffered. (%s)' % e.strerror)
+				self.sendStream()
+			else:
+				# 送信途中のエラーは切断する
+				self.logs.append('[ERROR] sendfile failed. (%s)' % e.strerror)
+				self.request.connection.stream.close()
+			return
+		
+		self.stream['offset'] += sent
+		self.stream['remain'] -= sent
+		
+		if sent == 0 or self.stream['remain'] <= 0:
+			self.endStream()
+		else:
+			tornado.ioloop.IOLoop.instance().add_callback(self.sendStreamFile)
+	
+	## 分割送信完了
+	# @param self
+	def endStream(self):
+		# ファイルが縮んだ場合もここで打ち切る
+		if self.stream['remain'] > 0:
+			self.logs.append('[WARN] File truncated while streaming. (%s)' % self.request.path)
+		
+		self.closeStream()
+		self.finish()
+	
+	## 分割送信終了
+	# @param self
+	def closeStream(self):
+		global stream_count
+		
+		if self.stream is not None:
+			# mmap されたデータはキャッシュと共有しているので閉じない
+			if self.stream['file']:
+				stream_count -= 1
+			
+			# 読み込みスレッドで処理中のファイルは処理の完了後に閉じる
+			if self.stream['fp'] is not None and not self.stream['busy']:
+				self.stream['fp'].close()
+			
+			self.stream = None
+	
+	## 切断時の処理
+	# @param self
+	def on_connection_close(self):
+		self.closeStream()
+	
 	## GET処理本体
 	# @param self
 	# @param disableSelfHost このサーバからのファイル転送を無効化する
@@ -194,7 +823,12 @@ class MainHandler(BaseHandler):
 			return
 		
 		# リダイレクト先決定
-		baseUrl = tools.selRedirectTo(self.request.path, redirect_table, disableSelfHost)
+		self.redir = tools.findRedirect(self.request.path, redirect_table)
+		baseUrl = tools.selRedirectToByRule(self.redir, self.request.path, disableSelfHost) if self.redir is not None else None
+		
+		if baseUrl is not None:
+			request_metrics.route(','.join(self.redir['wildcard']), baseUrl)
+		
 		if baseUrl is None:
 			# リダイレクト先が見つからない
 			self.logs.append('[ERROR] Not redirect anywhere. (%s)' % self.request.path)
@@ -202,10 +836,12 @@ class MainHandler(BaseHandler):
 			self.finish()
 		elif baseUrl == '':
 			# ファイル送信
-			path = os.path.join(config.ROOT_DIR.replace('/', '\\'), self.request.path.replace('/', '\\').lstrip('\\'))
+			path = os.path.normpath(os.path.join(config.ROOT_DIR, self.request.path.lstrip('/')))
 			self.getFile(path)
 		else:
-			# リダイレクト
+			# リダイレクト (ファイルサイズはキャッシュ済みの場合のみ集計する)
+			request_metrics.redirected(afcache.peekSize(os.path.normpath(os.path.join(config.ROOT_DIR, self.request.path.lstrip('/')))))
+			
 			url = baseUrl.rstrip('/') + self.request.path
 			self.logs.append('[INFO] Redirect to: %s' % url)
 			self.redirect(url)
@@ -222,24 +858,93 @@ if __name__ == "__main__":
 		(r"/!.*", ControlHandler),
 		(r".*", MainHandler),
 	])
-
-	logFile = alog.AsyncLogWriter()
+	
+	sockets = tornado.netutil.bind_sockets(config.SERVER_PORT)
+	
+	# マルチプロセス化 (IOLoop やスレッドはワーカープロセスで作成する)
+	worker_id = None
+	
+	if config.SERVER_PROCESSES != 1:
+		supervisor = prefork.WorkerSupervisor(config.SERVER_PROCESSES or tornado.process.cpu_count(), [signal.SIGUSR1, signal.SIGUSR2, signal.SIGHUP])
+		worker_id = supervisor.start()
+		
+		# すべてのワーカープロセスが終了した
+		if worker_id is None:
+			raise SystemExit(0)
+	
+	# シグナルは IOLoop 上で処理する
+	signal_pipe = os.pipe()
+	
+	for fd in signal_pipe:
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+	
+	tornado.ioloop.IOLoop.instance().add_handler(signal_pipe[0], onSignalPipe, tornado.ioloop.IOLoop.READ)
+	
+	for signum in COMMAND_SIGNALS.values() + [signal.SIGINT, signal.SIGHUP]:
+		signal.signal(signum, onSignal)
+	
+	logFile = alog.AsyncLogWriter(
+		formatter=formatAccessLog,
+		checkInterval=config.ACCESS_LOG_FLUSH_INTERVAL,
+		queueSize=config.ACCESS_LOG_QUEUE_SIZE,
+		policy=config.ACCESS_LOG_QUEUE_POLICY,
+		fsyncInterval=config.ACCESS_LOG_FSYNC_INTERVAL
+	)
 	logFile.initialize()
 	
 	afcache = fcache.AyncFileCache(
 		maxfsize=config.CACHE_MAX_FILE_SIZE,
 		maxtotal=config.CACHE_MAX_TOTAL_SIZE,
 		cintval=config.FILE_CHECK_INTERVAL,
-		minTTL=config.MAX_CACHE_TTL,
-		maxTTL=config.MAX_CACHE_TTL
+		minTTL=config.MIN_CACHE_TTL,
+		maxTTL=config.MAX_CACHE_TTL,
+		swr=config.FILE_STALE_WHILE_REVALIDATE,
+		nreaders=config.CACHE_READ_THREADS,
+		storage=config.CACHE_STORAGE,
+		compress=config.CACHE_GZIP,
+		compressLevel=config.CACHE_GZIP_LEVEL,
+		compressRatio=config.CACHE_GZIP_MIN_RATIO,
+		shmPath=config.CACHE_SHM_PATH,
+		snapshotPath=config.CACHE_SNAPSHOT_PATH,
+		snapshotEntries=config.CACHE_SNAPSHOT_ENTRIES,
+		warmup=config.CACHE_WARMUP,
+		policy=config.CACHE_POLICY,
+		sketchWidth=config.CACHE_SKETCH_WIDTH,
+		dispatch=tornado.ioloop.IOLoop.instance().add_callback
 	)
 	afcache.initialize()
 	
+	sreader = streamio.StreamReader(
+		nthreads=config.STREAM_READ_THREADS,
+		dispatch=tornado.ioloop.IOLoop.instance().add_callback
+	)
+	sreader.initialize()
+	
+	fwatcher = fwatch.FileWatcher(config.ROOT_DIR, afcache.invalidate, afcache.invalidateAll, afcache.setWatched)
+	
+	hchecker = health.HealthChecker(
+		interval=config.HEALTH_CHECK_INTERVAL,
+		timeout=config.HEALTH_CHECK_TIMEOUT,
+		path=config.HEALTH_CHECK_PATH,
+		fall=config.HEALTH_CHECK_FALL,
+		latency=config.HEALTH_LATENCY_WEIGHTING,
+		onUpdate=lambda: tornado.ioloop.IOLoop.instance().add_callback(applyHealth)
+	)
+	
 	redirect_table = {}
+	stream_count = 0
+	request_metrics = metrics.Metrics()
 	reloadConf()
 	
-	application.listen(config.SERVER_PORT)
+	if worker_id is not None:
+		tornado.ioloop.PeriodicCallback(checkSupervisor, 1000).start()
+	
+	server = tornado.httpserver.HTTPServer(application)
+	server.add_sockets(sockets)
 	tornado.ioloop.IOLoop.instance().start()
 	
+	hchecker.finalize()
+	fwatcher.finalize()
+	sreader.finalize()
 	afcache.finalize()
 	logFile.finalize()
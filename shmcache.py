@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import mmap
+import stat
+import errno
+import fcntl
+import struct
+import hashlib
+import threading
+
+# 共有メモリの識別子
+MAGIC = 'RSHMC001'
+
+# ヘッダ (識別子, スロット数, 予備, データ領域サイズ, 書き込み位置)
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_HEAD_OFFSET = 24
+
+# スロット (シーケンス番号, キーのハッシュ, 更新日時, サイズ, 書き込み位置)
+SLOT = struct.Struct('<Q16sdQQ')
+SLOT_SEQ = struct.Struct('<Q')
+
+# 同じハッシュ値から探すスロット数
+PROBES = 8
+
+## 共有メモリ上のキャッシュデータ
+class SharedData:
+	## コンストラクタ
+	# @param self
+	# @param segment 共有メモリ
+	# @param start 書き込み位置
+	# @param size サイズ (byte)
+	def __init__(self, segment, start, size):
+		self.segment = segment
+		self.start = start
+		self.size = size
+	
+	## サイズ
+	# @param self
+	# @return サイズ (byte)
+	def __len__(self):
+		return self.size
+	
+	## データの取り出し
+	# @param self
+	# @return データ (他のデータに上書きされた場合は None)
+	def read(self):
+		return self.segment.read(self.start, self.size)
+
+## 複数プロセスで共有するキャッシュ領域
+# データ領域はリングバッファで、古いデータから上書きされる
+# 書き込みはファイルロックで排他し、読み込みはロックせずに書き込み位置とシーケンス番号で整合性を確認する
+class SharedSegment:
+	## コンストラクタ
+	# @param self
+	# @param path 共有メモリのファイル名 (/dev/shm 上のファイルを指定する)
+	# @param size データ領域サイズ (byte) (既に作成済みの場合はそのサイズを使用する)
+	def __init__(self, path, size):
+		self.path = path
+		self.lock = threading.Lock()
+		self.closed = False
+		
+		# 他のユーザが置いたシンボリックリンクやファイルは使用しない (切り詰めや偽のデータの送信を防ぐ)
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+		
+		try:
+			st = os.fstat(self.fd)
+			
+			if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0077:
+				raise OSError(errno.EPERM, 'Shared memory file must be a regular file owned by this user with mode 0600', path)
+			
+			fcntl.lockf(self.fd, fcntl.LOCK_EX)
+			
+			try:
+				header = os.read(self.fd, HEADER.size)
+				
+				if len(header) == HEADER.size and header[:len(MAGIC)] == MAGIC:
+					# 作成済み
+					magic, self.nslots, pad, self.arena, head = HEADER.unpack(header)
+				else:
+					# 新規作成 (スロットは 2KB 毎に1つ)
+					self.nslots = max(1024, size // 2048)
+					self.arena = size
+					os.ftruncate(self.fd, 0)
+					os.ftruncate(self.fd, HEADER.size + SLOT.size * self.nslots + self.arena)
+					os.lseek(self.fd, 0, os.SEEK_SET)
+					os.write(self.fd, HEADER.pack(MAGIC, self.nslots, 0, self.arena, 0))
+			finally:
+				fcntl.lockf(self.fd, fcntl.LOCK_UN)
+			
+			self.base = HEADER.size + SLOT.size * self.nslots
+			self.mm = mmap.mmap(self.fd, self.base + self.arena)
+		except:
+			os.close(self.fd)
+			raise
+	
+	## 終了処理
+	# 閉じた後は読み込みや検索で見つからず、登録もしない (他のスレッドが使用中でもよい)
+	# @param self
+	def close(self):
+		with self.lock:
+			if self.closed:
+				return
+			
+			self.closed = True
+			self.mm.close()
+			os.close(self.fd)
+	
+	## 現在の書き込み位置
+	# @param self
+	# @return 書き込み位置 (データ領域を周回しても増え続ける)
+	def head(self):
+		return struct.unpack_from('<Q', self.mm, HEADER_HEAD_OFFSET)[0]
+	
+	## 使用量の取得
+	# @param self
+	# @return (使用中のサイズ, データ領域サイズ)
+	def usage(self):
+		return (min(self.head(), self.arena), self.arena)
+	
+	## スロットの読み込み
+	# @param self
+	# @param i スロット番号
+	# @return (キーのハッシュ, 更新日時, サイズ, 書き込み位置) (書き込み中の場合は None)
+	def readSlot(self, i):
+		offset = HEADER.size + SLOT.size * i
+		
+		for n in xrange(100):
+			seq, keyhash, mtime, size, start = SLOT.unpack_from(self.mm, offset)
+			
+			# 書き込み中でなく、読み込み中に更新されていなければ有効
+			if seq & 1 == 0 and SLOT_SEQ.unpack_from(self.mm, offset)[0] == seq:
+				return (keyhash, mtime, size, start) if seq > 0 else None
+		
+		return None
+	
+	## スロットの書き込み (ロック中に呼び出す)
+	# @param self
+	# @param i スロット番号
+	# @param keyhash キーのハッシュ
+	# @param mtime 更新日時 (UNIX時間)
+	# @param size サイズ (byte)
+	# @param start 書き込み位置
+	def writeSlot(self, i, keyhash, mtime, size, start):
+		offset = HEADER.size + SLOT.size * i
+		seq = SLOT_SEQ.unpack_from(self.mm, offset)[0]
+		
+		SLOT_SEQ.pack_into(self.mm, offset, seq + 1)
+		SLOT.pack_into(self.mm, offset, seq + 1, keyhash, mtime, size, start)
+		SLOT_SEQ.pack_into(self.mm, offset, seq + 2)
+	
+	## キーに対応するスロット番号を列挙
+	# @param self
+	# @param keyhash キーのハッシュ
+	# @return スロット番号のリスト
+	def probe(self, keyhash):
+		i = struct.unpack_from('<Q', keyhash)[0] % self.nslots
+		return [(i + n) % self.nslots for n in xrange(min(PROBES, self.nslots))]
+	
+	## データの取り出し
+	# @param self
+	# @param start 書き込み位置
+	# @param size サイズ (byte)
+	# @return データ (他のデータに上書きされた場合は None)
+	def read(self, start, size):
+		if self.closed:
+			return None
+		
+		pos = self.base + start % self.arena
+		
+		try:
+			data = self.mm[pos:pos + size]
+			
+			# コピー後に上書きされていないか確認
+			if start < self.head() - self.arena:
+				return None
+		except ValueError:
+			# 読み込み中に閉じられた
+			return None
+		
+		return data
+	
+	## データの検索
+	# @param self
+	# @param key キー
+	# @param mtime 更新日時 (UNIX時間)
+	# @param size サイズ (byte) (None の場合は確認しない)
+	# @return SharedData (見つからない場合は None)
+	def find(self, key, mtime, size = None):
+		keyhash = hashlib.md5(key).digest()
+		
+		try:
+			for i in self.probe(keyhash):
+				if self.closed:
+					break
+				
+				slot = self.readSlot(i)
+				
+				if slot is not None and slot[0] == keyhash and slot[1] == mtime and (size is None or slot[2] == size):
+					if slot[3] >= self.head() - self.arena:
+						return SharedData(self, slot[3], slot[2])
+		except ValueError:
+			# 検索中に閉じられた
+			pass
+		
+		return None
+	
+	## データの登録
+	# @param self
+	# @param key キー
+	# @param mtime 更新日時 (UNIX時間)
+	# @param data データ
+	# @return SharedData (データ領域より大きい場合と閉じた後は None)
+	def put(self, key, mtime, data):
+		size = len(data)
+		
+		if size > self.arena:
+			return None
+		
+		keyhash = hashlib.md5(key).digest()
+		
+		with self.lock:
+			if self.closed:
+				return None
+			
+			fcntl.lockf(self.fd, fcntl.LOCK_EX)
+			
+			try:
+				# データ領域の末尾をまたぐ場合は先頭から書き込む
+				start = self.head()
+				if start % self.arena + size > self.arena:
+					start += self.arena - start % self.arena
+				
+				# 上書きされる領域を読み込み中のプロセスが検出できるよう、先に書き込み位置を進める
+				struct.pack_into('<Q', self.mm, HEADER_HEAD_OFFSET, start + size)
+				
+				pos = self.base + start % self.arena
+				self.mm[pos:pos + size] = data[:]
+				
+				# 同じキー、空き、最も古いものの順にスロットを選ぶ
+				limit = start + size - self.arena
+				target = None
+				oldest = None
+				
+				for i in self.probe(keyhash):
+					slot = self.readSlot(i)
+					
+					if slot is None or slot[0] == keyhash or slot[3] < limit:
+						target = i
+						break
+					
+					if oldest is None or slot[3] < oldest[1]:
+						oldest = (i, slot[3])
+				
+				if target is None:
+					target = oldest[0]
+				
+				self.writeSlot(target, keyhash, mtime, size, start)
+			finally:
+				fcntl.lockf(self.fd, fcntl.LOCK_UN)
+		
+		return SharedData(self, start, size)
+	
+	## すべてのデータを無効化
+	# @param self
+	def clear(self):
+		with self.lock:
+			if self.closed:
+				return
+			
+			fcntl.lockf(self.fd, fcntl.LOCK_EX)
+			
+			try:
+				# 書き込み位置を1周進める
+				head = self.head()
+				struct.pack_into('<Q', self.mm, HEADER_HEAD_OFFSET, head + self.arena + (self.arena - head % self.arena))
+			finally:
+				fcntl.lockf(self.fd, fcntl.LOCK_UN)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 mosamosa (pcyp4g@gmail.com)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import Queue
+import threading
+
+## ファイルを開く
+# @param path ファイルパス
+# @return (ファイルオブジェクト, os.fstat の結果)
+def openFile(path):
+	fp = open(path, 'rb')
+	
+	try:
+		return (fp, os.fstat(fp.fileno()))
+	except:
+		fp.close()
+		raise
+
+## 分割送信のファイル読み込みクラス
+# ディスクの待ち時間で IOLoop を止めないよう、ファイルを開く処理と読み込みを別スレッドで行い、
+# 結果を dispatch 経由で IOLoop 上のコールバックに渡す
+class StreamReader:
+	## コンストラクタ
+	# @param self
+	# @param nthreads 読み込みスレッド数
+	# @param dispatch コールバックの呼び出し関数 (None の場合は読み込みスレッドから直接呼び出す)
+	def __init__(self, nthreads, dispatch = None):
+		self.dispatch = dispatch
+		self.lock = threading.RLock()
+		self.qRead = Queue.Queue()
+		self.thReadTerminate = False
+		self.thReads = []
+		self.thRetired = []
+		self.settings(nthreads)
+	
+	## 設定
+	# @param self
+	# @param nthreads 読み込みスレッド数
+	def settings(self, nthreads = None):
+		if nthreads is not None:
+			self.nthreads = max(1, nthreads)
+			
+			if len(self.thReads) > 0:
+				self.resize()
+	
+	## 初期化処理
+	# @param self
+	def initialize(self):
+		if len(self.thReads) == 0:
+			self.thReadTerminate = False
+			self.resize()
+	
+	## 終了処理
+	# @param self
+	def finalize(self):
+		self.thReadTerminate = True
+		
+		for th in self.thReads + self.thRetired:
+			if th.isAlive():
+				th.join()
+		
+		self.thReads = []
+		self.thRetired = []
+	
+	## 読み込みスレッド数の変更
+	# @param self
+	def resize(self):
+		with self.lock:
+			self.thRetired = [th for th in self.thRetired if th.isAlive()]
+			
+			# 不足分を起動
+			while len(self.thReads) < self.nthreads:
+				th = threading.Thread(target=StreamReader.readThread, args=(self,))
+				self.thReads.append(th)
+				th.start()
+			
+			# 超過分は処理の区切りで終了させる
+			while len(self.thReads) > self.nthreads:
+				self.thRetired.append(self.thReads.pop())
+	
+	## 読み込みの依頼
+	# @param self
+	# @param func 読み込みスレッドで実行する関数
+	# @param args 引数のタプル
+	# @param callback 完了時に (戻り値, 例外) を引数に呼び出されるコールバック (成功時の例外は None)
+	def submit(self, func, args, callback):
+		self.qRead.put((func, args, callback))
+	
+	## 読み込みスレッド
+	# @param self
+	@staticmethod
+	def readThread(self):
+		th = threading.currentThread()
+		
+		while not self.thReadTerminate and th in self.thReads:
+			try:
+				func, args, callback = self.qRead.get(timeout=0.1)
+			except Queue.Empty:
+				continue
+			
+			try:
+				ret = (func(*args), None)
+			except Exception, e:
+				ret = (None, e)
+			
+			if self.dispatch is not None:
+				self.dispatch(lambda ret=ret, callback=callback: callback(*ret))
+			else:
+				callback(*ret)
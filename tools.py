@@ -14,10 +14,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
 import re
+import sys
 import copy
+import math
 import time
+import struct
+import base64
+import hashlib
+import errno
+import ctypes
+import fractions
 import datetime
+import collections
 import locale
 
 # for getApacheLogDatetime function
@@ -75,85 +85,380 @@ NativeTZ = createNativeTZ('NativeTZ')
 # @param timestamp UNIX時間
 # @return タイムスタンプ文字列
 def getApacheLogDatetime(timestamp = None):
+	global _apacheLogDatetime
+	
 	if timestamp is None:
 		timestamp = time.time()
 	
-	dt = datetime.datetime.fromtimestamp(timestamp, NativeTZ())
+	# 同じ秒のものは前回の結果を使う
+	sec = int(timestamp)
+	memo = _apacheLogDatetime
+	
+	if memo[0] == sec:
+		return memo[1]
+	
+	dt = datetime.datetime.fromtimestamp(sec, NativeTZ())
+	ret = dt.strftime('%d/%b/%Y:%H:%M:%S %z')
+	_apacheLogDatetime = (sec, ret)
+	
+	return ret
+
+# getApacheLogDatetime の前回の結果 (UNIX時間の秒, タイムスタンプ文字列)
+_apacheLogDatetime = (None, '')
+
+## BASIC認証の Authorization ヘッダを解析する
+# @param auth Authorization ヘッダ (None の場合は未指定)
+# @return (ユーザ名, パスワード) 失敗した場合は None
+def parseBasicAuth(auth):
+	if auth is None:
+		return None
+	
+	auth = auth.split(' ')
+	if auth[0] == 'Basic' and len(auth) == 2:
+		try:
+			info = base64.b64decode(auth[1]).split(':')
+			if len(info) == 2:
+				return (info[0].strip(), info[1].strip())
+		except TypeError:
+			pass
+	
+	return None
+
+# for sendfile function (Linux のみ)
+try:
+	if not sys.platform.startswith('linux'):
+		raise OSError(errno.ENOSYS, 'Not linux')
+	
+	_libc = ctypes.CDLL(None, use_errno=True)
+	_sendfile = _libc.sendfile64
+	_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+	_sendfile.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+	_sendfile = None
+
+## sendfile が利用可能か否か
+# @return 利用可能か否か
+def sendfileAvailable():
+	return _sendfile is not None
+
+## ファイルの内容をカーネル内で直接ソケットへ送信する
+# @param outfd 送信先ソケットのファイルディスクリプタ
+# @param infd 送信元ファイルのファイルディスクリプタ
+# @param offset 送信元ファイルの読み込み位置
+# @param count 送信する最大サイズ (byte)
+# @return 送信したサイズ (byte)
+def sendfile(outfd, infd, offset, count):
+	if _sendfile is None:
+		raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+	
+	ret = _sendfile(outfd, infd, ctypes.byref(ctypes.c_int64(offset)), count)
+	
+	if ret < 0:
+		err = ctypes.get_errno()
+		raise OSError(err, os.strerror(err))
+	
+	return ret
+
+## 比率を整数比に変換する
+# @param ratio 比率のリスト
+# @param maxTotal 整数比の合計の上限 (超える場合は近似する)
+# @return 整数比のリスト
+def intRatio(ratio, maxTotal = 10000):
+	# すべて 0 の場合
+	top = max(ratio) if len(ratio) > 0 else 0
+	if top <= 0:
+		return [0] * len(ratio)
+	
+	# 整数はそのまま使い、整数でないものだけを最大値に対する 1/1000 単位で近似する
+	# 0 でない比率が丸めで 0 になる場合は近似できる最小の値にする (選択されないリダイレクト先を作らない)
+	scale = fractions.Fraction(top) if top == int(top) else fractions.Fraction(top).limit_denominator(max(1000, int(1000 / top)))
+	minimum = fractions.Fraction(1, 1000)
+	ratio = [fractions.Fraction(0) if x <= 0 else fractions.Fraction(int(x)) if x == int(x) else max(minimum, (fractions.Fraction(x) / scale).limit_denominator(1000)) * scale for x in ratio]
+	
+	# 分母を払う
+	denom = reduce(lambda a, b: a * b // fractions.gcd(a, b), [x.denominator for x in ratio], 1)
+	ratio = [int(x * denom) for x in ratio]
+	
+	# 約分する
+	div = reduce(fractions.gcd, ratio)
+	ratio = [x // div for x in ratio]
+	
+	# 周期が長すぎる場合は近似する
+	total = sum(ratio)
+	if total > maxTotal:
+		ratio = [max(1, int(round(float(x) * maxTotal / total))) if x > 0 else 0 for x in ratio]
 	
-	return dt.strftime('%d/%b/%Y:%H:%M:%S %z')
+	return ratio
 
-## 出現比率に応じた数列を発生させる Generator を作成する
+## 出現比率に応じた1周期分の数列を作成する (smooth weighted round-robin)
 # @param ratio 比率のリスト
-# @return 数列を発生させる Generator
-def occuRatioSequence(ratio):
-	if len(ratio) == 1:
-		while True:
-			yield 0
+# @return インデックスのリスト (どの区間でも比率からのずれが最小になるように並ぶ)
+def occuRatioSchedule(ratio):
+	ratio = intRatio(ratio)
+	total = sum(ratio)
+	current = [0] * len(ratio)
+	seq = []
 	
-	total = float(sum(ratio))
-	ratio = [total / x for x in ratio]
+	for n in xrange(total):
+		current = [c + w for c, w in zip(current, ratio)]
+		i = current.index(max(current))
+		current[i] -= total
+		seq.append(i)
 	
-	unit = min(ratio) / len(ratio)
-	offset = max(ratio) / (len(ratio) - 1)
+	return seq
+
+## GLOB風ワイルドカードのワイルドカードを含まない先頭のディレクトリを列挙する
+# @param wc GLOB風ワイルドカード
+# @return ディレクトリ名のリスト (先頭の空文字列を含む)
+def wcPrefix(wc):
+	# 「\」区切りのパターンは前方一致で絞り込まない
+	if '\\' in wc:
+		return []
+	
+	prefix = []
 	
-	ratio = [(i, x) for i, x in enumerate(ratio)]
-	ratio.sort(lambda a, b: -1 if a[1] - b[1] < 0 else 1 if a[1] - b[1] > 0 else 0)
+	for seg in wc.split('/')[:-1]:
+		if '*' in seg or '?' in seg:
+			break
+		prefix.append(seg)
 	
-	index = [x[0] for x in ratio]
-	ratio = [x[1] for x in ratio]
+	return prefix
+
+## GLOB風ワイルドカードに一致するファイルを列挙する
+# @param root ルートディレクトリ
+# @param wc GLOB風ワイルドカード
+# @param ptn wc をコンパイルした正規表現
+# @return リクエストパスを列挙するイテレータ
+def walkWildcard(root, wc, ptn):
+	# ワイルドカードを含まないディレクトリより下だけをたどる
+	prefix = '/'.join(wcPrefix(wc))
+	top = os.path.join(root, prefix.lstrip('/'))
 	
-	ramp = [(i * offset) % ratio[i] for i, x in enumerate(ratio)]
+	for dirpath, dirnames, filenames in os.walk(top):
+		dirnames.sort()
+		
+		for name in sorted(filenames):
+			path = '/' + os.path.relpath(os.path.join(dirpath, name), root).replace(os.sep, '/')
+			
+			if ptn.match(path):
+				yield path
+
+## リダイレクト先の選択順序を作成する
+# @param redir fixed config.REDIRECT_TABLE の要素
+# @param factors リダイレクト先URLをキーとした weight の調整比率の辞書 (0 は選択しない)
+def buildRedirectSeq(redir, factors = None):
+	factors = factors or {}
+	oldSeq = redir.get('seq', {})
+	redir['seq'] = {}
 	
-	while True:
-		ramp = [x + unit for x in ramp]
-		seq = [index[i] for i, x in enumerate(ramp) if x >= ratio[i]]
-		ramp = [x - ratio[i] if x >= ratio[i] else x for i, x in enumerate(ramp)]
+	# このサーバを含む場合と含まない場合
+	for disableSelfHost in (False, True):
+		redirTo = [x for x in redir['to'] if not disableSelfHost or x['base_url'] != '']
+		targets = [(x['base_url'], x['weight'] * factors.get(x['base_url'], 1.0)) for x in redirTo]
+		targets = [x for x in targets if x[1] > 0]
+		
+		# すべて停止中の場合は調整しない
+		if len(targets) == 0:
+			targets = [(x['base_url'], x['weight']) for x in redirTo]
+		
+		if len(targets) >= 1:
+			seq = [targets[i][0] for i in occuRatioSchedule([x[1] for x in targets])]
+		else:
+			seq = []
 		
-		for x in seq:
-			yield x
+		# 選択位置は引き継ぐ
+		pos = oldSeq[disableSelfHost]['pos'] % len(seq) if disableSelfHost in oldSeq and len(seq) >= 1 else 0
+		
+		redir['seq'][disableSelfHost] = {'list': seq, 'pos': pos, 'targets': targets}
+
+## リダイレクト先の weight の調整比率を反映する
+# @param redirTable fixed config.REDIRECT_TABLE
+# @param factors リダイレクト先URLをキーとした weight の調整比率の辞書 (0 は選択しない)
+def applyRedirectFactors(redirTable, factors):
+	for redir in redirTable['rules']:
+		buildRedirectSeq(redir, factors)
+
+## リダイレクト先URLを列挙する
+# @param redirTable fixed config.REDIRECT_TABLE
+# @return リダイレクト先URLのリスト (このサーバを除く)
+def listRedirectUrls(redirTable):
+	urls = set()
+	
+	for redir in redirTable['rules']:
+		urls.update(x['base_url'] for x in redir['to'] if x['base_url'] != '')
+	
+	return sorted(urls)
 
 ## config.REDIRECT_TABLEの整形
 # @param redirTable config.REDIRECT_TABLE
+# @param memoSize 検索結果を記憶するパスの最大数
+# @param factors リダイレクト先URLをキーとした weight の調整比率の辞書
 # @return fixed config.REDIRECT_TABLE
-def fixRedirectTable(redirTable):
-	redirTable = copy.deepcopy(redirTable)
+def fixRedirectTable(redirTable, memoSize = 10000, factors = None):
+	rules = copy.deepcopy(redirTable)
+	
+	# パターンのディレクトリ部分によるツリー
+	index = {'rules': [], 'children': {}}
 	
-	for redir in redirTable:
-		redir['pattern'] = [re.compile(wc2re(x)) for x in redir['pattern']]
+	for i, redir in enumerate(rules):
+		wcs = redir['pattern']
+		redir['wildcard'] = wcs
+		redir['pattern'] = [re.compile(wc2re(x)) for x in wcs]
+		
+		for wc, ptn in zip(wcs, redir['pattern']):
+			node = index
+			for seg in wcPrefix(wc):
+				node = node['children'].setdefault(seg, {'rules': [], 'children': {}})
+			node['rules'].append((i, ptn))
+		
 		redir['to'] = [x for x in redir['to'] if x['weight'] != 0]
+		redir.setdefault('cache_control', None)
 		
 		for redirTo in redir['to']:
 			redirTo['weight'] = abs(redirTo['weight'])
 		
-		redir['seq'] = {}
+		redir.setdefault('mode', 'weighted')
+		redir.setdefault('preload', False)
+		
+		buildRedirectSeq(redir, factors)
 	
-	return redirTable
+	return {'rules': rules, 'index': index, 'memo': collections.OrderedDict(), 'memoSize': memoSize}
 
-## リダイレクト先を選択する
+## config.REDIRECT_TABLE の検証
+# @param redirTable config.REDIRECT_TABLE
+def checkRedirectTable(redirTable):
+	if not isinstance(redirTable, list):
+		raise ValueError('REDIRECT_TABLE must be a list')
+	
+	for i, redir in enumerate(redirTable):
+		if not isinstance(redir, dict):
+			raise ValueError('REDIRECT_TABLE[%d] must be a dict' % i)
+		
+		if not isinstance(redir.get('pattern'), list) or not all(isinstance(x, basestring) for x in redir['pattern']):
+			raise ValueError('REDIRECT_TABLE[%d]: pattern must be a list of strings' % i)
+		
+		if not isinstance(redir.get('to'), list):
+			raise ValueError('REDIRECT_TABLE[%d]: to must be a list' % i)
+		
+		for redirTo in redir['to']:
+			if not isinstance(redirTo, dict) or not isinstance(redirTo.get('base_url'), basestring) or not isinstance(redirTo.get('weight'), (int, long, float)):
+				raise ValueError('REDIRECT_TABLE[%d]: each of to needs base_url and a numeric weight' % i)
+		
+		if redir.get('mode', 'weighted') not in ('weighted', 'hash'):
+			raise ValueError('REDIRECT_TABLE[%d]: unknown mode %r' % (i, redir['mode']))
+
+## 変更のないリダイレクト設定の選択位置を引き継ぐ
+# パターン、リダイレクト先と weight、選択方法が同じものを変更のない設定とみなす
+# @param redirTable 新しい fixed config.REDIRECT_TABLE
+# @param oldTable 以前の fixed config.REDIRECT_TABLE
+def inheritRedirectSeq(redirTable, oldTable):
+	key = lambda redir: (tuple(redir['wildcard']), tuple((x['base_url'], x['weight']) for x in redir['to']), redir['mode'])
+	olds = {}
+	
+	for redir in oldTable.get('rules', []):
+		olds.setdefault(key(redir), []).append(redir)
+	
+	for redir in redirTable['rules']:
+		cands = olds.get(key(redir))
+		
+		if not cands:
+			continue
+		
+		old = cands.pop(0)
+		
+		for disableSelfHost, seq in redir['seq'].iteritems():
+			if disableSelfHost in old['seq'] and len(seq['list']) >= 1:
+				seq['pos'] = old['seq'][disableSelfHost]['pos'] % len(seq['list'])
+
+## パスに一致するリダイレクト設定を検索する
 # @param path リクエストパス
 # @param redirTable fixed config.REDIRECT_TABLE
+# @return 一致したリダイレクト設定 (見つからない場合は None)
+def findRedirect(path, redirTable):
+	memo = redirTable['memo']
+	
+	# 検索済みのパス
+	if path in memo:
+		redir = memo.pop(path)
+		memo[path] = redir
+		return redir
+	
+	# パスのディレクトリをたどって候補となるパターンを列挙
+	node = redirTable['index']
+	cands = list(node['rules'])
+	
+	for seg in path.split('/')[:-1]:
+		node = node['children'].get(seg)
+		if node is None:
+			break
+		cands.extend(node['rules'])
+	
+	# 設定の順にパターンマッチ
+	cands.sort(key=lambda x: x[0])
+	redir = None
+	
+	for i, ptn in cands:
+		if ptn.match(path):
+			redir = redirTable['rules'][i]
+			break
+	
+	# 検索結果を記憶 (古いものから削除)
+	memo[path] = redir
+	if len(memo) > redirTable['memoSize']:
+		memo.popitem(False)
+	
+	return redir
+
+## パスのハッシュによってリダイレクト先を選択する (weighted rendezvous hashing)
+# @param path リクエストパス
+# @param targets (リダイレクト先URL, weight) のリスト
+# @return リダイレクト先URL
+def selRedirectToByHash(path, targets):
+	best = None
+	bestScore = None
+	
+	for baseUrl, weight in targets:
+		# パスとリダイレクト先から (0, 1) の一様な値を作る
+		h = struct.unpack('<Q', hashlib.md5(baseUrl + '\0' + path).digest()[:8])[0]
+		h = (h + 0.5) / 18446744073709551616.0
+		
+		score = weight / -math.log(h)
+		
+		if bestScore is None or score > bestScore:
+			best = baseUrl
+			bestScore = score
+	
+	return best
+
+## リダイレクト設定からリダイレクト先を選択する
+# @param redir fixed config.REDIRECT_TABLE の要素
+# @param path リクエストパス
 # @param disableSelfHost このサーバからのファイル転送を無効化する
 # @return リダイレクト先URL
-def selRedirectTo(path, redirTable, disableSelfHost = False):
-	for redir in redirTable:
-		found = False
+def selRedirectToByRule(redir, path, disableSelfHost = False):
+	seq = redir['seq'][disableSelfHost]
+	
+	if len(seq['list']) >= 1:
+		# 同じパスは常に同じリダイレクト先
+		if redir['mode'] == 'hash':
+			return selRedirectToByHash(path, seq['targets'])
 		
-		for ptn in redir['pattern']:
-			if ptn.match(path):
-				found = True
-				break
+		pos = seq['pos']
+		seq['pos'] = pos + 1 if pos + 1 < len(seq['list']) else 0
 		
-		if found:
-			redirTo = [x for x in redir['to'] if not disableSelfHost or x['base_url'] != '']
-			
-			if len(redirTo) >= 1:
-				ratio = tuple(x['weight'] for x in redirTo)
-				
-				if ratio not in redir['seq']:
-					redir['seq'][ratio] = occuRatioSequence(ratio)
-				
-				return redirTo[redir['seq'][ratio].next()]['base_url']
-			
-			break
+		return seq['list'][pos]
 	
 	return None
+
+## リダイレクト先を選択する
+# @param path リクエストパス
+# @param redirTable fixed config.REDIRECT_TABLE
+# @param disableSelfHost このサーバからのファイル転送を無効化する
+# @return リダイレクト先URL
+def selRedirectTo(path, redirTable, disableSelfHost = False):
+	redir = findRedirect(path, redirTable)
+	
+	if redir is None:
+		return None
+	
+	return selRedirectToByRule(redir, path, disableSelfHost)